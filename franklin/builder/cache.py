@@ -0,0 +1,96 @@
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from core.cache import LRUCache, is_shared_cache
+
+logger = logging.getLogger(__name__)
+
+# Stored in place of a payload when a domain is not managed by Franklin
+DOMAIN_NOT_FOUND = 'not-found'
+
+_local = LRUCache(max_size=settings.DOMAIN_CACHE_SIZE,
+                  timeout=settings.DOMAIN_CACHE_LOCAL_TIMEOUT)
+
+# Domains invalidated inside deferred_invalidation blocks on this thread
+_deferred = threading.local()
+
+
+def _key(domain):
+    # Domains come straight from the query string; hash them so they are
+    # always valid keys for backends like memcached.
+    digest = hashlib.sha1(domain.encode('utf-8')).hexdigest()
+    return 'domain:{0}'.format(digest)
+
+
+def get_domain(domain):
+    """ Returns the cached payload for a domain, DOMAIN_NOT_FOUND for a cached
+    miss, or None if nothing is cached in this process or the shared cache.
+    """
+    key = _key(domain)
+    value = _local.get(key)
+    if value is None:
+        value = cache.get(key)
+        if value is not None:
+            _local.set(key, value)
+    return value
+
+
+def set_domain(domain, payload):
+    """ Stores the serialized build for a domain. A payload of None records
+    that the domain is unknown, which is cached for a shorter time.
+    """
+    key = _key(domain)
+    if payload is None:
+        payload = DOMAIN_NOT_FOUND
+        timeout = settings.DOMAIN_CACHE_MISS_TIMEOUT
+    else:
+        timeout = settings.DOMAIN_CACHE_TIMEOUT
+    if not is_shared_cache():
+        # Deploys run in the worker process, whose invalidations never reach
+        # this process's cache
+        timeout = min(timeout, settings.DOMAIN_CACHE_LOCAL_TIMEOUT)
+    cache.set(key, payload, timeout)
+    _local.set(key, payload, min(timeout, settings.DOMAIN_CACHE_LOCAL_TIMEOUT))
+
+
+def invalidate_domain(domain):
+    """ Drops a domain's cached lookup. Inside a deferred_invalidation block
+    it is dropped again when the block exits.
+    """
+    key = _key(domain)
+    cache.delete(key)
+    _local.delete(key)
+    pending = getattr(_deferred, 'keys', None)
+    if pending is not None:
+        pending.add(key)
+
+
+@contextmanager
+def deferred_invalidation():
+    """ Wrap transactions that change routes in this, outside the atomic
+    block. A lookup made before the transaction commits still reads the old
+    build and caches it for DOMAIN_CACHE_TIMEOUT, so domains invalidated in
+    the block are invalidated once more after the commit. Nested blocks
+    leave that to the outermost one.
+    """
+    outermost = getattr(_deferred, 'keys', None) is None
+    if outermost:
+        _deferred.keys = set()
+    try:
+        yield
+    finally:
+        if outermost:
+            keys, _deferred.keys = _deferred.keys, None
+            if keys:
+                cache.delete_many(list(keys))
+                for key in keys:
+                    _local.delete(key)
+
+
+def clear_local():
+    _local.clear()
@@ -0,0 +1,143 @@
+import logging
+import os
+import select
+import threading
+from collections import defaultdict
+
+from django.db import connection
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'franklin_build_events'
+
+
+class Broadcaster(object):
+    """ Wakes the event streams of a site when BuildEvents are added for it.
+
+    On Postgres, notify() issues a NOTIFY, which is only delivered when the
+    surrounding transaction commits, and a listener thread in every worker
+    process wakes its own streams; so streams also hear about changes made
+    by other workers and by the job worker. On other databases only streams
+    in the notifying process are woken.
+    """
+    # Seconds between listener reconnection attempts
+    RECONNECT_DELAY = 1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = defaultdict(set)
+        self._listener = None
+        self._stop = None
+        self._pid = None
+
+    @property
+    def uses_postgres(self):
+        return connection.vendor == 'postgresql'
+
+    def notify(self, site_ids):
+        if self.uses_postgres:
+            with connection.cursor() as cursor:
+                for site_id in site_ids:
+                    cursor.execute('SELECT pg_notify(%s, %s)',
+                                   [CHANNEL, str(site_id)])
+        else:
+            for site_id in site_ids:
+                self.wake(site_id)
+
+    def wake(self, site_id=None):
+        """ Wakes the streams of a site, or every stream """
+        with self._lock:
+            if site_id is None:
+                waiters = [waiter for waiters in self._waiters.values()
+                           for waiter in waiters]
+            else:
+                waiters = list(self._waiters.get(site_id, ()))
+        for waiter in waiters:
+            waiter.set()
+
+    def subscribe(self, site_id):
+        """ An Event that is set whenever the site has new BuildEvents """
+        waiter = threading.Event()
+        with self._lock:
+            self._waiters[site_id].add(waiter)
+        if self.uses_postgres:
+            self._ensure_listener()
+        return waiter
+
+    def unsubscribe(self, site_id, waiter):
+        with self._lock:
+            self._waiters[site_id].discard(waiter)
+            if not self._waiters[site_id]:
+                del self._waiters[site_id]
+
+    def stop(self, timeout=None):
+        """ Stops the listener thread and closes its connection; the next
+        subscribe() starts a new one
+        """
+        with self._lock:
+            if self._listener is None or self._pid != os.getpid():
+                return
+            listener, stop_fd = self._listener, self._stop
+            self._listener = self._stop = None
+        os.write(stop_fd, b'x')
+        os.close(stop_fd)
+        listener.join(timeout)
+
+    def _ensure_listener(self):
+        with self._lock:
+            # A listener thread doesn't survive a fork into a worker
+            if (self._pid == os.getpid() and self._listener is not None and
+                    self._listener.is_alive()):
+                return
+            self._pid = os.getpid()
+            params = connection.get_connection_params()
+            read_fd, self._stop = os.pipe()
+            self._listener = threading.Thread(target=self._listen,
+                                              args=(params, read_fd))
+            self._listener.daemon = True
+            self._listener.start()
+
+    def _listen(self, params, stop_fd):
+        """ Wakes streams on notifications until stop_fd becomes readable
+        """
+        reconnecting = False
+        try:
+            while True:
+                conn = None
+                try:
+                    conn = psycopg2.connect(**params)
+                    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                    conn.cursor().execute('LISTEN ' + CHANNEL)
+                    # Anything sent while we weren't listening is read again.
+                    # A stream that subscribed before the first connection
+                    # at worst waits for its next heartbeat to read again.
+                    if reconnecting:
+                        self.wake()
+                    while True:
+                        readable = select.select([conn, stop_fd], [], [],
+                                                 60)[0]
+                        if stop_fd in readable:
+                            return
+                        if not readable:
+                            continue
+                        conn.poll()
+                        while conn.notifies:
+                            self.wake(int(conn.notifies.pop(0).payload))
+                except Exception:
+                    logger.exception(
+                        'Build event listener failed, reconnecting')
+                    reconnecting = True
+                    if select.select([stop_fd], [], [],
+                                     self.RECONNECT_DELAY)[0]:
+                        return
+                finally:
+                    if conn is not None:
+                        conn.close()
+        finally:
+            os.close(stop_fd)
+
+
+broadcaster = Broadcaster()
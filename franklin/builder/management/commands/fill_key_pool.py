@@ -0,0 +1,31 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from builder.models import DeployKey
+from builder.tasks import fill_key_pool
+
+
+class Command(BaseCommand):
+    help = ('Fills the pool of pre-generated deploy keys. With --watch, keeps '
+            'checking and refills whenever it drops below the low water mark.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', type=int,
+                            default=settings.KEY_POOL_HIGH_WATER)
+        parser.add_argument('--processes', type=int, default=None)
+        parser.add_argument('--watch', type=float, default=None,
+                            help='Seconds between checks of the pool depth')
+
+    def handle(self, *args, **options):
+        while True:
+            depth = DeployKey.objects.count()
+            if options['watch'] is None or \
+                    depth < settings.KEY_POOL_LOW_WATER:
+                added = fill_key_pool(options['target'], options['processes'])
+                self.stdout.write('Added {0} keys, pool depth {1}'.format(
+                    added, DeployKey.objects.count()))
+            if options['watch'] is None:
+                return
+            time.sleep(options['watch'])
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('builder', '0003_auto_20160614_1940'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteChange',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, primary_key=True, auto_created=True)),
+                ('url', models.CharField(max_length=100)),
+                ('path', models.CharField(max_length=100, null=True, blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Route Change',
+                'verbose_name_plural': 'Route Changes',
+            },
+        ),
+    ]
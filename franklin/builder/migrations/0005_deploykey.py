@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('builder', '0004_routechange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeployKey',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, primary_key=True, auto_created=True)),
+                ('public_key', models.TextField()),
+                ('private_key', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Deploy Key',
+                'verbose_name_plural': 'Deploy Keys',
+            },
+        ),
+    ]
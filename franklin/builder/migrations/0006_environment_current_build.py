@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+def backfill_current_build(apps, schema_editor):
+    Environment = apps.get_model('builder', 'Environment')
+    Deploy = apps.get_model('builder', 'Deploy')
+    for environment in Environment.objects.iterator():
+        deploy = Deploy.objects.filter(environment=environment,
+                                       build__status='SUC')\
+                               .order_by('-deployed').first()
+        if deploy:
+            Environment.objects.filter(id=environment.id).update(
+                current_build=deploy.build_id,
+                current_deployed_at=deploy.deployed)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('builder', '0005_deploykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='environment',
+            name='current_build',
+            field=models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, blank=True, to='builder.Build', null=True),
+        ),
+        migrations.AddField(
+            model_name='environment',
+            name='current_deployed_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.RunPython(backfill_current_build,
+                             migrations.RunPython.noop),
+    ]
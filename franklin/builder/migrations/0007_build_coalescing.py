@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('builder', '0006_environment_current_build'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='build',
+            name='target_environment',
+            field=models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, blank=True, to='builder.Environment', null=True),
+        ),
+        migrations.AddField(
+            model_name='build',
+            name='started',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AlterField(
+            model_name='build',
+            name='status',
+            field=models.CharField(default='NEW', max_length=3, choices=[('NEW', 'new'), ('BLD', 'building'), ('SUC', 'success'), ('FAL', 'failed'), ('SUP', 'superseded')]),
+        ),
+    ]
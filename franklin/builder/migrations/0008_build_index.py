@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('builder', '0007_build_coalescing'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='build',
+            index_together=set([('site', 'created', 'id')]),
+        ),
+    ]
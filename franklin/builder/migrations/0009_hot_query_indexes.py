@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('builder', '0008_build_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='environment',
+            name='lookup_name',
+            field=models.CharField(default='', max_length=100, editable=False),
+        ),
+        migrations.RunSQL(
+            "UPDATE builder_environment SET lookup_name = LOWER(name)",
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterIndexTogether(
+            name='environment',
+            index_together=set([('site', 'lookup_name')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='deploy',
+            index_together=set([('environment', 'deployed'), ('build', 'environment')]),
+        ),
+        # Only active sites are listed for users
+        migrations.RunSQL(
+            "CREATE INDEX builder_site_owner_active "
+            "ON builder_site (owner_id) WHERE is_active",
+            "DROP INDEX builder_site_owner_active",
+        ),
+        # Builds waiting for, or with, the builder; see Environment.queue_build
+        migrations.RunSQL(
+            "CREATE INDEX builder_build_pending "
+            "ON builder_build (target_environment_id, status) "
+            "WHERE status IN ('NEW', 'BLD')",
+            "DROP INDEX builder_build_pending",
+        ),
+    ]
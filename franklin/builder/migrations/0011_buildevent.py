@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('builder', '0010_build_builder_url'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuildEvent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, primary_key=True, auto_created=True)),
+                ('kind', models.CharField(max_length=10)),
+                ('data', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('build', models.ForeignKey(related_name='+', to='builder.Build', on_delete=django.db.models.deletion.CASCADE)),
+                ('site', models.ForeignKey(related_name='+', to='builder.Site', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='buildevent',
+            index_together=set([('site', 'id')]),
+        ),
+    ]
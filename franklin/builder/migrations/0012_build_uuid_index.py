@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('builder', '0011_buildevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='build',
+            name='uuid',
+            field=models.UUIDField(editable=False, default=uuid.uuid4, db_index=True),
+        ),
+    ]
@@ -1,15 +1,33 @@
+import json
 import logging
 import os
-import re
+import time
 import uuid
+from datetime import timedelta
 
+from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 
-from core.exceptions import ServiceUnavailable
-from core.helpers import generate_ssh_keys, make_rest_post_call
+from .cache import deferred_invalidation, invalidate_domain
+from .events import broadcaster
+from .pool import get_builder_pool
+from .routing import RoutingIndex, get_routing_index, \
+    invalidate_routing_index
+from core.exceptions import BadRequest, ServiceUnavailable, \
+    ServiceUnreachable
+from core.helpers import generate_ssh_keys
+from core.jobs import enqueue
+from core.metrics import BUILDER_DISPATCH_FAILURES, \
+    BUILDER_DISPATCH_LATENCY, DEPLOY_KEY_CLAIM_LATENCY, record_transition
 from github.api import get_branch_details, get_default_branch
+from github.ratelimit import READ
 
 
 logger = logging.getLogger(__name__)
@@ -32,6 +50,57 @@ class Owner(models.Model):
         verbose_name_plural = _('Owners')
 
 
+class DeployKey(models.Model):
+    """ A pre-generated SSH keypair, waiting to be handed to a new site so RSA
+    key generation stays off the request path. See builder.tasks.fill_key_pool
+
+    :param public_key: OpenSSH formatted public key
+    :param private_key: PEM formatted private key
+    :param created: Date the key was generated
+    """
+    public_key = models.TextField()
+    private_key = models.TextField()
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+
+    @classmethod
+    def claim(cls):
+        """ Atomically takes a key out of the pool. Returns a (public, private)
+        tuple, or None when the pool is empty.
+        """
+        start = time.monotonic()
+        candidates = cls.objects.order_by('id')\
+                                .values_list('id', 'public_key', 'private_key')
+        # Concurrent claims may race for the same rows; whoever deletes the
+        # row owns the key, so try a few before giving up.
+        for key_id, public_key, private_key in candidates[:5]:
+            with connection.cursor() as cursor:
+                cursor.execute('DELETE FROM {0} WHERE id = %s'.format(
+                    cls._meta.db_table), [key_id])
+                claimed = cursor.rowcount == 1
+            if claimed:
+                DEPLOY_KEY_CLAIM_LATENCY.labels('claimed').observe(
+                    time.monotonic() - start)
+                return (public_key, private_key)
+        DEPLOY_KEY_CLAIM_LATENCY.labels('empty').observe(
+            time.monotonic() - start)
+        logger.warning('Deploy key pool is empty')
+        cls.request_refill()
+        return None
+
+    @classmethod
+    def request_refill(cls):
+        """ Queues a fill_key_pool job unless one is already queued """
+        if cache.add('deploy-key-pool-refill', True, 10 * 60):
+            enqueue('builder.tasks.fill_key_pool')
+
+    def __str__(self):
+        return '%s %s' % (self.id, self.created)
+
+    class Meta(object):
+        verbose_name = _('Deploy Key')
+        verbose_name_plural = _('Deploy Keys')
+
+
 class Site(models.Model):
     """ Represents a 'deployed' or soon-to-be deployed static site.
 
@@ -55,32 +124,90 @@ class Site(models.Model):
     webhook_id = models.CharField(blank=True, null=True, max_length=12)
     is_active = models.BooleanField(default=True)
 
+    def get_routing_index(self):
+        def build():
+            index = RoutingIndex()
+            for env_id, deploy_type, branch, tag_regex in \
+                    self.environments.values_list(
+                        'id', 'deploy_type', 'branch', 'tag_regex'):
+                if deploy_type == Environment.BRANCH:
+                    index.add_branch(branch, env_id)
+                elif deploy_type == Environment.TAG:
+                    index.add_tag(tag_regex, env_id)
+            return index
+        return get_routing_index(self.id, build)
+
+    def get_deployable_environments(self, event, is_tag_event=False):
+        """ Every environment that should be built for a push or tag event.
+        `event` is the full ref for pushes (refs/heads/<branch>) and the tag
+        name for tag events.
+        """
+        if not self.is_active:
+            return []
+        env_ids = self.get_routing_index().match(event, is_tag_event)
+        if not env_ids:
+            return []
+        return list(self.environments.filter(id__in=env_ids).order_by('id'))
+
     def get_deployable_environment(self, event, is_tag_event=False):
-        if self.is_active:
-            for env in self.environments.all():
-                if (env.deploy_type == Environment.BRANCH and not
-                        is_tag_event and event.endswith(env.branch)):
-                    return env
-                elif (env.deploy_type == Environment.TAG and
-                        is_tag_event and re.match(env.tag_regex, event)):
-                    return env
-        return None
+        environments = self.get_deployable_environments(event, is_tag_event)
+        return environments[0] if environments else None
 
-    def get_newest_commit(self, user):
+    def get_newest_commit(self, user, priority=READ):
         """ Calls github and retrieves the current git hash of the most recent
         code push to the default branch of the repo
         """
-        branch = get_default_branch(self, user)
-        git_hash = get_branch_details(self, user, branch)
+        branch = get_default_branch(self, user, priority)
+        git_hash = get_branch_details(self, user, branch, priority)
         return (branch, git_hash)
 
     def get_most_recent_build(self):
+        if hasattr(self, '_most_recent_build'):
+            return self._most_recent_build
         return BranchBuild.objects.filter(site=self)\
                                   .order_by('-created').first()
 
+    @staticmethod
+    def prefetch_most_recent_builds(sites):
+        """ Loads the newest build of every site in a single query, so
+        get_most_recent_build doesn't query once per site. Returns the sites
+        as a list.
+        """
+        sites = list(sites)
+        builds = BranchBuild.objects.filter(site__in=sites)\
+                                    .order_by('site_id', '-created', '-id')\
+                                    .distinct('site_id')
+        latest = {build.site_id: build for build in builds}
+        for site in sites:
+            site._most_recent_build = latest.get(site.id)
+        return sites
+
+    def delete_history(self, batch_size):
+        """ Deletes the site's builds and their deploys in batches, each in
+        its own short transaction, so large sites don't hold long locks.
+        """
+        while True:
+            ids = list(self.builds.order_by('id')
+                                  .values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return
+            with deferred_invalidation(), transaction.atomic():
+                deploys = Deploy.objects.filter(build_id__in=ids)
+                env_ids = set(deploys.values_list('environment_id',
+                                                  flat=True))
+                # Skips update_deploy_route, which would record a route
+                # change per deploy; each environment is updated once below,
+                # after its current build is cleared
+                deploys._raw_delete(deploys.db)
+                Build.objects.filter(id__in=ids).delete()
+                for environment in Environment.objects.filter(
+                        id__in=env_ids).select_related('current_build'):
+                    update_route(environment.url, environment)
+
     def save(self, user=None, *args, **kwargs):
         if not self.deploy_key:
-            self.deploy_key, self.deploy_key_secret = generate_ssh_keys()
+            self.deploy_key, self.deploy_key_secret = \
+                DeployKey.claim() or generate_ssh_keys()
         if not self.environments.exists() and user:
             branch = get_default_branch(self, user)
             self.environments.create(
@@ -105,63 +232,119 @@ class Build(models.Model):
     :param created: Date this code was built
     :param deployed: Date this code was last deployed to an environment
     :param path: The path of the site on the static server
+    :param target_environment: The environment a push queued this build for.
+                               Newer pushes to it supersede the build while
+                               it is still NEW
+    :param started: When the build was last sent to the builder
+    :param builder_url: The builder node that accepted the build
     """
 
     NEW = 'NEW'
     BUILDING = 'BLD'
     SUCCESS = 'SUC'
     FAILED = 'FAL'
+    SUPERSEDED = 'SUP'
     STATUS_CHOICES = (
         (NEW, _('new')),
         (BUILDING, _('building')),
         (SUCCESS, _('success')),
-        (FAILED, _('failed'))
+        (FAILED, _('failed')),
+        (SUPERSEDED, _('superseded'))
     )
+    DEPLOYABLE_STATUSES = (NEW, SUCCESS, FAILED)
 
-    uuid = models.UUIDField(default=uuid.uuid4, editable=False)
+    uuid = models.UUIDField(default=uuid.uuid4, editable=False, db_index=True)
     site = models.ForeignKey(Site, related_name='builds')
     created = models.DateTimeField(auto_now_add=True, editable=False)
     status = models.CharField(max_length=3, choices=STATUS_CHOICES,
                               default=NEW)
+    target_environment = models.ForeignKey(
+        'Environment', related_name='+', blank=True, null=True,
+        on_delete=models.SET_NULL)
+    started = models.DateTimeField(blank=True, null=True)
+    builder_url = models.CharField(max_length=255, blank=True, default='')
 
     @property
     def path(self):
         return "{0}/{1}".format(self.site.github_id, self.uuid)
 
     def can_build(self):
-        return self.status is not self.BUILDING
+        return self.status in self.DEPLOYABLE_STATUSES
+
+    def transition(self, from_statuses, to_status, **fields):
+        """ Moves the build to `to_status` only if it is still in one of
+        `from_statuses`, as a single conditional UPDATE. Returns whether this
+        call made the change.
+        """
+        updated = Build.objects.filter(
+            id=self.id, status__in=from_statuses
+        ).update(status=to_status, **fields)
+        if updated:
+            record_transition(self.status if self.status in from_statuses
+                              else None, to_status)
+            self.status = to_status
+            for name, value in fields.items():
+                setattr(self, name, value)
+            BuildEvent.publish([BuildEvent.for_status(self)])
+        return bool(updated)
 
     def deploy(self, environment):
-        if self.can_build():
-            callback = os.environ['API_BASE_URL'] + \
-                reverse('webhook:builder', args=[str(self.uuid), ])
-
-            url = os.environ['BUILDER_URL'] + '/build'
-            headers = {'content-type': 'application/json'}
-            body = {
-                "deploy_key": self.site.deploy_key_secret,
-                "branch": self.branch,
-                "git_hash": self.git_hash,
-                "repo_owner": self.site.owner.name,
-                "path": self.path,
-                "repo_name": self.site.name,
-                "environment": environment.name.lower(),
-                'callback': callback
-            }
-            try:
-                make_rest_post_call(url, headers, body)
-            except:
-                logger.warn('Builder down?')
-                msg = 'Service temporarily unavailable: franklin-build'
-                raise ServiceUnavailable(detail=msg)
-            self.status = self.BUILDING
-            self.save()
-        else:
-            logger.error("Build being/been built by builder...")
+        previous = self.status
+        if not self.transition(self.DEPLOYABLE_STATUSES, self.BUILDING,
+                               started=timezone.now()):
+            logger.error("Build %s being/been built by builder or "
+                         "superseded", self.uuid)
+            return False
+
+        callback = os.environ['API_BASE_URL'] + \
+            reverse('webhook:builder', args=[str(self.uuid), ])
+
+        headers = {'content-type': 'application/json'}
+        body = {
+            "deploy_key": self.site.deploy_key_secret,
+            "branch": self.branch,
+            "git_hash": self.git_hash,
+            "repo_owner": self.site.owner.name,
+            "path": self.path,
+            "repo_name": self.site.name,
+            "environment": environment.name.lower(),
+            'callback': callback
+        }
+        start = time.perf_counter()
+        try:
+            builder_url = get_builder_pool().post('/build', headers,
+                                                  body)[0]
+        except ServiceUnreachable:
+            logger.warning('Builder unreachable for build %s', self.uuid)
+            BUILDER_DISPATCH_FAILURES.inc()
+            # No builder has the build, so hand it back for a retry to claim
+            self.transition((self.BUILDING, ), previous)
+            raise
+        except BadRequest:
+            logger.error('Builder rejected build %s', self.uuid)
+            BUILDER_DISPATCH_FAILURES.inc()
+            self.transition((self.BUILDING, ), self.FAILED)
+            return False
+        except ServiceUnavailable as e:
+            # The builder may be building it already; its callback, or
+            # BUILD_TIMEOUT, settles the build
+            builder_url = getattr(e, 'node_url', None)
+            logger.warning('No answer from builder %s for build %s',
+                           builder_url, self.uuid)
+            BUILDER_DISPATCH_FAILURES.inc()
+        finally:
+            BUILDER_DISPATCH_LATENCY.observe(time.perf_counter() - start)
+        self.builder_url = builder_url
+        Build.objects.filter(id=self.id).update(builder_url=builder_url)
+        return True
 
     def __str__(self):
         return '%s - %s' % (self.status, self.created)
 
+    class Meta(object):
+        # Serves a site's build history newest first, see KeysetPagination
+        index_together = ('site', 'created', 'id')
+
 
 class BranchBuild(Build):
     """ Flavor of build that was created from a branch
@@ -192,7 +375,11 @@ class Environment(models.Model):
                       deployed (If deploy_type is tag)
     :param url: The url builder has deployed this project to
     :param past_builds: Ref to all builds that can be marked current_deployed
-    :param status: The current status of the deployed version on Franklin
+    :param current_build: The build currently deployed. Maintained whenever a
+                          Deploy is created, see set_current_build
+    :param current_deployed_at: When current_build was deployed
+    :param lookup_name: Lowercased name, for case-insensitive lookups that
+                        can use an index
     """
 
     BRANCH = 'BCH'
@@ -213,12 +400,62 @@ class Environment(models.Model):
     url = models.CharField(max_length=100, unique=True)
     past_builds = models.ManyToManyField(
         Build, related_name='environments', through='Deploy', blank=True)
+    current_build = models.ForeignKey(
+        Build, related_name='+', blank=True, null=True,
+        on_delete=models.SET_NULL)
+    current_deployed_at = models.DateTimeField(blank=True, null=True)
+    lookup_name = models.CharField(max_length=100, default='',
+                                   editable=False)
 
     def get_current_deploy(self):
-        return self.past_builds.filter(status=Build.SUCCESS)\
-                               .order_by('-created').first()
+        return self.current_build
+
+    def queue_build(self, git_hash, branch):
+        """ Creates a build of `git_hash` for this environment and queues it
+        for the builder. Builds still waiting to be sent are superseded, so a
+        burst of pushes only builds the newest commit.
+        """
+        with transaction.atomic():
+            # Serialize concurrent pushes for this environment
+            list(Environment.objects.select_for_update().filter(id=self.id))
+            superseded = list(Build.objects.filter(
+                target_environment=self, status=Build.NEW))
+            if superseded:
+                Build.objects.filter(
+                    id__in=[build.id for build in superseded]
+                ).update(status=Build.SUPERSEDED)
+                logger.info('Superseded %d queued builds for %s',
+                            len(superseded), self.url)
+                record_transition(Build.NEW, Build.SUPERSEDED,
+                                  len(superseded))
+            build = BranchBuild.objects.create(
+                git_hash=git_hash, branch=branch, site=self.site,
+                target_environment=self)
+            for superseded_build in superseded:
+                superseded_build.status = Build.SUPERSEDED
+            BuildEvent.publish([BuildEvent.for_status(superseded_build)
+                                for superseded_build in superseded] +
+                               [BuildEvent.for_status(build)])
+            enqueue('builder.tasks.deploy_build', build_id=build.id,
+                    environment_id=self.id)
+        return build
+
+    def set_current_build(self, build, deployed):
+        """ Points the environment at a newly deployed build, unless a newer
+        deploy got there first.
+        """
+        updated = Environment.objects.filter(
+            Q(current_deployed_at__isnull=True) |
+            Q(current_deployed_at__lte=deployed), id=self.id
+        ).update(current_build=build, current_deployed_at=deployed)
+        if updated:
+            self.current_build = build
+            self.current_deployed_at = deployed
+            update_route(self.url, self)
+        return bool(updated)
 
     def save(self, *args, **kwargs):
+        self.lookup_name = self.name.lower()
         if not self.url:
             if self.name == self.site.DEFAULT_ENV:
                 self.url = "{0}.{1}".format(self.site.name.lower(),
@@ -236,6 +473,7 @@ class Environment(models.Model):
         verbose_name = _('Environment')
         verbose_name_plural = _('Environments')
         unique_together = ('name', 'site')
+        index_together = ('site', 'lookup_name')
 
 
 class Deploy(models.Model):
@@ -250,5 +488,161 @@ class Deploy(models.Model):
     build = models.ForeignKey(Build, on_delete=models.CASCADE)
     deployed = models.DateTimeField(auto_now_add=True, editable=False)
 
+    def save(self, *args, **kwargs):
+        created = self.pk is None
+        with deferred_invalidation(), transaction.atomic():
+            super(Deploy, self).save(*args, **kwargs)
+            if created and self.build.status == Build.SUCCESS:
+                self.environment.set_current_build(self.build, self.deployed)
+            if created:
+                BuildEvent.publish([BuildEvent.for_deploy(self)])
+
     def __str__(self):
         return '%s %s' % (self.environment.site.name, self.deployed)
+
+    class Meta(object):
+        index_together = (('environment', 'deployed'),
+                          ('build', 'environment'))
+
+
+class RouteChange(models.Model):
+    """ Log of changes to the domain routing table. The id acts as the routing
+    table version that edge proxies poll against. Changes older than
+    ROUTES_RETENTION are compacted away, except the latest one.
+
+    :param url: The environment url whose route changed
+    :param path: Path of the build now served for the url. Null if the url no
+                 longer routes anywhere
+    :param created: Date the change was recorded
+    """
+    url = models.CharField(max_length=100)
+    path = models.CharField(max_length=100, blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+
+    @classmethod
+    def latest_version(cls):
+        return cls.objects.order_by('-id').values_list('id', flat=True)\
+                          .first() or 0
+
+    def __str__(self):
+        return '%s %s' % (self.id, self.url)
+
+    class Meta(object):
+        verbose_name = _('Route Change')
+        verbose_name_plural = _('Route Changes')
+
+
+class BuildEvent(models.Model):
+    """ Append-only log of what happened to a site's builds, streamed to
+    dashboards. The id is the event id clients resume from.
+
+    :param site: The site of the build
+    :param build: The build the event is about
+    :param kind: status when the build changed status, deploy when it was
+                 deployed to an environment
+    :param data: JSON sent to clients
+    :param created: Date the event was recorded
+    """
+    STATUS = 'status'
+    DEPLOY = 'deploy'
+
+    site = models.ForeignKey(Site, related_name='+', on_delete=models.CASCADE)
+    build = models.ForeignKey(Build, related_name='+',
+                              on_delete=models.CASCADE)
+    kind = models.CharField(max_length=10)
+    data = models.TextField()
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+
+    @classmethod
+    def for_status(cls, build):
+        return cls(site_id=build.site_id, build_id=build.id, kind=cls.STATUS,
+                   data=json.dumps({
+                       'uuid': str(build.uuid),
+                       'status': dict(Build.STATUS_CHOICES)[build.status],
+                   }))
+
+    @classmethod
+    def for_deploy(cls, deploy):
+        build = deploy.build
+        return cls(site_id=build.site_id, build_id=build.id, kind=cls.DEPLOY,
+                   data=json.dumps({
+                       'uuid': str(build.uuid),
+                       'environment': deploy.environment.name,
+                       'deployed': deploy.deployed.isoformat(),
+                   }))
+
+    @classmethod
+    def publish(cls, events):
+        """ Records events and wakes the streams of their sites, once the
+        surrounding transaction commits on Postgres
+        """
+        cls.objects.bulk_create(events)
+        broadcaster.notify({event.site_id for event in events})
+
+    def __str__(self):
+        return '%s %s' % (self.id, self.kind)
+
+    class Meta(object):
+        index_together = ('site', 'id')
+
+
+def update_route(url, environment=None):
+    """ Drops cached lookups for a domain and records its current route """
+    invalidate_domain(url)
+    build = environment.get_current_deploy() if environment else None
+    RouteChange.objects.create(url=url, path=build.path if build else None)
+
+
+def compact_route_changes():
+    """ Deletes route changes older than ROUTES_RETENTION. The latest change
+    is kept so the current version stays resolvable.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.ROUTES_RETENTION)
+    RouteChange.objects.filter(
+        created__lt=cutoff, id__lt=RouteChange.latest_version()
+    ).delete()
+
+
+def prune_build_events():
+    """ Deletes build events older than SSE_EVENT_RETENTION """
+    cutoff = timezone.now() - timedelta(seconds=settings.SSE_EVENT_RETENTION)
+    # Events are recorded in roughly id order, so walking back from the
+    # newest id only reads the events kept
+    newest = BuildEvent.objects.filter(created__lt=cutoff).order_by('-id')\
+                               .values_list('id', flat=True).first()
+    if newest:
+        BuildEvent.objects.filter(id__lte=newest).delete()
+
+
+@receiver(post_delete, sender=Deploy)
+def update_deploy_route(sender, instance, **kwargs):
+    update_route(instance.environment.url, instance.environment)
+
+
+@receiver(pre_save, sender=Environment)
+def remove_previous_environment_route(sender, instance, **kwargs):
+    if instance.pk:
+        previous = Environment.objects.filter(pk=instance.pk)\
+                                      .values_list('url', flat=True).first()
+        if previous and previous != instance.url:
+            update_route(previous)
+
+
+@receiver(post_save, sender=Environment)
+def update_environment_route(sender, instance, **kwargs):
+    invalidate_routing_index(instance.site_id)
+    update_route(instance.url, instance)
+
+
+@receiver(post_delete, sender=Environment)
+def remove_environment_route(sender, instance, **kwargs):
+    invalidate_routing_index(instance.site_id)
+    update_route(instance.url)
+
+
+@receiver(post_delete, sender=Site)
+@receiver(post_save, sender=Site)
+def invalidate_site_domains(sender, instance, **kwargs):
+    for url in Environment.objects.filter(site_id=instance.pk)\
+                                  .values_list('url', flat=True):
+        invalidate_domain(url)
@@ -0,0 +1,193 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from core.exceptions import BadRequest, ServiceUnavailable, \
+    ServiceUnreachable
+from core.helpers import make_rest_get_call, make_rest_post_call
+
+logger = logging.getLogger(__name__)
+
+
+class BuilderNode(object):
+    """ One franklin-builder and the circuit breaker in front of it.
+
+    closed: calls go through; the breaker opens after
+            BUILDER_FAILURE_THRESHOLD failures in a row, or when more than
+            BUILDER_MAX_ERROR_RATE of the last BUILDER_ERROR_WINDOW calls
+            failed
+    open: no calls for BUILDER_OPEN_SECONDS
+    half-open: one caller probes /health/; success closes the breaker,
+               failure opens it again
+
+    State is kept per worker process.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    UNREACHABLE = {'status': 'unreachable'}
+
+    def __init__(self, url):
+        self.url = url
+        self.state = self.CLOSED
+        self._outcomes = deque(maxlen=settings.BUILDER_ERROR_WINDOW)
+        self._consecutive_failures = 0
+        self._opened = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def error_rate(self):
+        with self._lock:
+            if not self._outcomes:
+                return 0.0
+            return self._outcomes.count(False) / len(self._outcomes)
+
+    def acquire(self):
+        """ Whether a call may be sent to this node now. A half-open node
+        lets through only the caller that gets to probe it.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (self.state == self.OPEN and time.monotonic() - self._opened <
+                    settings.BUILDER_OPEN_SECONDS):
+                return False
+            if self._probing:
+                return False
+            self.state = self.HALF_OPEN
+            self._probing = True
+        return self.probe(settings.BUILDER_PROBE_TIMEOUT) is not \
+            self.UNREACHABLE
+
+    def probe(self, timeout):
+        """ The node's /health/, which also counts as a call """
+        result = self.get_health(timeout)
+        if result is self.UNREACHABLE:
+            self.record_failure()
+        else:
+            self.record_success()
+        return result
+
+    def get_health(self, timeout):
+        """ The node's /health/, leaving the breaker alone. Not retried,
+        so it takes no longer than `timeout`.
+        """
+        try:
+            response = make_rest_get_call(self.url + '/health/', '',
+                                          timeout=timeout, max_retries=0)
+            return response.json()
+        except Exception:
+            return self.UNREACHABLE
+
+    def record_success(self):
+        with self._lock:
+            self._outcomes.append(True)
+            self._consecutive_failures = 0
+            self._probing = False
+            if self.state != self.CLOSED:
+                logger.info('Builder %s is back, closing its breaker',
+                            self.url)
+                self.state = self.CLOSED
+                self._outcomes.clear()
+
+    def record_failure(self):
+        with self._lock:
+            self._outcomes.append(False)
+            self._consecutive_failures += 1
+            self._probing = False
+            failures = self._outcomes.count(False)
+            tripped = (
+                self.state == self.HALF_OPEN or
+                self._consecutive_failures >=
+                settings.BUILDER_FAILURE_THRESHOLD or
+                (len(self._outcomes) == self._outcomes.maxlen and
+                 failures / len(self._outcomes) >
+                 settings.BUILDER_MAX_ERROR_RATE))
+            if tripped and self.state != self.OPEN:
+                logger.warning('Builder %s failing, opening its breaker',
+                               self.url)
+            if tripped:
+                self.state = self.OPEN
+                self._opened = time.monotonic()
+
+
+class BuilderPool(object):
+    """ The franklin-builder nodes listed in BUILDER_URL (comma separated).
+    Builds are spread round robin over nodes whose breaker lets calls
+    through, failing over to the next one when a node can't be connected to
+    or answers with a server error.
+
+    :param urls: Base urls of the builder nodes
+    """
+    def __init__(self, urls):
+        self.nodes = [BuilderNode(url) for url in urls]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _ordered(self):
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.nodes)
+        return self.nodes[start:] + self.nodes[:start]
+
+    def post(self, path, headers, body):
+        """ POSTs to the first available node. Returns (node url, response).
+
+        A node that times out, or fails with a server error other than
+        502/503/504, may still have accepted the call, so the call isn't sent
+        to another node then; the ServiceUnavailable is raised
+        with the node's url as `node_url`. ServiceUnreachable is raised when
+        no node got the call, and BadRequest when a node refused it.
+        """
+        for node in self._ordered():
+            if not node.acquire():
+                continue
+            try:
+                response = make_rest_post_call(node.url + path, headers, body)
+            except ServiceUnreachable:
+                node.record_failure()
+                continue
+            except ServiceUnavailable as e:
+                node.record_failure()
+                e.node_url = node.url
+                raise
+            except BadRequest:
+                # The node is up, the call was wrong
+                node.record_success()
+                raise
+            node.record_success()
+            return node.url, response
+        msg = 'Service temporarily unavailable: franklin-build'
+        raise ServiceUnreachable(detail=msg)
+
+    def check_health(self, timeout):
+        """ Probes every node, within `timeout` seconds in total. Breakers
+        are left out: they live in each process and only the job workers'
+        see builds being sent.
+        """
+        timeout = timeout / len(self.nodes)
+        nodes = {node.url: node.get_health(timeout) for node in self.nodes}
+        healthy = any(result is not BuilderNode.UNREACHABLE
+                      for result in nodes.values())
+        return {'status': 'good' if healthy else 'unreachable',
+                'nodes': nodes}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_builder_pool():
+    """ The pool for the current BUILDER_URL, rebuilt if it changed """
+    global _pool
+    urls = [url.strip().rstrip('/')
+            for url in os.environ['BUILDER_URL'].split(',') if url.strip()]
+    with _pool_lock:
+        if _pool is None or [node.url for node in _pool.nodes] != urls:
+            _pool = BuilderPool(urls)
+        return _pool
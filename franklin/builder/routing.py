@@ -0,0 +1,129 @@
+import logging
+import re
+import sre_constants
+import sre_parse
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from core.cache import LRUCache, is_shared_cache
+
+logger = logging.getLogger(__name__)
+
+BRANCH_PREFIX = 'refs/heads/'
+
+# Refs longer than this are never matched against user supplied patterns
+MAX_TAG_LENGTH = 255
+
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+# Per-worker map of site id -> (generation, RoutingIndex)
+_local = LRUCache(max_size=settings.ROUTING_INDEX_CACHE_SIZE)
+
+
+def _children(value):
+    if isinstance(value, sre_parse.SubPattern):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _children(item)
+
+
+def _has_repeat(pattern):
+    for op, value in pattern:
+        if op in _REPEATS and value[1] > 1:
+            return True
+        if any(_has_repeat(child) for child in _children(value)):
+            return True
+    return False
+
+
+def _has_nested_repeat(pattern):
+    for op, value in pattern:
+        if op in _REPEATS and value[1] > 1 and _has_repeat(value[2]):
+            return True
+        if any(_has_nested_repeat(child) for child in _children(value)):
+            return True
+    return False
+
+
+def compile_tag_regex(pattern):
+    """ Compiles a tag pattern, or returns None if it is invalid or nests
+    unbounded quantifiers (e.g. `(a+)+`), which can backtrack exponentially.
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, OverflowError, RecursionError) as e:
+        logger.warning('Invalid tag pattern %r: %s', pattern, e)
+        return None
+    if _has_nested_repeat(parsed):
+        logger.warning('Rejected tag pattern %r: nested quantifiers', pattern)
+        return None
+    return re.compile(pattern)
+
+
+class RoutingIndex(object):
+    """ A site's environments compiled for matching webhook events: an exact
+    map of branch name to environments, and precompiled tag patterns.
+    """
+    def __init__(self):
+        self.branches = {}
+        self.tags = []
+
+    def add_branch(self, branch, environment_id):
+        self.branches.setdefault(branch, []).append(environment_id)
+
+    def add_tag(self, pattern, environment_id):
+        regex = compile_tag_regex(pattern) if pattern else None
+        if regex:
+            self.tags.append((regex, environment_id))
+
+    def match(self, ref, is_tag_event=False):
+        """ Ids of every environment deployed by `ref` """
+        if is_tag_event:
+            if len(ref) > MAX_TAG_LENGTH:
+                return []
+            return [environment_id for regex, environment_id in self.tags
+                    if regex.match(ref)]
+        if ref.startswith(BRANCH_PREFIX):
+            return list(self.branches.get(ref[len(BRANCH_PREFIX):], ()))
+        return []
+
+
+def _generation_key(site_id):
+    return 'routing-index:{0}'.format(site_id)
+
+
+def _generation_timeout():
+    # Generations bumped by other workers never reach a per-process cache, so
+    # there each one only lasts a few seconds
+    if is_shared_cache():
+        return None
+    return settings.ROUTING_INDEX_LOCAL_TIMEOUT
+
+
+def get_routing_index(site_id, build):
+    """ Returns the site's RoutingIndex, calling `build` to compile a new one
+    if this worker has none or the site's environments changed since.
+    """
+    key = _generation_key(site_id)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, uuid.uuid4().hex, _generation_timeout())
+        generation = cache.get(key)
+        if generation is None:
+            # No shared cache to coordinate invalidation through
+            return build()
+
+    entry = _local.get(site_id)
+    if entry and entry[0] == generation:
+        return entry[1]
+    index = build()
+    _local.set(site_id, (generation, index))
+    return index
+
+
+def invalidate_routing_index(site_id):
+    cache.set(_generation_key(site_id), uuid.uuid4().hex,
+              _generation_timeout())
@@ -1,6 +1,8 @@
 from rest_framework import serializers
 
 from builder.models import Build, BranchBuild, Environment, Owner, Site
+from core.exceptions import RateLimited
+from github.ratelimit import COSMETIC
 
 
 class OwnerSerializer(serializers.ModelSerializer):
@@ -57,13 +59,13 @@ class EnvironmentDetailSerializer(serializers.Serializer):
     def to_representation(self, instance):
         env_serializer = EnvironmentSerializer(instance)
         result = env_serializer.data
-        current_deploy = instance.get_current_deploy()
+        # Prefetch 'current_build__branchbuild' to render without queries
+        current_deploy = instance.current_build
         result['build'] = {}
         if current_deploy and hasattr(current_deploy, 'branchbuild'):
-            build = BranchBuild.objects.get(created=current_deploy.created)
-            serializer = BranchBuildSerializer(
-                build, context={'env': instance})
+            serializer = BranchBuildSerializer(current_deploy.branchbuild)
             result['build'] = serializer.data
+            result['build']['deployed'] = instance.current_deployed_at
         return result
 
 
@@ -75,7 +77,11 @@ class SiteSerializer(serializers.ModelSerializer):
         result = super(SiteSerializer, self).to_representation(instance)
         if self.context and self.context.get('user', None):
             user = self.context['user']
-            branch, git_hash = instance.get_newest_commit(user)
+            try:
+                branch, git_hash = instance.get_newest_commit(user, COSMETIC)
+            except RateLimited:
+                # Not worth the user's remaining Github budget
+                branch = ''
             result['default_branch'] = branch
         build = instance.get_most_recent_build()
         if build:
@@ -0,0 +1,131 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+
+from rest_framework.renderers import BaseRenderer
+
+from .events import broadcaster
+from .models import BuildEvent
+
+logger = logging.getLogger(__name__)
+
+# Streams currently open in this worker, see SSE_MAX_CONNECTIONS
+_slots = threading.BoundedSemaphore(settings.SSE_MAX_CONNECTIONS)
+
+
+class EventStreamRenderer(BaseRenderer):
+    """ Lets views answer `Accept: text/event-stream`. Streams are returned
+    as StreamingHttpResponses; only errors go through the renderer.
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data)
+
+
+def acquire_slot():
+    return _slots.acquire(blocking=False)
+
+
+class EventStream(object):
+    """ The server-sent events of a site's BuildEvents with an id greater
+    than `last_id`, as they are recorded. Sends a comment every
+    SSE_HEARTBEAT_SECONDS so proxies keep the connection open, and ends
+    after SSE_MAX_SECONDS; EventSource clients then reconnect with
+    Last-Event-ID.
+
+    Event ids are allocated before the event commits, so an event can turn up
+    after others with greater ids. Streams keep re-reading the events
+    recorded in the last SSE_REREAD_SECONDS and skip the ones they already
+    sent. A resumed stream can't know which of the events around `last_id`
+    the client saw and sends them again, so clients must ignore ids they
+    already have.
+
+    Holds one of the worker's stream slots (see acquire_slot) until closed.
+
+    :param resumed: Whether a client that may have missed events before
+                    `last_id` is reconnecting
+    """
+    def __init__(self, site_id, last_id, resumed=True):
+        self.site_id = site_id
+        self.last_id = last_id
+        self.resumed = resumed
+        self._closed = False
+        self._events = self.events()
+
+    def __iter__(self):
+        return self._events
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._events.close()
+            _slots.release()
+
+    def events(self):
+        waiter = broadcaster.subscribe(self.site_id)
+        try:
+            deadline = time.monotonic() + settings.SSE_MAX_SECONDS
+            yield 'retry: {0}\n\n'.format(settings.SSE_RETRY_MS)
+            cursor, sent = self._get_start()
+            while time.monotonic() < deadline:
+                waiter.clear()
+                events = BuildEvent.objects.filter(
+                    site_id=self.site_id, id__gt=cursor
+                ).exclude(id__in=list(sent)).order_by('id')
+                events = list(events[:settings.SSE_CHUNK_SIZE])
+                for event in events:
+                    sent[event.id] = event.created
+                    yield 'id: {0}\nevent: {1}\ndata: {2}\n\n'.format(
+                        event.id, event.kind, event.data)
+                cursor = self._forget_old(cursor, sent)
+                if len(events) == settings.SSE_CHUNK_SIZE:
+                    continue
+                # Don't hold a database connection while idle
+                if not connection.in_atomic_block:
+                    connection.close()
+                if not waiter.wait(settings.SSE_HEARTBEAT_SECONDS):
+                    yield ': heartbeat\n\n'
+        finally:
+            broadcaster.unsubscribe(self.site_id, waiter)
+
+    def _get_start(self):
+        """ The id to read events after, and the events already sent (or
+        not to send) in the re-read window below `last_id`, by id
+        """
+        events = BuildEvent.objects.filter(site_id=self.site_id)
+        created = events.filter(id=self.last_id)\
+                        .values_list('created', flat=True).first()
+        if created is None:
+            return self.last_id, OrderedDict()
+        floor = created - timedelta(seconds=settings.SSE_REREAD_SECONDS)
+        cursor = events.filter(id__lte=self.last_id, created__lt=floor)\
+                       .order_by('-id')\
+                       .values_list('id', flat=True).first() or 0
+        if self.resumed:
+            return cursor, OrderedDict()
+        # A new client only wants what comes next
+        seen = events.filter(id__gt=cursor, id__lte=self.last_id)\
+                     .order_by('id').values_list('id', 'created')
+        return cursor, OrderedDict(seen)
+
+    def _forget_old(self, cursor, sent):
+        """ Stops re-reading events recorded SSE_REREAD_SECONDS before the
+        newest one sent. Returns the id to read events after.
+        """
+        if not sent:
+            return cursor
+        floor = max(sent.values()) - \
+            timedelta(seconds=settings.SSE_REREAD_SECONDS)
+        for event_id, created in list(sent.items()):
+            if created < floor:
+                del sent[event_id]
+                cursor = max(cursor, event_id)
+        return cursor
@@ -0,0 +1,102 @@
+import logging
+import os
+from datetime import timedelta
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.utils import timezone
+
+from .models import BranchBuild, Build, DeployKey, Environment
+from core.helpers import generate_ssh_keys
+from core.jobs import RetryLater
+from core.metrics import DEPLOY_KEY_POOL_DEPTH
+
+logger = logging.getLogger(__name__)
+
+
+def deploy_build(build_id, environment_id):
+    """ Background job: sends a build to franklin-builder. A builder outage
+    raises ServiceUnavailable, which the job queue retries with backoff.
+
+    Only one build per environment is with the builder at a time. Until it
+    finishes this build waits in the queue, where a newer push can still
+    supersede it.
+    """
+    try:
+        build = BranchBuild.objects.select_related('site__owner')\
+                                   .get(id=build_id)
+        environment = Environment.objects.get(id=environment_id)
+    except (BranchBuild.DoesNotExist, Environment.DoesNotExist):
+        logger.warning('Build %s or environment %s no longer exists',
+                       build_id, environment_id)
+        return
+
+    if build.target_environment_id and build.status == Build.NEW:
+        # Builds that never reported back stop blocking after BUILD_TIMEOUT
+        cutoff = timezone.now() - timedelta(seconds=settings.BUILD_TIMEOUT)
+        if Build.objects.filter(
+                target_environment_id=build.target_environment_id,
+                status=Build.BUILDING, started__gte=cutoff).exists():
+            raise RetryLater(settings.BUILD_RETRY_DELAY)
+    build.deploy(environment)
+
+
+# Connections a key generating process inherited, kept so they are never
+# garbage collected there: closing one would end the parent's session
+_inherited_connections = []
+
+
+def _detach_connections():
+    """ Pool initializer: forked processes must never use or close the
+    database connections they inherit from the worker
+    """
+    for conn in connections.all():
+        if conn.connection is not None:
+            _inherited_connections.append(conn.connection)
+            conn.connection = None
+
+
+def _generate_key(_):
+    return generate_ssh_keys()
+
+
+def check_key_pool():
+    """ Sweep: records the deploy key pool depth and queues a refill once
+    it is below KEY_POOL_LOW_WATER. Claims don't count the pool, so site
+    creation doesn't pay for it.
+    """
+    depth = DeployKey.objects.count()
+    DEPLOY_KEY_POOL_DEPTH.set(depth)
+    if depth < settings.KEY_POOL_LOW_WATER:
+        DeployKey.request_refill()
+
+
+def fill_key_pool(target=None, processes=None):
+    """ Background job: tops the deploy key pool up to `target` keys,
+    generating them in parallel across all cores. Returns the number of keys
+    added.
+    """
+    target = target or settings.KEY_POOL_HIGH_WATER
+    missing = target - DeployKey.objects.count()
+    added = 0
+    if missing > 0:
+        with Pool(processes or os.cpu_count(),
+                  initializer=_detach_connections) as pool:
+            keys = []
+            for public_key, private_key in pool.imap(
+                    _generate_key, range(missing)):
+                keys.append(DeployKey(public_key=public_key,
+                                      private_key=private_key))
+                if len(keys) >= 10:
+                    DeployKey.objects.bulk_create(keys)
+                    added += len(keys)
+                    keys = []
+            DeployKey.objects.bulk_create(keys)
+            added += len(keys)
+    cache.delete('deploy-key-pool-refill')
+    depth = DeployKey.objects.count()
+    DEPLOY_KEY_POOL_DEPTH.set(depth)
+    logger.info('Added %d deploy keys, pool depth: %d', added, depth)
+    return added
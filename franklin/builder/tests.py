@@ -1,11 +1,33 @@
+import json
 import os
-from unittest import mock
+from datetime import timedelta
+from unittest import mock, skipUnless
 
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from .models import Build, BranchBuild, Deploy, Environment, Owner, Site
-from core.exceptions import ServiceUnavailable
+from requests.exceptions import ConnectTimeout, ReadTimeout
+
+from .cache import clear_local, deferred_invalidation, get_domain, \
+    set_domain
+from .events import broadcaster
+from .pool import BuilderPool
+from .routing import compile_tag_regex
+from .models import Build, BranchBuild, BuildEvent, Deploy, DeployKey, \
+    Environment, Owner, RouteChange, Site, compact_route_changes, \
+    prune_build_events
+from .streams import EventStream, acquire_slot
+from .tasks import check_key_pool, deploy_build
+from core.exceptions import ServiceUnavailable, ServiceUnreachable
+from core.jobs import RetryLater
+from core.management.commands.run_worker import Command
+from core.metrics import REGISTRY
+from core.models import Job
 from github.serializers import GithubWebhookSerializer
 
 
@@ -19,8 +41,9 @@ class OwnerTestCase(TestCase):
 
 
 class SiteTestCase(TestCase):
-    @mock.patch('core.helpers.requests.get')
+    @mock.patch('core.helpers.client.get')
     def setUp(self, mock_get):
+        cache.clear()
         # mocking the return object from POSTing to github API
         mock_get_response = mock.Mock(status_code=200)
         mock_get_response.json.return_value = {"default_branch": "master"}
@@ -85,8 +108,9 @@ class SiteTestCase(TestCase):
 
 
 class EnvironmentTestCase(TestCase):
-    @mock.patch('core.helpers.requests.get')
+    @mock.patch('core.helpers.client.get')
     def setUp(self, mock_get):
+        cache.clear()
         # mocking the return object from POSTing to github API
         mock_get_response = mock.Mock(status_code=200)
         mock_get_response.json.return_value = {"default_branch": "master"}
@@ -113,6 +137,22 @@ class EnvironmentTestCase(TestCase):
         Deploy.objects.create(build=self.branch_build, environment=self.env)
         self.assertTrue(self.env.past_builds.exists())
 
+    def test_current_build(self):
+        """ Each new deploy of a successful build becomes the current one
+        """
+        newer_build = BranchBuild.objects.create(
+            git_hash='qwer5678', branch=self.env.branch, site=self.site,
+            status=Build.SUCCESS)
+        self.branch_build.status = Build.SUCCESS
+        self.branch_build.save()
+        Deploy.objects.create(build=newer_build, environment=self.env)
+        # Rolling back to an older build
+        deploy = Deploy.objects.create(build=self.branch_build,
+                                       environment=self.env)
+        env = Environment.objects.get(id=self.env.id)
+        self.assertEqual(env.get_current_deploy(), self.branch_build.build_ptr)
+        self.assertEqual(env.current_deployed_at, deploy.deployed)
+
     def test_production_env_url(self):
         """ Production environments have a special url.
         """
@@ -132,8 +172,9 @@ class EnvironmentTestCase(TestCase):
 
 class BuildTestCase(TestCase):
 
-    @mock.patch('core.helpers.requests.get')
+    @mock.patch('core.helpers.client.get')
     def setUp(self, mock_get):
+        cache.clear()
         # mocking the return object from POSTing to github API
         mock_get_response = mock.Mock(status_code=200)
         mock_get_response.json.return_value = {"default_branch": "master"}
@@ -165,7 +206,7 @@ class BuildTestCase(TestCase):
         """
         self.assertEqual(self.branch_build.status, Build.NEW)
 
-    @mock.patch('core.helpers.requests.post')
+    @mock.patch('core.helpers.client.post')
     def test_building_env(self, mock_post):
         """ Tests the model method that calls franklin-builder when an
         environment is ready to be deployed for a branch.
@@ -174,14 +215,828 @@ class BuildTestCase(TestCase):
 
         self.branch_build.deploy(self.env)
         self.assertEqual(self.branch_build.status, Build.BUILDING)
+        build = Build.objects.get(id=self.branch_build.id)
+        self.assertEqual(build.builder_url,
+                         os.environ['BUILDER_URL'].rstrip('/'))
 
-    @mock.patch('core.helpers.requests.post')
+    @mock.patch('core.helpers.client.post')
     def test_building_env_negative(self, mock_post):
         """ Tests the model method that calls franklin-builder when builder
         returns an error.
         """
-        mock_post.return_value = mock.Mock(status_code=500)
+        mock_post.return_value = mock.Mock(status_code=503)
 
         with self.assertRaises(ServiceUnavailable):
             self.branch_build.deploy(self.env)
         self.assertEqual(self.branch_build.status, Build.NEW)
+
+    @mock.patch('core.helpers.client.post')
+    def test_building_env_server_error(self, mock_post):
+        """ A builder that failed while handling the build may have started
+        it, so the build stays with it
+        """
+        mock_post.return_value = mock.Mock(status_code=500)
+
+        self.assertTrue(self.branch_build.deploy(self.env))
+        self.assertEqual(Build.objects.get(id=self.branch_build.id).status,
+                         Build.BUILDING)
+
+    @mock.patch('core.helpers.client.post')
+    def test_building_env_timeout(self, mock_post):
+        """ A builder that didn't answer may be building already, so the
+        build stays with it rather than being sent again
+        """
+        mock_post.side_effect = ReadTimeout()
+
+        self.assertTrue(self.branch_build.deploy(self.env))
+        build = Build.objects.get(id=self.branch_build.id)
+        self.assertEqual(build.status, Build.BUILDING)
+        self.assertEqual(build.builder_url,
+                         os.environ['BUILDER_URL'].rstrip('/'))
+
+    @mock.patch('core.helpers.client.post')
+    def test_building_env_rejected(self, mock_post):
+        """ A build the builder refuses fails rather than being retried """
+        mock_post.return_value = mock.Mock(status_code=400)
+
+        self.assertFalse(self.branch_build.deploy(self.env))
+        self.assertEqual(Build.objects.get(id=self.branch_build.id).status,
+                         Build.FAILED)
+
+
+class BuilderPoolTestCase(TestCase):
+    def setUp(self):
+        self.pool = BuilderPool(['http://builder1', 'http://builder2'])
+
+    @mock.patch('core.helpers.client.post')
+    def test_failover(self, mock_post):
+        """ A node that can't take the build hands it to the next one """
+        mock_post.side_effect = lambda url, **kwargs: mock.Mock(
+            status_code=503 if url.startswith('http://builder1') else 200)
+        url, response = self.pool.post('/build', {}, {})
+        self.assertEqual(url, 'http://builder2')
+        self.assertEqual(self.pool.nodes[0].error_rate, 1.0)
+
+    @mock.patch('core.helpers.client.post')
+    def test_failover_on_connect_error(self, mock_post):
+        """ A build that never reached a node goes to the next one """
+        def post(url, **kwargs):
+            if url.startswith('http://builder1'):
+                raise ConnectTimeout()
+            return mock.Mock(status_code=200)
+        mock_post.side_effect = post
+        url, response = self.pool.post('/build', {}, {})
+        self.assertEqual(url, 'http://builder2')
+
+    @mock.patch('core.helpers.client.post')
+    def test_no_failover_on_read_timeout(self, mock_post):
+        """ A node that timed out may be building already, so the build
+        isn't sent to another one
+        """
+        mock_post.side_effect = ReadTimeout()
+        with self.assertRaises(ServiceUnavailable) as raised:
+            self.pool.post('/build', {}, {})
+        self.assertNotIsInstance(raised.exception, ServiceUnreachable)
+        self.assertIn(raised.exception.node_url,
+                      ('http://builder1', 'http://builder2'))
+        self.assertEqual(mock_post.call_count, 1)
+
+    @mock.patch('core.helpers.client.post')
+    def test_no_failover_on_server_error(self, mock_post):
+        """ A node that failed while handling the build may have started
+        it, so the build isn't sent to another one
+        """
+        mock_post.return_value = mock.Mock(status_code=500)
+        with self.assertRaises(ServiceUnavailable) as raised:
+            self.pool.post('/build', {}, {})
+        self.assertNotIsInstance(raised.exception, ServiceUnreachable)
+        self.assertEqual(mock_post.call_count, 1)
+
+    @mock.patch('core.helpers.client.get')
+    def test_check_health(self, mock_get):
+        """ Health reports what each node answers, without touching the
+        breakers
+        """
+        def get(url, **kwargs):
+            if url.startswith('http://builder1'):
+                raise ConnectTimeout()
+            response = mock.Mock(status_code=200)
+            response.json.return_value = {'status': 'good'}
+            return response
+        mock_get.side_effect = get
+        self.assertEqual(self.pool.check_health(1), {
+            'status': 'good',
+            'nodes': {'http://builder1': {'status': 'unreachable'},
+                      'http://builder2': {'status': 'good'}},
+        })
+        self.assertEqual(self.pool.nodes[0].error_rate, 0.0)
+
+    @mock.patch('core.client.requests.Session.request',
+                side_effect=ConnectTimeout)
+    def test_check_health_not_retried(self, mock_request):
+        """ Each node is probed once, so the check stays within its
+        timeout
+        """
+        self.pool.check_health(1)
+        self.assertEqual(mock_request.call_count, len(self.pool.nodes))
+
+    @mock.patch('core.helpers.client.post')
+    def test_all_down(self, mock_post):
+        mock_post.return_value = mock.Mock(status_code=503)
+        with self.assertRaises(ServiceUnreachable):
+            self.pool.post('/build', {}, {})
+
+    @override_settings(BUILDER_FAILURE_THRESHOLD=2, BUILDER_OPEN_SECONDS=60)
+    @mock.patch('core.helpers.client.post')
+    def test_breaker_opens(self, mock_post):
+        """ Nodes failing in a row are skipped without being called """
+        node = self.pool.nodes[0]
+        node.record_failure()
+        self.assertTrue(node.acquire())
+        node.record_failure()
+        self.assertEqual(node.state, node.OPEN)
+        self.assertFalse(node.acquire())
+
+        mock_post.return_value = mock.Mock(status_code=200)
+        for i in range(2):
+            url, response = self.pool.post('/build', {}, {})
+            self.assertEqual(url, 'http://builder2')
+        self.assertEqual(mock_post.call_count, 2)
+
+    @override_settings(BUILDER_FAILURE_THRESHOLD=1, BUILDER_OPEN_SECONDS=0)
+    @mock.patch('core.helpers.client.get')
+    def test_half_open_probe(self, mock_get):
+        """ Once open long enough, a health probe decides whether the node
+        gets calls again
+        """
+        node = self.pool.nodes[0]
+        node.record_failure()
+        mock_get.return_value = mock.Mock(status_code=503)
+        self.assertFalse(node.acquire())
+        self.assertEqual(node.state, node.OPEN)
+
+        mock_get.return_value = mock.Mock(status_code=200)
+        mock_get.return_value.json.return_value = {}
+        self.assertTrue(node.acquire())
+        self.assertEqual(node.state, node.CLOSED)
+
+
+class DomainCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_local()
+        self.owner = Owner.objects.create(
+            name='istrategylabs', github_id=607333)
+        self.site = Site.objects.create(
+            owner=self.owner, name='franklin-dashboard', github_id=45864453,
+            deploy_key='key')
+        self.env = Environment.objects.create(
+            site=self.site, name='Staging', url='staging.example.com')
+        self.build = BranchBuild.objects.create(
+            git_hash='asdf1234', branch='master', site=self.site,
+            status=Build.SUCCESS)
+        self.url = reverse('domain')
+
+    def test_invalidated_after_commit(self):
+        """ A lookup cached while a deploy's transaction is still open is
+        dropped once the transaction is over
+        """
+        with deferred_invalidation():
+            Deploy.objects.create(build=self.build, environment=self.env)
+            # A concurrent lookup reading the previous build
+            set_domain(self.env.url, {'path': 'old'})
+        self.assertIsNone(get_domain(self.env.url))
+
+    def test_cached_lookup(self):
+        """ Repeat lookups for a domain are served without touching the DB
+        """
+        Deploy.objects.create(build=self.build, environment=self.env)
+        response = self.client.get(self.url, {'domain': self.env.url})
+        self.assertEqual(response.data['path'], self.build.path)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {'domain': self.env.url})
+        self.assertEqual(response.data['path'], self.build.path)
+
+    def test_unknown_domain_cached(self):
+        """ Misses are cached too, and cleared once the domain exists
+        """
+        domain = 'new-site.example.com'
+        self.assertEqual(
+            self.client.get(self.url, {'domain': domain}).status_code, 404)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {'domain': domain})
+        self.assertEqual(response.status_code, 404)
+        Environment.objects.create(site=self.site, name='New', url=domain)
+        response = self.client.get(self.url, {'domain': domain})
+        self.assertEqual(response.status_code, 200)
+
+    def test_deploy_invalidates(self):
+        """ A new deploy to an environment is visible on the next lookup
+        """
+        self.client.get(self.url, {'domain': self.env.url})
+        Deploy.objects.create(build=self.build, environment=self.env)
+        response = self.client.get(self.url, {'domain': self.env.url})
+        self.assertEqual(response.data['path'], self.build.path)
+
+    @mock.patch('builder.cache.cache')
+    def test_local_cache_kept_briefly(self, mock_cache):
+        """ Without a shared cache, lookups are only kept as long as other
+        processes may serve them after a deploy
+        """
+        with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.'
+                           'LocMemCache'}}):
+            set_domain(self.env.url, {'path': 'old'})
+        mock_cache.set.assert_called_with(mock.ANY, {'path': 'old'}, 5)
+        with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.memcached.'
+                           'MemcachedCache'}}):
+            set_domain(self.env.url, {'path': 'old'})
+        mock_cache.set.assert_called_with(mock.ANY, {'path': 'old'}, 3600)
+
+
+class RoutingTableTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = Owner.objects.create(
+            name='istrategylabs', github_id=607333)
+        self.site = Site.objects.create(
+            owner=self.owner, name='franklin-dashboard', github_id=45864453,
+            deploy_key='key')
+        self.env = Environment.objects.create(
+            site=self.site, name='Staging', url='staging.example.com')
+        self.other_env = Environment.objects.create(
+            site=self.site, name='Production', url='example.com')
+        self.build = BranchBuild.objects.create(
+            git_hash='asdf1234', branch='master', site=self.site,
+            status=Build.SUCCESS)
+        self.url = reverse('domain_routes')
+
+    def get_routes(self, **params):
+        response = self.client.get(self.url, params)
+        return json.loads(b''.join(response.streaming_content).decode())
+
+    def test_snapshot(self):
+        """ The full table lists every domain with its current build path
+        """
+        Deploy.objects.create(build=self.build, environment=self.env)
+        result = self.get_routes()
+        self.assertTrue(result['full'])
+        self.assertEqual(result['version'], RouteChange.latest_version())
+        self.assertEqual(dict(result['routes']), {
+            self.env.url: self.build.path,
+            self.other_env.url: None,
+        })
+
+    def test_changes_since(self):
+        """ Routes changed after the given version are returned, after the
+        changes recorded just before it
+        """
+        version = self.get_routes()['version']
+        Deploy.objects.create(build=self.build, environment=self.env)
+        result = self.get_routes(since=version)
+        self.assertFalse(result['full'])
+        self.assertGreater(result['version'], version)
+        self.assertEqual(result['routes'][-1], [self.env.url, self.build.path])
+        # setUp's changes were recorded within ROUTES_REREAD_SECONDS
+        self.assertEqual(len(result['routes']),
+                         RouteChange.objects.count())
+
+    def test_late_commit_resent(self):
+        """ A change committed after a poll that already saw a newer id is
+        still listed on the next poll
+        """
+        late = RouteChange.objects.create(url=self.env.url,
+                                          path=self.build.path)
+        version = RouteChange.objects.create(url=self.other_env.url).id
+        result = self.get_routes(since=version)
+        self.assertFalse(result['full'])
+        self.assertEqual(result['routes'][-2:], [[late.url, late.path],
+                                                 [self.other_env.url, None]])
+
+    def test_old_changes_not_resent(self):
+        """ Only changes within ROUTES_REREAD_SECONDS of the version are
+        listed again
+        """
+        RouteChange.objects.update(
+            created=timezone.now() - timedelta(hours=1))
+        Deploy.objects.create(build=self.build, environment=self.env)
+        version = RouteChange.latest_version()
+        self.assertEqual(self.get_routes(since=version)['routes'],
+                         [[self.env.url, self.build.path]])
+
+    def test_compaction(self):
+        """ Old changes are deleted, and clients behind them get the full
+        table
+        """
+        Deploy.objects.create(build=self.build, environment=self.env)
+        version = RouteChange.latest_version()
+        Deploy.objects.create(build=self.build, environment=self.other_env)
+        RouteChange.objects.update(
+            created=timezone.now() - timedelta(days=30))
+        compact_route_changes()
+        self.assertEqual(list(RouteChange.objects.values_list('id',
+                                                              flat=True)),
+                         [RouteChange.latest_version()])
+        result = self.get_routes(since=version)
+        self.assertTrue(result['full'])
+        self.assertEqual(dict(result['routes']), {
+            self.env.url: self.build.path,
+            self.other_env.url: self.build.path,
+        })
+
+
+class DeployKeyTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = Owner.objects.create(
+            name='istrategylabs', github_id=607333)
+
+    @mock.patch('builder.models.generate_ssh_keys')
+    def test_site_claims_pooled_key(self, mock_generate):
+        """ New sites take a pre-generated key instead of generating one
+        """
+        DeployKey.objects.create(public_key='public', private_key='private')
+        site = Site.objects.create(
+            owner=self.owner, name='franklin-dashboard', github_id=45864453)
+        self.assertEqual(site.deploy_key, 'public')
+        self.assertEqual(site.deploy_key_secret, 'private')
+        self.assertFalse(DeployKey.objects.exists())
+        self.assertFalse(mock_generate.called)
+
+    @mock.patch('builder.models.generate_ssh_keys')
+    def test_empty_pool_fallback(self, mock_generate):
+        """ With an empty pool, keys are generated inline and a refill job
+        is queued
+        """
+        mock_generate.return_value = ('public', 'private')
+        site = Site.objects.create(
+            owner=self.owner, name='franklin-dashboard', github_id=45864453)
+        self.assertEqual(site.deploy_key, 'public')
+        self.assertTrue(Job.objects.filter(
+            task='builder.tasks.fill_key_pool').exists())
+
+    def test_metrics(self):
+        """ Claims are timed by outcome
+        """
+        claims = 'franklin_deploy_key_claim_latency_seconds_count'
+        before = {outcome: REGISTRY.get_sample_value(
+            claims, {'outcome': outcome}) or 0
+            for outcome in ('claimed', 'empty')}
+        DeployKey.objects.create(public_key='a', private_key='a')
+        DeployKey.objects.create(public_key='b', private_key='b')
+        DeployKey.claim()
+        DeployKey.claim()
+        DeployKey.claim()
+        self.assertEqual(REGISTRY.get_sample_value(
+            claims, {'outcome': 'claimed'}), before['claimed'] + 2)
+        self.assertEqual(REGISTRY.get_sample_value(
+            claims, {'outcome': 'empty'}), before['empty'] + 1)
+
+    def test_claim_does_not_count(self):
+        """ Claiming a key takes one query to list candidates and one to
+        delete the claimed key
+        """
+        DeployKey.objects.create(public_key='a', private_key='a')
+        with self.assertNumQueries(2):
+            self.assertEqual(DeployKey.claim(), ('a', 'a'))
+
+    def test_check_key_pool(self):
+        """ The sweep records the pool depth and refills a low pool once
+        """
+        DeployKey.objects.create(public_key='a', private_key='a')
+        check_key_pool()
+        check_key_pool()
+        self.assertEqual(REGISTRY.get_sample_value(
+            'franklin_deploy_key_pool_depth'), 1)
+        self.assertEqual(Job.objects.filter(
+            task='builder.tasks.fill_key_pool').count(), 1)
+
+
+class BuildCoalescingTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = Owner.objects.create(
+            name='istrategylabs', github_id=607333)
+        self.site = Site.objects.create(
+            owner=self.owner, name='franklin-dashboard', github_id=45864453,
+            deploy_key='key')
+        self.env = Environment.objects.create(
+            site=self.site, name='Staging', url='staging.example.com')
+
+    def test_newer_push_supersedes(self):
+        """ Only the newest queued build for an environment stays NEW
+        """
+        first = self.env.queue_build('a' * 40, 'master')
+        second = self.env.queue_build('b' * 40, 'master')
+        first.refresh_from_db()
+        self.assertEqual(first.status, Build.SUPERSEDED)
+        self.assertEqual(second.status, Build.NEW)
+        self.assertFalse(first.can_build())
+
+    @mock.patch('core.helpers.client.post')
+    def test_superseded_not_sent(self, mock_post):
+        """ A superseded build's queued job does not reach the builder
+        """
+        first = self.env.queue_build('a' * 40, 'master')
+        self.env.queue_build('b' * 40, 'master')
+        deploy_build(first.id, self.env.id)
+        self.assertFalse(mock_post.called)
+
+    @mock.patch('core.helpers.client.post')
+    def test_waits_for_building(self, mock_post):
+        """ A build waits while another build for its environment is with
+        the builder
+        """
+        mock_post.return_value = mock.Mock(status_code=200)
+        first = self.env.queue_build('a' * 40, 'master')
+        deploy_build(first.id, self.env.id)
+        second = self.env.queue_build('b' * 40, 'master')
+        with self.assertRaises(RetryLater):
+            deploy_build(second.id, self.env.id)
+        self.assertEqual(mock_post.call_count, 1)
+
+    # Sweeps and the refill job queued for the empty key pool would
+    # generate real keys
+    @override_settings(JOB_SWEEPS=())
+    @mock.patch('builder.tasks.fill_key_pool')
+    @mock.patch('signal.signal')
+    @mock.patch('core.management.commands.run_worker.close_old_connections')
+    @mock.patch('core.management.commands.run_worker.start_http_server')
+    @mock.patch('core.helpers.client.post')
+    def test_worker_metrics(self, mock_post, mock_serve, *mocks):
+        """ run_worker serves the metrics of the builds its jobs send
+        """
+        mock_post.return_value = mock.Mock(status_code=200)
+        sent = 'franklin_builder_dispatch_latency_seconds_count'
+        before = REGISTRY.get_sample_value(sent) or 0
+        self.env.queue_build('a' * 40, 'master')
+        worker = Command()
+        with mock.patch('time.sleep',
+                        side_effect=lambda poll: worker.stop(None, None)):
+            worker.handle(poll=0, metrics_port=9100)
+        mock_serve.assert_called_once_with(9100)
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(REGISTRY.get_sample_value(sent), before + 1)
+
+    @mock.patch('core.helpers.client.post')
+    def test_status_callback(self, mock_post):
+        """ Builder callbacks move BUILDING builds once; repeats are no-ops
+        and callbacks for builds that were never sent are rejected
+        """
+        mock_post.return_value = mock.Mock(status_code=200)
+        build = self.env.queue_build('a' * 40, 'master')
+        url = reverse('webhook:builder', args=[str(build.uuid)])
+        data = {'status': 'success', 'environment': 'staging'}
+
+        self.assertEqual(self.client.post(url, data).status_code, 422)
+        build.deploy(self.env)
+        self.assertEqual(self.client.post(url, data).status_code, 200)
+        self.assertEqual(self.client.post(url, data).status_code, 200)
+        build.refresh_from_db()
+        self.assertEqual(build.status, Build.SUCCESS)
+        self.assertEqual(Deploy.objects.filter(build=build).count(), 1)
+
+
+class BatchBuildStatusTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = Owner.objects.create(
+            name='istrategylabs', github_id=607333)
+        self.site = Site.objects.create(
+            owner=self.owner, name='franklin-dashboard', github_id=45864453,
+            deploy_key='key')
+        self.env = Environment.objects.create(
+            site=self.site, name='Staging', url='staging.example.com')
+        self.url = reverse('webhook:builder_batch')
+
+    def make_build(self, status):
+        return BranchBuild.objects.create(
+            git_hash='a' * 40, branch='master', site=self.site, status=status)
+
+    def post(self, entries):
+        return self.client.post(self.url, json.dumps(entries),
+                                content_type='application/json')
+
+    def test_batch(self):
+        """ Every entry gets its own result; successful builds are deployed
+        and the environment points at the last one
+        """
+        done = self.make_build(Build.BUILDING)
+        failed = self.make_build(Build.BUILDING)
+        retried = self.make_build(Build.SUCCESS)
+        idle = self.make_build(Build.NEW)
+        entries = [
+            {'uuid': str(done.uuid), 'environment': 'Staging',
+             'status': 'success'},
+            {'uuid': str(failed.uuid), 'environment': 'staging',
+             'status': 'failed'},
+            {'uuid': str(retried.uuid), 'environment': 'staging',
+             'status': 'success'},
+            {'uuid': str(idle.uuid), 'environment': 'staging',
+             'status': 'success'},
+            {'uuid': str(done.uuid), 'environment': 'production',
+             'status': 'success'},
+            {'uuid': 'nope', 'environment': 'staging', 'status': 'success'},
+            {'uuid': str(done.uuid), 'environment': 'staging',
+             'status': 'done'},
+        ]
+        response = self.post(entries)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.data],
+                         [200, 200, 200, 422, 404, 400, 400])
+        self.assertEqual(response.data[0]['uuid'], str(done.uuid))
+
+        statuses = dict(Build.objects.values_list('id', 'status'))
+        self.assertEqual(statuses[done.id], Build.SUCCESS)
+        self.assertEqual(statuses[failed.id], Build.FAILED)
+        self.assertEqual(statuses[idle.id], Build.NEW)
+        self.assertEqual(Deploy.objects.filter(build=done).count(), 1)
+        self.assertEqual(Deploy.objects.count(), 1)
+        self.env.refresh_from_db()
+        self.assertEqual(self.env.current_build_id, done.id)
+
+    def test_queries_per_batch(self):
+        """ The number of queries doesn't grow with the batch """
+        counts = []
+        for size in (2, 8):
+            entries = [{'uuid': str(self.make_build(Build.BUILDING).uuid),
+                        'environment': 'staging', 'status': 'success'}
+                       for i in range(size)]
+            with CaptureQueriesContext(connection) as queries:
+                self.post(entries)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_not_a_list(self):
+        response = self.post({'uuid': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+
+class BuildEventTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        # NOTIFY isn't delivered inside a test's transaction, and a LISTEN
+        # connection would keep the test database open
+        listener = mock.patch.object(broadcaster, '_ensure_listener')
+        listener.start()
+        self.addCleanup(listener.stop)
+        self.owner = Owner.objects.create(
+            name='istrategylabs', github_id=607333)
+        self.site = Site.objects.create(
+            owner=self.owner, name='franklin-dashboard', github_id=45864453,
+            deploy_key='key')
+        self.env = Environment.objects.create(
+            site=self.site, name='Staging', url='staging.example.com')
+        self.build = BranchBuild.objects.create(
+            git_hash='a' * 40, branch='master', site=self.site)
+
+    def test_published(self):
+        """ Status changes and deploys are recorded as events """
+        self.build.transition((Build.NEW, ), Build.SUCCESS)
+        Deploy.objects.create(build=self.build, environment=self.env)
+        events = list(BuildEvent.objects.filter(site=self.site)
+                                        .order_by('id'))
+        self.assertEqual([event.kind for event in events],
+                         [BuildEvent.STATUS, BuildEvent.DEPLOY])
+        self.assertEqual(json.loads(events[0].data),
+                         {'uuid': str(self.build.uuid), 'status': 'success'})
+        self.assertEqual(json.loads(events[1].data)['environment'],
+                         'Staging')
+
+    def test_pruned(self):
+        """ Events older than SSE_EVENT_RETENTION are deleted """
+        self.build.transition((Build.NEW, ), Build.BUILDING)
+        BuildEvent.objects.update(created=timezone.now() - timedelta(days=1))
+        self.build.transition((Build.BUILDING, ), Build.SUCCESS)
+        prune_build_events()
+        self.assertEqual(
+            list(BuildEvent.objects.values_list('data', flat=True)),
+            [json.dumps({'uuid': str(self.build.uuid),
+                         'status': 'success'})])
+
+    def test_stream_starts_after(self):
+        """ A new stream starts after the event id it is given """
+        self.build.transition((Build.NEW, ), Build.BUILDING)
+        self.build.transition((Build.BUILDING, ), Build.SUCCESS)
+        first, second = BuildEvent.objects.order_by('id')
+        self.assertTrue(acquire_slot())
+        stream = EventStream(self.site.id, first.id, resumed=False)
+        try:
+            lines = iter(stream)
+            self.assertTrue(next(lines).startswith('retry:'))
+            self.assertEqual(next(lines), (
+                'id: {0}\nevent: status\ndata: {1}\n\n'.format(
+                    second.id, second.data)))
+        finally:
+            stream.close()
+
+    def test_stream_resends_recent(self):
+        """ A resumed stream sends the events recorded just before its id
+        again, and each event only once
+        """
+        self.build.transition((Build.NEW, ), Build.BUILDING)
+        self.build.transition((Build.BUILDING, ), Build.SUCCESS)
+        first, second = BuildEvent.objects.order_by('id')
+        self.assertTrue(acquire_slot())
+        stream = EventStream(self.site.id, second.id)
+        try:
+            lines = iter(stream)
+            next(lines)
+            self.assertTrue(next(lines).startswith(
+                'id: {0}\n'.format(first.id)))
+            self.assertTrue(next(lines).startswith(
+                'id: {0}\n'.format(second.id)))
+            with override_settings(SSE_HEARTBEAT_SECONDS=0):
+                self.assertEqual(next(lines), ': heartbeat\n\n')
+        finally:
+            stream.close()
+
+    def test_stream_late_event(self):
+        """ An event that turns up below ids already sent is still sent
+        """
+        self.build.transition((Build.NEW, ), Build.BUILDING)
+        self.build.transition((Build.BUILDING, ), Build.SUCCESS)
+        late, second = BuildEvent.objects.order_by('id')
+        # Stands in for an event not yet committed when the stream starts
+        late_id = late.id
+        late.delete()
+        self.assertTrue(acquire_slot())
+        stream = EventStream(self.site.id, 0, resumed=False)
+        try:
+            lines = iter(stream)
+            next(lines)
+            self.assertTrue(next(lines).startswith(
+                'id: {0}\n'.format(second.id)))
+            late.id = late_id
+            late.save()
+            with override_settings(SSE_HEARTBEAT_SECONDS=0):
+                self.assertEqual(next(lines), ': heartbeat\n\n')
+            self.assertTrue(next(lines).startswith(
+                'id: {0}\n'.format(late_id)))
+        finally:
+            stream.close()
+
+    def test_view(self):
+        user = User.objects.create_user(username='testuser', password='a')
+        social = user.social_auth.create(provider='github', uid=123)
+        social.extra_data['access_token'] = 'abc123'
+        social.save()
+        self.build.transition((Build.NEW, ), Build.BUILDING)
+        event = BuildEvent.objects.get()
+
+        response = self.client.get(
+            reverse('project_events', args=[self.site.github_id]),
+            HTTP_AUTHORIZATION='Bearer abc123',
+            HTTP_ACCEPT='text/event-stream', HTTP_LAST_EVENT_ID='0')
+        try:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            lines = iter(response.streaming_content)
+            next(lines)
+            self.assertIn('id: {0}\n'.format(event.id).encode(),
+                          next(lines))
+        finally:
+            response.close()
+
+
+class RoutingIndexTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = Owner.objects.create(
+            name='istrategylabs', github_id=607333)
+        self.site = Site.objects.create(
+            owner=self.owner, name='franklin-dashboard', github_id=45864453,
+            deploy_key='key')
+        self.master = Environment.objects.create(
+            site=self.site, name='Staging', url='staging.example.com')
+        self.preview = Environment.objects.create(
+            site=self.site, name='Preview', url='preview.example.com')
+        self.release = Environment.objects.create(
+            site=self.site, name='Production', url='example.com',
+            deploy_type=Environment.TAG, tag_regex=r'^v\d+\.\d+$')
+
+    def test_exact_branch(self):
+        """ Branches match exactly, and every matching environment is
+        returned
+        """
+        self.assertEqual(
+            self.site.get_deployable_environments('refs/heads/master'),
+            [self.master, self.preview])
+        self.assertEqual(
+            self.site.get_deployable_environments('refs/heads/not-master'),
+            [])
+
+    def test_tag(self):
+        """ Tag events are matched against the precompiled patterns """
+        self.assertEqual(
+            self.site.get_deployable_environments('v1.2', True),
+            [self.release])
+        self.assertEqual(
+            self.site.get_deployable_environments('master', True), [])
+
+    def test_unsafe_patterns(self):
+        """ Patterns prone to catastrophic backtracking are never compiled
+        """
+        self.assertIsNone(compile_tag_regex(r'^(a+)+$'))
+        self.assertIsNone(compile_tag_regex(r'^(\w*\.)*$'))
+        self.assertIsNone(compile_tag_regex(r'^(v'))
+        self.assertIsNotNone(compile_tag_regex(r'^release-(\d+)?$'))
+
+    def test_cached_until_environment_changes(self):
+        """ The index is only rebuilt after an environment is saved """
+        self.site.get_routing_index()
+        with self.assertNumQueries(0):
+            self.site.get_routing_index()
+
+        self.preview.branch = 'develop'
+        self.preview.save()
+        self.assertEqual(
+            self.site.get_deployable_environments('refs/heads/develop'),
+            [self.preview])
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_local_cache_rebuilt(self):
+        """ Without a shared cache, changes saved by other workers are
+        picked up once the generation expires
+        """
+        with mock.patch('builder.routing.cache') as mock_cache:
+            mock_cache.get.return_value = None
+            self.site.get_routing_index()
+        mock_cache.add.assert_called_with(mock.ANY, mock.ANY, 5)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'query plans need Postgres')
+class QueryPlanTestCase(TestCase):
+    """ Hot queries must be served by the index meant for them. Sequential
+    scans are disabled so the planner only picks one when no index applies.
+    """
+    def setUp(self):
+        cache.clear()
+        self.owner = Owner.objects.create(
+            name='istrategylabs', github_id=607333)
+        self.site = Site.objects.create(
+            owner=self.owner, name='franklin-dashboard', github_id=45864453,
+            deploy_key='key')
+        self.env = Environment.objects.create(
+            site=self.site, name='Staging', url='staging.example.com')
+        self.build = BranchBuild.objects.create(
+            git_hash='asdf1234', branch='master', site=self.site,
+            status=Build.SUCCESS, target_environment=self.env)
+        Deploy.objects.create(build=self.build, environment=self.env)
+
+    def assertIndexed(self, queryset, index):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertNotIn('Seq Scan', plan, plan)
+        # "Index Scan using <index>", or "Bitmap Index Scan on <index>"
+        self.assertRegex(plan, r' (using|on) {0}\b'.format(index))
+
+    def index_name(self, model, *fields, suffix=''):
+        """ The name Django gave an index; index_together ones end in _idx
+        """
+        columns = [model._meta.get_field(field).column for field in fields]
+        return connection.schema_editor()._create_index_name(
+            model, columns, suffix=suffix)
+
+    def test_most_recent_build(self):
+        builds = BranchBuild.objects.filter(site=self.site)\
+                                    .order_by('-created', '-id')
+        self.assertIndexed(
+            builds[:1],
+            self.index_name(Build, 'site', 'created', 'id', suffix='_idx'))
+
+    def test_deploys(self):
+        self.assertIndexed(
+            Deploy.objects.filter(build=self.build, environment=self.env)[:1],
+            self.index_name(Deploy, 'build', 'environment', suffix='_idx'))
+        deploys = Deploy.objects.filter(environment=self.env)\
+                                .order_by('-deployed')
+        self.assertIndexed(
+            deploys[:1],
+            self.index_name(Deploy, 'environment', 'deployed',
+                            suffix='_idx'))
+
+    def test_environment_by_name(self):
+        self.assertIndexed(
+            Environment.objects.filter(lookup_name='staging', site=self.site),
+            self.index_name(Environment, 'site', 'lookup_name',
+                            suffix='_idx'))
+
+    def test_user_sites(self):
+        self.assertIndexed(Site.objects.filter(
+            owner__github_id__in=[607333], is_active=True),
+            'builder_site_owner_active')
+
+    def test_pending_builds(self):
+        self.assertIndexed(Build.objects.filter(
+            target_environment=self.env, status=Build.NEW),
+            'builder_build_pending')
+
+    def test_build_by_uuid(self):
+        self.assertIndexed(Build.objects.filter(uuid=self.build.uuid),
+                           self.index_name(Build, 'uuid'))
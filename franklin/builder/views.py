@@ -1,17 +1,27 @@
+import json
 import logging
+from datetime import timedelta
+from uuid import UUID
 
-from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, StreamingHttpResponse
 
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.exceptions import NotFound, ParseError
 from rest_framework.permissions import AllowAny
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.status import HTTP_200_OK
+from rest_framework.status import HTTP_200_OK, HTTP_400_BAD_REQUEST, \
+    HTTP_404_NOT_FOUND
 
-from .models import Build, BranchBuild, Deploy, Environment, Site
+from .cache import DOMAIN_NOT_FOUND, deferred_invalidation, get_domain, \
+    set_domain
+from .models import Build, BranchBuild, BuildEvent, Deploy, Environment, \
+    RouteChange, Site
 from .serializers import BuildSerializer
-from core.exceptions import BadRequest
+from core.exceptions import BadRequest, BadResource
+from core.metrics import record_transition
 
 logger = logging.getLogger(__name__)
 
@@ -25,12 +35,114 @@ def domain(request):
     if request.method == 'GET':
         domain = request.GET.get('domain')
         if domain:
-            environment = get_object_or_404(Environment, url=domain)
-            serializer = BuildSerializer(environment.get_current_deploy())
-            return Response(serializer.data, status=HTTP_200_OK)
+            payload = get_domain(domain)
+            if payload is None:
+                # Cache miss. Unknown domains are cached as well so repeated
+                # lookups for them don't reach the DB either.
+                environments = Environment.objects.select_related(
+                    'current_build__site')
+                environment = environments.filter(url=domain).first()
+                if environment:
+                    serializer = BuildSerializer(
+                        environment.get_current_deploy())
+                    payload = dict(serializer.data)
+                set_domain(domain, payload)
+            if payload is None or payload == DOMAIN_NOT_FOUND:
+                raise Http404
+            return Response(payload, status=HTTP_200_OK)
     raise BadRequest()
 
 
+@api_view(['GET'])
+@permission_classes((AllowAny, ))
+def routes(request):
+    """
+    Streams the full domain -> build path routing table, or with ?since= only
+    the routes that changed around and after that version. Changes are
+    listed oldest first, so applying them in order yields the current table.
+    A null path means the domain no longer routes anywhere. Clients whose
+    version was compacted away get the full table, flagged by "full".
+    """
+    if request.method == 'GET':
+        since = request.GET.get('since')
+        try:
+            since = int(since) if since is not None else None
+        except ValueError:
+            raise BadRequest(detail='since must be an integer version')
+        # Read the version before the table so nothing written while we
+        # stream can be missed by a client's next ?since= poll.
+        version = RouteChange.latest_version()
+        start = None if since is None else _get_reread_start(since)
+        if start is None:
+            entries = _iter_routes()
+        else:
+            entries = _iter_route_changes(start, version)
+        stream = _stream_routes(version, start is None, entries)
+        return StreamingHttpResponse(stream, content_type='application/json')
+    raise BadRequest()
+
+
+def _stream_routes(version, full, entries):
+    yield '{{"version": {0}, "full": {1}, "routes": ['.format(
+        version, json.dumps(full))
+    separator = ''
+    for url, path in entries:
+        yield separator + json.dumps([url, path])
+        separator = ', '
+    yield ']}'
+
+
+def _iter_routes():
+    last_id = 0
+    while True:
+        routes = Environment.objects.filter(id__gt=last_id)\
+                                    .order_by('id')\
+                                    .values_list(
+                                        'id', 'url', 'current_build__uuid',
+                                        'current_build__site__github_id')
+        chunk = list(routes[:settings.ROUTES_CHUNK_SIZE])
+        if not chunk:
+            return
+        last_id = chunk[-1][0]
+        for env_id, url, uuid, github_id in chunk:
+            # Same format as Build.path
+            path = '{0}/{1}'.format(github_id, uuid) if uuid else None
+            yield url, path
+
+
+def _get_reread_start(since):
+    """ The version to list changes from for a client at `since`, or None if
+    the client must start over from the full table.
+
+    Ids are allocated before the change commits, so a change with an id below
+    `since` may only have become visible after the client's poll. Changes
+    recorded up to ROUTES_REREAD_SECONDS before `since` are listed again;
+    replaying them in order still yields the current table.
+    """
+    created = RouteChange.objects.filter(id=since)\
+                                 .values_list('created', flat=True).first()
+    if created is None:
+        # Compacted away, or never handed out
+        return None
+    floor = created - timedelta(seconds=settings.ROUTES_REREAD_SECONDS)
+    return RouteChange.objects.filter(id__lte=since, created__lt=floor)\
+                              .order_by('-id')\
+                              .values_list('id', flat=True).first() or 0
+
+
+def _iter_route_changes(since, version):
+    while since < version:
+        changes = RouteChange.objects.filter(id__gt=since, id__lte=version)\
+                                     .order_by('id')\
+                                     .values_list('id', 'url', 'path')
+        chunk = list(changes[:settings.ROUTES_CHUNK_SIZE])
+        if not chunk:
+            return
+        since = chunk[-1][0]
+        for change_id, url, path in chunk:
+            yield url, path
+
+
 class UpdateBuildStatus(APIView):
     permission_classes = (AllowAny,)
 
@@ -41,8 +153,8 @@ class UpdateBuildStatus(APIView):
             if received_status not in ['success', 'failed']:
                 raise ParseError(detail="status must be 'success' or 'failed'")
             build = BranchBuild.objects.get(uuid=uuid)
-            environment = Environment.objects.get(name__iexact=received_env,
-                                                  site=build.site)
+            environment = Environment.objects.get(
+                lookup_name=received_env.lower(), site=build.site)
             return (environment, build)
         except (BranchBuild.DoesNotExist, Environment.DoesNotExist,
                 Site.DoesNotExist) as e:
@@ -51,8 +163,131 @@ class UpdateBuildStatus(APIView):
     def post(self, request, uuid, format=None):
         environment, build = self.get_object(request, uuid)
         received = request.data['status']
-        build.status = Build.SUCCESS if received == 'success' else Build.FAILED
-        build.save()
-        if build.status == Build.SUCCESS:
-            Deploy.objects.create(build=build, environment=environment)
+        status = Build.SUCCESS if received == 'success' else Build.FAILED
+        # A build is never left SUCCESS without its deploy
+        with deferred_invalidation(), transaction.atomic():
+            transitioned = build.transition((Build.BUILDING, ), status)
+            if transitioned and status == Build.SUCCESS:
+                Deploy.objects.create(build=build, environment=environment)
+        if not transitioned and build.status != status:
+            # Builder retries are fine; anything else is out of order
+            raise BadResource(detail='build is not being built')
         return Response(status=HTTP_200_OK)
+
+
+class UpdateBuildStatuses(APIView):
+    """
+    Batch variant of UpdateBuildStatus for the builder. Takes a list of
+    {uuid, environment, status} entries and answers with a list of
+    {uuid, status, detail} results in the same order, where status is the
+    HTTP status the entry would have had on its own.
+    """
+    permission_classes = (AllowAny,)
+    STATUSES = {'success': Build.SUCCESS, 'failed': Build.FAILED}
+
+    def post(self, request, format=None):
+        entries = request.data
+        if not isinstance(entries, list):
+            raise BadRequest(detail='expected a list of builds')
+        if len(entries) > settings.BUILDER_BATCH_MAX_SIZE:
+            raise BadRequest(detail='at most {0} builds per call'.format(
+                settings.BUILDER_BATCH_MAX_SIZE))
+
+        results = [self.parse(entry) for entry in entries]
+        pending = [result for result in results if 'status' not in result]
+        self.resolve(pending)
+        with deferred_invalidation(), transaction.atomic():
+            self.apply([result for result in pending
+                        if 'status' not in result])
+
+        return Response([{'uuid': result['uuid'], 'status': result['status'],
+                          'detail': result.get('detail', '')}
+                         for result in results], status=HTTP_200_OK)
+
+    def parse(self, entry):
+        if not isinstance(entry, dict):
+            return {'uuid': None, 'status': HTTP_400_BAD_REQUEST,
+                    'detail': 'expected an object'}
+        result = {'uuid': entry.get('uuid')}
+        try:
+            result['key'] = UUID(str(entry.get('uuid')))
+        except ValueError:
+            return dict(result, status=HTTP_400_BAD_REQUEST,
+                        detail='invalid uuid')
+        if entry.get('status') not in self.STATUSES:
+            return dict(result, status=HTTP_400_BAD_REQUEST,
+                        detail="status must be 'success' or 'failed'")
+        result['to_status'] = self.STATUSES[entry['status']]
+        result['environment'] = str(entry.get('environment', '')).lower()
+        return result
+
+    def resolve(self, results):
+        """ Finds every entry's build and environment in two queries """
+        builds = {build.uuid: build for build in BranchBuild.objects.filter(
+            uuid__in={result['key'] for result in results})}
+        environments = {
+            (environment.site_id, environment.lookup_name): environment
+            for environment in Environment.objects.filter(
+                site_id__in={build.site_id for build in builds.values()},
+                lookup_name__in={result['environment']
+                                 for result in results})}
+        for result in results:
+            build = builds.get(result['key'])
+            environment = build and environments.get(
+                (build.site_id, result['environment']))
+            if not build:
+                result.update(status=HTTP_404_NOT_FOUND,
+                              detail='build not found')
+            elif not environment:
+                result.update(status=HTTP_404_NOT_FOUND,
+                              detail='environment not found')
+            else:
+                result.update(build=build, environment=environment)
+
+    def apply(self, results):
+        """ Moves builds out of BUILDING and records the deploys of
+        successful ones, with one UPDATE per status and one INSERT.
+        """
+        ids = {result['build'].id for result in results}
+        # Locked so no single callback can change them under us
+        statuses = dict(Build.objects.select_for_update().filter(
+            id__in=ids).values_list('id', 'status'))
+
+        moved = {Build.SUCCESS: [], Build.FAILED: []}
+        deploys = []
+        events = []
+        for result in results:
+            build, to_status = result['build'], result['to_status']
+            if statuses[build.id] == Build.BUILDING:
+                statuses[build.id] = to_status
+                moved[to_status].append(build.id)
+                build.status = to_status
+                events.append(BuildEvent.for_status(build))
+                if to_status == Build.SUCCESS:
+                    deploys.append(Deploy(build=build,
+                                          environment=result['environment']))
+                result['status'] = HTTP_200_OK
+            elif statuses[build.id] == to_status:
+                # Builder retries are fine; anything else is out of order
+                result['status'] = HTTP_200_OK
+            else:
+                result.update(status=BadResource.status_code,
+                              detail='build is not being built')
+
+        for to_status, build_ids in moved.items():
+            if build_ids:
+                Build.objects.filter(id__in=build_ids).update(
+                    status=to_status)
+                record_transition(Build.BUILDING, to_status, len(build_ids))
+
+        # bulk_create skips Deploy.save, so point environments by hand; only
+        # the newest deploy per environment matters
+        Deploy.objects.bulk_create(deploys)
+        latest = {}
+        for deploy in deploys:
+            latest[deploy.environment_id] = deploy
+        for deploy in latest.values():
+            deploy.environment.set_current_build(deploy.build,
+                                                 deploy.deployed)
+        BuildEvent.publish(events + [BuildEvent.for_deploy(deploy)
+                                     for deploy in deploys])
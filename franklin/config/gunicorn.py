@@ -0,0 +1,44 @@
+"""gunicorn settings
+
+Workers record metrics to files under `prometheus_multiproc_dir` so that
+/metrics adds up every worker; see core.metrics.
+
+prometheus_client decides how to store values when it is first imported, so
+nothing here may import it before the directory is set.
+"""
+import glob
+import os
+import tempfile
+
+if not os.environ.get('prometheus_multiproc_dir'):
+    # Set before the workers fork and import prometheus_client
+    os.environ['prometheus_multiproc_dir'] = tempfile.mkdtemp(
+        prefix='franklin-metrics-')
+
+# Build event streams stay open for minutes. Threaded workers keep serving
+# other requests meanwhile, as a stream only holds one thread, and keep
+# telling the arbiter they are alive; a sync worker would be blocked and
+# then killed at `timeout`. Leave threads to spare beyond
+# SSE_MAX_CONNECTIONS.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+
+
+def on_starting(server):
+    # Values left by a previous run would be added to this one
+    for path in glob.glob(os.path.join(
+            os.environ['prometheus_multiproc_dir'], '*.db')):
+        os.remove(path)
+
+
+def worker_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    from builder.events import broadcaster
+
+    # Closes the build event listener's database connection
+    broadcaster.stop(timeout=5)
+
+    # Drops the exited worker's live gauges
+    multiprocess.mark_process_dead(worker.pid,
+                                   os.environ['prometheus_multiproc_dir'])
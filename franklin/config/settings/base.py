@@ -55,6 +55,8 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'core.middleware.MetricsMiddleware',
+    'core.middleware.InstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -138,6 +140,160 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, '../../staticfiles')
 
+# Caching
+# Point CACHE_BACKEND/CACHE_LOCATION at a shared cache (e.g. memcached) in
+# multi-process deployments so invalidations reach every worker. With the
+# default in-process cache, entries that other processes invalidate (e.g.
+# domain lookups after a deploy) are only kept for a few seconds.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+# Domain lookups (/v1/domains/). Times are in seconds.
+DOMAIN_CACHE_TIMEOUT = 60 * 60
+DOMAIN_CACHE_MISS_TIMEOUT = 30
+DOMAIN_CACHE_LOCAL_TIMEOUT = 5
+DOMAIN_CACHE_SIZE = 10000
+
+# Bearer token -> user lookups kept in the shared cache (seconds)
+AUTH_TOKEN_CACHE_TIMEOUT = 60
+
+# Rows read per query when streaming the routing table (/v1/domains/routes/)
+ROUTES_CHUNK_SIZE = 2000
+# Route changes are committed out of id order, so a ?since= poll also resends
+# changes recorded this many seconds before its version (at least the longest
+# transaction that changes routes). Changes are kept for ROUTES_RETENTION;
+# clients further behind get the full table.
+ROUTES_REREAD_SECONDS = 60
+ROUTES_RETENTION = 7 * 24 * 60 * 60
+
+# Outbound HTTP calls (Github, builder) made through core.client
+REST_CONNECT_TIMEOUT = 3.05
+REST_READ_TIMEOUT = 15
+REST_POOL_SIZE = 10
+REST_MAX_RETRIES = 2
+REST_RETRY_BACKOFF = 0.25
+
+# Seconds health probe results are served before being refreshed in the
+# background, and the deadline for each probe
+HEALTH_CHECK_INTERVAL = 10
+HEALTH_CHECK_TIMEOUT = 2
+
+# /metrics is only served to these addresses, or to scrapers sending
+# `Authorization: Bearer <METRICS_TOKEN>`
+METRICS_ALLOWED_IPS = os.environ.get('METRICS_ALLOWED_IPS',
+                                     '127.0.0.1').split(',')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Port each run_worker process serves its metrics on (0 = not served). Jobs
+# record builder dispatches and build transitions there, not in /metrics
+WORKER_METRICS_PORT = int(os.environ.get('WORKER_METRICS_PORT', 0))
+
+# Fraction of requests that get a Server-Timing header and a timing log line
+INSTRUMENTATION_SAMPLE_RATE = float(
+    os.environ.get('INSTRUMENTATION_SAMPLE_RATE', 0))
+
+# Queries in sampled requests slower than this (ms) are logged verbatim
+INSTRUMENTATION_SLOW_QUERY_MS = 100
+
+# Github API root; points at a local stand-in when benchmarking
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
+
+# Bytes of Github GET responses kept per worker for conditional
+# revalidation
+GITHUB_CACHE_BYTES = 16 * 1024 * 1024
+
+# Github calls of each priority are held back once a token has this few
+# requests left before its hourly reset, keeping them for higher priorities
+GITHUB_RATELIMIT_RESERVE = {'write': 0, 'read': 100, 'cosmetic': 1000}
+
+# Cached repo permission checks (seconds). Non-admin results expire sooner
+GITHUB_PERMISSIONS_TIMEOUT = 60
+GITHUB_PERMISSIONS_NEGATIVE_TIMEOUT = 10
+
+# Default and max items per page of paginated listings
+LIST_PAGE_SIZE = 100
+LIST_MAX_PAGE_SIZE = 500
+
+# Sites whose compiled environment routing is kept per worker, and seconds a
+# worker reuses one without a shared cache to hear of environment changes
+ROUTING_INDEX_CACHE_SIZE = 1000
+ROUTING_INDEX_LOCAL_TIMEOUT = 5
+
+# Seconds a build may stay with the builder before a newer build for the
+# same environment stops waiting on it
+BUILD_TIMEOUT = 30 * 60
+
+# Seconds a queued build waits before checking the environment again
+BUILD_RETRY_DELAY = 15
+
+# Build event streams: most open at once per worker, seconds between
+# heartbeats, seconds before a stream ends and the client reconnects, and
+# the reconnection delay (ms) suggested to clients
+SSE_MAX_CONNECTIONS = int(os.environ.get('SSE_MAX_CONNECTIONS', 8))
+SSE_HEARTBEAT_SECONDS = 15
+SSE_MAX_SECONDS = 5 * 60
+SSE_RETRY_MS = 2000
+SSE_CHUNK_SIZE = 100
+# Events committed out of id order are still sent if they were recorded
+# within this many seconds of the newest one sent
+SSE_REREAD_SECONDS = 60
+# Seconds build events are kept. Streams only read events newer than their
+# Last-Event-ID and re-read SSE_REREAD_SECONDS before it; the rest is margin
+# for clients reconnecting late
+SSE_EVENT_RETENTION = 60 * 60
+
+# Most builds the builder may report in one batched status callback
+BUILDER_BATCH_MAX_SIZE = 500
+
+# A builder node's circuit breaker opens after this many failed calls in a
+# row, or when more than this fraction of its recent calls failed
+BUILDER_FAILURE_THRESHOLD = 3
+BUILDER_MAX_ERROR_RATE = 0.5
+BUILDER_ERROR_WINDOW = 20
+
+# Seconds an open breaker stays open before the node is probed again, and
+# the timeout of that probe
+BUILDER_OPEN_SECONDS = 30
+BUILDER_PROBE_TIMEOUT = 2
+
+# Seconds before a user's cached org memberships are refreshed
+USER_ORGS_TIMEOUT = 15 * 60
+
+# Max concurrent requests when fetching the pages of a Github listing
+GITHUB_PAGE_WORKERS = 4
+
+# Background jobs (manage.py run_worker). Times are in seconds.
+JOB_MAX_ATTEMPTS = 8
+JOB_LEASE_SECONDS = 5 * 60
+JOB_RETRY_BACKOFF = 10
+JOB_MAX_RETRY_DELAY = 30 * 60
+JOB_POLL_INTERVAL = 1
+# Housekeeping functions each worker calls every JOB_SWEEP_INTERVAL
+JOB_SWEEPS = (
+    'builder.models.compact_route_changes',
+    'builder.models.prune_build_events',
+    'core.jobs.prune_jobs',
+    'builder.tasks.check_key_pool',
+)
+JOB_SWEEP_INTERVAL = 10 * 60
+# Finished jobs are deleted this long after they ran, a batch at a time
+JOB_RETENTION = 7 * 24 * 60 * 60
+JOB_PRUNE_BATCH_SIZE = 1000
+
+# Pre-generated deploy keys. The check_key_pool sweep queues a refill job
+# below the low water mark, as does a claim that finds the pool empty
+KEY_POOL_LOW_WATER = 20
+KEY_POOL_HIGH_WATER = 100
+
+# Builds deleted per transaction when tearing down a deleted site
+SITE_TEARDOWN_BATCH_SIZE = 500
+
 # REST API
 
 REST_FRAMEWORK = {
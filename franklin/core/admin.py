@@ -0,0 +1,11 @@
+from django.contrib import admin
+
+from .models import Job
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('task', 'status', 'attempts', 'run_at', 'updated')
+    list_filter = ('status', 'task')
+
+
+admin.site.register(Job, JobAdmin)
@@ -0,0 +1,112 @@
+import random
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from builder.models import BranchBuild, Build, Deploy, Environment, Owner, \
+    Site
+
+# Names of everything generated start with this, so it can be cleared
+PREFIX = 'bench-'
+
+# Github ids are offset to stay clear of real owners and repos
+GITHUB_ID_OFFSET = 900000000
+
+BASE_DOMAIN = 'bench.example.com'
+
+
+def skewed_counts(total, buckets, rng, skew=1.2):
+    """ Splits `total` across `buckets` following a Zipf-like distribution,
+    so a few buckets get most of the items (like a few busy repos).
+    """
+    weights = [1.0 / (rank + 1) ** skew for rank in range(buckets)]
+    rng.shuffle(weights)
+    scale = total / sum(weights)
+    counts = [int(weight * scale) for weight in weights]
+    for i in rng.sample(range(buckets), total - sum(counts)):
+        counts[i] += 1
+    return counts
+
+
+def clear():
+    with transaction.atomic():
+        sites = Site.objects.filter(name__startswith=PREFIX)
+        Environment.objects.filter(site__in=sites).update(current_build=None)
+        Deploy.objects.filter(build__site__in=sites).delete()
+        Build.objects.filter(site__in=sites).delete()
+        Environment.objects.filter(site__in=sites).delete()
+        sites.delete()
+        Owner.objects.filter(name__startswith=PREFIX).delete()
+        get_user_model().objects.filter(username__startswith=PREFIX).delete()
+
+
+def generate(owners, sites, builds, token, deploy_ratio=0.3, seed=None):
+    """ Creates `owners` owners sharing `sites` sites, each with a production
+    and a staging environment, and `builds` builds skewed towards a few
+    sites. A fraction of builds is deployed. Also creates a user who can
+    authenticate with `token` and owns the first owner's sites.
+    """
+    rng = random.Random(seed)
+    with transaction.atomic():
+        Owner.objects.bulk_create(
+            [Owner(name='{0}owner-{1}'.format(PREFIX, i),
+                   github_id=GITHUB_ID_OFFSET + i)
+             for i in range(owners)])
+        owner_objs = list(Owner.objects.filter(name__startswith=PREFIX)
+                                       .order_by('github_id'))
+
+        site_objs = []
+        for owner, count in zip(owner_objs,
+                                skewed_counts(sites, owners, rng)):
+            for i in range(count):
+                site_objs.append(Site(
+                    owner=owner, deploy_key='bench-key',
+                    deploy_key_secret='bench-secret',
+                    name='{0}site-{1}'.format(PREFIX, len(site_objs)),
+                    github_id=GITHUB_ID_OFFSET + len(site_objs)))
+        Site.objects.bulk_create(site_objs)
+        site_objs = list(Site.objects.filter(name__startswith=PREFIX)
+                                     .order_by('github_id'))
+
+        environments = []
+        for site in site_objs:
+            environments.append(Environment(
+                site=site, name='Production', lookup_name='production',
+                deploy_type=Environment.PROMOTE,
+                url='{0}.{1}'.format(site.name, BASE_DOMAIN)))
+            environments.append(Environment(
+                site=site, name='Staging', lookup_name='staging',
+                url='{0}-staging.{1}'.format(site.name, BASE_DOMAIN)))
+        Environment.objects.bulk_create(environments)
+        staging = dict(Environment.objects.filter(
+            site__in=site_objs, name='Staging').values_list('site_id', 'id'))
+
+        # Multi-table models can't be bulk created
+        deploys = []
+        for site, count in zip(site_objs,
+                               skewed_counts(builds, len(site_objs), rng)):
+            for i in range(count):
+                deployed = rng.random() < deploy_ratio
+                build = BranchBuild.objects.create(
+                    site=site, branch='master',
+                    git_hash='{0:040x}'.format(rng.getrandbits(160)),
+                    status=Build.SUCCESS if deployed else rng.choice(
+                        (Build.SUCCESS, Build.FAILED, Build.SUPERSEDED)))
+                if deployed:
+                    deploys.append(Deploy(build=build,
+                                          environment_id=staging[site.id]))
+        # bulk_create skips Deploy.save, so point environments by hand
+        Deploy.objects.bulk_create(deploys, batch_size=1000)
+        latest = {deploy.environment_id: deploy for deploy in deploys}
+        for environment_id, deploy in latest.items():
+            Environment.objects.filter(id=environment_id).update(
+                current_build=deploy.build,
+                current_deployed_at=deploy.deployed)
+
+        user = get_user_model().objects.create(username=PREFIX + 'user')
+        social = user.social_auth.create(provider='github',
+                                         uid=str(owner_objs[0].github_id))
+        # Saving indexes the token, see core.models.index_social_token
+        social.extra_data['access_token'] = token
+        social.save()
+    return owner_objs, site_objs
@@ -0,0 +1,152 @@
+import bisect
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+
+class Endpoint(object):
+    """ A request the runner repeats. `make_request` is called with a random
+    generator and returns (method, path, body, extra headers).
+    """
+    def __init__(self, name, make_request):
+        self.name = name
+        self.make_request = make_request
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of sorted `values` """
+    if not values:
+        return None
+    rank = max(0, int(round(pct / 100.0 * len(values))) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def webhook_request(site, secret):
+    body = json.dumps({
+        'ref': 'refs/heads/master',
+        'head_commit': {'id': '{0:040x}'.format(random.getrandbits(160))},
+        'repository': {
+            'id': site.github_id, 'name': site.name,
+            'full_name': '{0}/{1}'.format(site.owner.name, site.name),
+            'html_url': 'https://github.com/{0}/{1}'.format(site.owner.name,
+                                                            site.name),
+            'owner': {'id': site.owner.github_id, 'login': site.owner.name},
+        },
+    })
+    signature = 'sha1=' + hmac.new(secret.encode('ascii'), body.encode(),
+                                   hashlib.sha1).hexdigest()
+    return ('post', '/webhooks/github/', body,
+            {'HTTP_X_GITHUB_EVENT': 'push', 'HTTP_X_HUB_SIGNATURE': signature})
+
+
+def default_endpoints(sites):
+    """ The hot endpoints, hitting sites picked with the same skew as the
+    generated data: busy sites are requested more often.
+    """
+    cumulative = []
+    for rank in range(len(sites)):
+        cumulative.append((cumulative[-1] if cumulative else 0) +
+                          1.0 / (rank + 1))
+    secret = os.environ.get('GITHUB_SECRET', '')
+
+    def pick(rng):
+        index = bisect.bisect(cumulative, rng.random() * cumulative[-1])
+        return sites[min(index, len(sites) - 1)]
+
+    return [
+        Endpoint('domains', lambda rng: (
+            'get', '/v1/domains/?domain={0}-staging.bench.example.com'.format(
+                pick(rng).name), None, {})),
+        Endpoint('projects', lambda rng: ('get', '/v1/projects/', None, {})),
+        Endpoint('project_detail', lambda rng: (
+            'get', '/v1/projects/{0}'.format(pick(rng).github_id), None, {})),
+        Endpoint('project_builds', lambda rng: (
+            'get', '/v1/projects/{0}/builds'.format(pick(rng).github_id),
+            None, {})),
+        Endpoint('github_webhook', lambda rng: webhook_request(pick(rng),
+                                                               secret)),
+    ]
+
+
+class Runner(object):
+    """ Drives endpoints through the Django test client from a pool of
+    threads, recording latency, SQL queries and the calls made to the stub
+    upstreams for every request.
+
+    :param token: Bearer token of the benchmark user
+    :param stubs: StubServers whose hits count as outbound calls
+    """
+    def __init__(self, token, stubs, seed=None):
+        self.token = token
+        self.stubs = stubs
+        self.seed = seed
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = Client(
+                HTTP_AUTHORIZATION='Bearer {0}'.format(self.token))
+        return client
+
+    def _work(self, endpoint, count, seed):
+        rng = random.Random(seed)
+        samples = []
+        try:
+            for i in range(count):
+                method, path, body, headers = endpoint.make_request(rng)
+                send = getattr(self._client(), method)
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    if body is None:
+                        response = send(path, **headers)
+                    else:
+                        response = send(path, body,
+                                        content_type='application/json',
+                                        **headers)
+                    elapsed = time.perf_counter() - start
+                samples.append((elapsed, len(queries),
+                                response.status_code >= 400))
+        finally:
+            connection.close()
+        return samples
+
+    def run(self, endpoint, requests, concurrency):
+        outbound = sum(stub.hits for stub in self.stubs)
+        per_worker = [requests // concurrency + (1 if i < requests %
+                                                 concurrency else 0)
+                      for i in range(concurrency)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            batches = list(executor.map(
+                lambda args: self._work(endpoint, *args),
+                [(count, '{0}-{1}-{2}'.format(self.seed, endpoint.name, i)
+                  if self.seed is not None else None)
+                 for i, count in enumerate(per_worker)]))
+        wall = time.perf_counter() - start
+        outbound = sum(stub.hits for stub in self.stubs) - outbound
+
+        samples = [sample for batch in batches for sample in batch]
+        latencies = sorted(sample[0] * 1000 for sample in samples)
+        return {
+            'endpoint': endpoint.name,
+            'concurrency': concurrency,
+            'requests': len(samples),
+            'errors': sum(1 for sample in samples if sample[2]),
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'throughput_rps': len(samples) / wall if wall else None,
+            'queries_per_request': sum(sample[1] for sample in samples) /
+            len(samples),
+            'outbound_per_request': outbound / len(samples),
+        }
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from .data import PREFIX
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    stub = None
+
+    def do_GET(self):
+        self.stub.dispatch(self)
+
+    def do_POST(self):
+        self.stub.dispatch(self)
+
+    def do_DELETE(self):
+        self.stub.dispatch(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(object):
+    """ Local stand-in for an upstream HTTP service, served from a
+    background thread on a free port.
+
+    :param routes: (method, path regex, handler) tuples. Handlers are called
+                   with the regex match and return (status, payload)
+    :param latency: Mean seconds added to every response
+    :param error_rate: Fraction of requests answered with a 502
+    """
+    def __init__(self, routes, latency=0, error_rate=0, seed=None):
+        self.routes = [(method, re.compile(pattern + '$'), handler)
+                       for method, pattern, handler in routes]
+        self.latency = latency
+        self.error_rate = error_rate
+        self.hits = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://{0}:{1}'.format(host, port)
+
+    def start(self):
+        handler = type('Handler', (_Handler, ), {'stub': self})
+        self._server = _Server(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def dispatch(self, request):
+        with self._lock:
+            self.hits += 1
+            delay = self._rng.expovariate(1.0 / self.latency) \
+                if self.latency else 0
+            failed = self._rng.random() < self.error_rate
+        length = int(request.headers.get('Content-Length') or 0)
+        if length:
+            request.rfile.read(length)
+        time.sleep(delay)
+
+        path = request.path.split('?')[0]
+        status, payload = 404, {'message': 'Not Found'}
+        if failed:
+            status, payload = 502, {'message': 'Bad Gateway'}
+        else:
+            for method, pattern, handler in self.routes:
+                match = pattern.match(path)
+                if method == request.command and match:
+                    status, payload = handler(match)
+                    break
+        self.respond(request, status, payload)
+
+    def respond(self, request, status, payload):
+        body = json.dumps(payload).encode() if payload is not None else b''
+        etag = '"{0}"'.format(hashlib.md5(body).hexdigest())
+        if status == 200 and request.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(body)))
+        if request.command == 'GET' and status in (200, 304):
+            request.send_header('ETag', etag)
+            request.send_header('Cache-Control', 'private, max-age=60')
+        request.end_headers()
+        request.wfile.write(body)
+
+
+def github_stub(owners, sites, **kwargs):
+    """ Github API stand-in that knows about the generated owners and sites.
+    The benchmark user is an admin of every repo and a member of every org.
+    """
+    repos = {(site.owner.name, site.name): site for site in sites}
+
+    def repo_payload(site):
+        return {
+            'id': site.github_id,
+            'name': site.name,
+            'full_name': '{0}/{1}'.format(site.owner.name, site.name),
+            'html_url': 'https://github.com/{0}/{1}'.format(site.owner.name,
+                                                            site.name),
+            'default_branch': 'master',
+            'owner': {'id': site.owner.github_id, 'login': site.owner.name},
+            'permissions': {'admin': True, 'push': True, 'pull': True},
+        }
+
+    def orgs(match):
+        return 200, [{'id': owner.github_id, 'login': owner.name}
+                     for owner in owners[1:]]
+
+    def user_repos(match):
+        return 200, [repo_payload(site) for site in sites]
+
+    def repo(match):
+        site = repos.get((match.group('owner'), match.group('repo')))
+        return (200, repo_payload(site)) if site else (404, None)
+
+    def branch(match):
+        sha = hashlib.sha1(match.group('branch').encode()).hexdigest()
+        return 200, {'name': match.group('branch'), 'commit': {'sha': sha}}
+
+    def created(match):
+        return 201, {'id': 1}
+
+    def deleted(match):
+        return 204, None
+
+    repo_path = r'/repos/(?P<owner>[^/]+)/(?P<repo>[^/]+)'
+    return StubServer([
+        ('GET', r'/user', lambda match: (200, {'login': PREFIX + 'user'})),
+        ('GET', r'/user/orgs', orgs),
+        ('GET', r'/user/repos', user_repos),
+        ('GET', repo_path, repo),
+        ('GET', repo_path + r'/branches/(?P<branch>.+)', branch),
+        ('POST', repo_path + r'/(hooks|keys)', created),
+        ('DELETE', repo_path + r'/(hooks|keys)/\d+', deleted),
+    ], **kwargs)
+
+
+def builder_stub(**kwargs):
+    """ franklin-builder stand-in that accepts every build """
+    return StubServer([
+        ('POST', r'/build', lambda match: (200, {})),
+        ('GET', r'/health/?', lambda match: (200, {})),
+    ], **kwargs)
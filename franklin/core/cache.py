@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+# Cache backends that only live in the current process
+LOCAL_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def is_shared_cache(alias='default'):
+    """ Whether the cache is seen by every process (e.g. memcached), so
+    deleting a key there invalidates it for the web and worker processes
+    alike.
+    """
+    return settings.CACHES[alias]['BACKEND'] not in LOCAL_BACKENDS
+
+
+class LRUCache(object):
+    """ Small thread-safe, size-bounded in-process cache with per-entry
+    expiry. Used in front of shared (cross-process) caches or the DB for hot
+    lookups where even a network round trip is too slow.
+
+    :param max_size: Entries beyond this are evicted least-recently-used first
+    :param timeout: Default seconds an entry stays valid (None = no expiry)
+    :param sizeof: Size of a value, e.g. in bytes, with max_size then bounding
+                   the total. Each entry counts as 1 by default
+    """
+    _missing = object()
+
+    def __init__(self, max_size=1024, timeout=None, sizeof=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, self._missing)
+            if entry is self._missing:
+                return default
+            value, expires, size = entry
+            if expires is not None and expires < time.monotonic():
+                self._pop(key)
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=_missing):
+        if timeout is self._missing:
+            timeout = self.timeout
+        expires = time.monotonic() + timeout if timeout is not None else None
+        size = self.sizeof(value)
+        with self._lock:
+            self._pop(key)
+            if size > self.max_size:
+                return
+            self._data[key] = (value, expires, size)
+            self.size += size
+            while self.size > self.max_size:
+                self._pop(next(iter(self._data)))
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,154 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+logger = logging.getLogger(__name__)
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """ Transport adapter that records, per request, whether a pooled
+    connection was reused or a new one had to be opened.
+    """
+    def __init__(self, counters, *args, **kwargs):
+        self.counters = counters
+        super(CountingHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        pool = self.get_connection(request.url, kwargs.get('proxies'))
+        opened = pool.num_connections
+        try:
+            return super(CountingHTTPAdapter, self).send(request, **kwargs)
+        finally:
+            if pool.num_connections > opened:
+                self.counters.incr('opened')
+            else:
+                self.counters.incr('reused')
+
+
+class HostCounters(object):
+
+    def __init__(self):
+        self._counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def incr(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+class RestClient(object):
+    """ Per-process HTTP client for upstream services (Github, builder).
+
+    Keeps one pooled keep-alive session per upstream host, applies connect and
+    read timeouts to every call and retries idempotent calls that fail with a
+    connection error, a timeout or a 502/503/504, backing off with jitter.
+
+    :param connect_timeout: Seconds to wait for a connection
+    :param read_timeout: Seconds to wait between bytes of the response
+    :param pool_size: Max connections kept open per host
+    :param max_retries: Retries after the first attempt (idempotent only)
+    :param backoff: Base seconds for the exponential backoff between retries
+    """
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+    RETRY_STATUSES = (502, 503, 504)
+    MAX_BACKOFF = 5
+
+    def __init__(self, connect_timeout, read_timeout, pool_size, max_retries,
+                 backoff):
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._sessions = {}
+        self._counters = defaultdict(HostCounters)
+
+    def _session(self, host):
+        with self._lock:
+            # Pooled sockets must not be shared with a forked worker
+            if self._pid != os.getpid():
+                self._reset()
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                # Responses for one user must never leak cookies to the next
+                session.cookies.set_policy(
+                    DefaultCookiePolicy(allowed_domains=[]))
+                adapter = CountingHTTPAdapter(
+                    self._counters[host], pool_connections=1,
+                    pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+            return session
+
+    def _backoff(self, attempt):
+        return random.uniform(
+            0, min(self.MAX_BACKOFF, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, headers=None, data=None, timeout=None,
+                max_retries=None):
+        parsed = urlparse(url)
+        session = self._session('{0}://{1}'.format(parsed.scheme,
+                                                   parsed.netloc))
+        if max_retries is None:
+            max_retries = self.max_retries
+        retries = max_retries if method in self.IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            try:
+                response = session.request(method, url, headers=headers,
+                                           data=data,
+                                           timeout=timeout or self.timeout)
+            except (ConnectionError, Timeout) as e:
+                if attempt == retries:
+                    raise
+                logger.info('Retrying %s %s after %s', method, url, e)
+            else:
+                if (response.status_code not in self.RETRY_STATUSES or
+                        attempt == retries):
+                    return response
+                logger.info('Retrying %s %s after status %s', method, url,
+                            response.status_code)
+            time.sleep(self._backoff(attempt))
+
+    def get(self, url, headers=None, timeout=None, max_retries=None):
+        return self.request('GET', url, headers=headers, timeout=timeout,
+                            max_retries=max_retries)
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        return self.request('POST', url, headers=headers, data=data,
+                            timeout=timeout)
+
+    def delete(self, url, headers=None, timeout=None):
+        return self.request('DELETE', url, headers=headers, timeout=timeout)
+
+    def stats(self):
+        """ Connections reused vs opened, per upstream host """
+        with self._lock:
+            return {host: counters.as_dict()
+                    for host, counters in self._counters.items()}
+
+
+client = RestClient(connect_timeout=settings.REST_CONNECT_TIMEOUT,
+                    read_timeout=settings.REST_READ_TIMEOUT,
+                    pool_size=settings.REST_POOL_SIZE,
+                    max_retries=settings.REST_MAX_RETRIES,
+                    backoff=settings.REST_RETRY_BACKOFF)
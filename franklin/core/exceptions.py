@@ -1,7 +1,7 @@
 import logging
 
 from rest_framework import status
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, Throttled
 
 logger = logging.getLogger(__name__)
 
@@ -11,6 +11,15 @@ class ServiceUnavailable(APIException):
     default_detail = 'Service temporarily unavailable, try again later.'
 
 
+class ServiceUnreachable(ServiceUnavailable):
+    """ The call never reached the service, or was answered with a 502, 503
+    or 504, so it may be sent to another instance. Plain ServiceUnavailable
+    (e.g. a read timeout or a 500) leaves open whether the call went
+    through.
+    """
+    pass
+
+
 class ResourceExists(APIException):
     status_code = 422
     default_detail = 'Resource already exists'
@@ -24,3 +33,7 @@ class BadResource(APIException):
 class BadRequest(APIException):
     status_code = status.HTTP_400_BAD_REQUEST
     default_detail = 'Problem parsing JSON'
+
+
+class RateLimited(Throttled):
+    default_detail = 'Github rate limit exceeded, try again later.'
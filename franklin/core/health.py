@@ -0,0 +1,84 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class HealthChecker(object):
+    """ Probes upstream dependencies concurrently, each within
+    HEALTH_CHECK_TIMEOUT, and keeps the latest results in memory. Results
+    older than HEALTH_CHECK_INTERVAL are still served while a background
+    thread refreshes them; only the very first check is waited on.
+
+    :param probes: Map of name -> callable taking a timeout in seconds and
+                   returning that dependency's status as a dict
+    """
+    TIMED_OUT = {'status': 'timeout'}
+
+    def __init__(self, probes):
+        self.probes = probes
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._results = None
+        self._checked = 0
+        self._refreshing = False
+        # Spare workers so a probe stuck past its deadline can't hold up the
+        # next refresh
+        self._executor = ThreadPoolExecutor(max_workers=2 * len(self.probes))
+
+    def results(self):
+        with self._lock:
+            # Threads don't survive a fork into a worker
+            if self._pid != os.getpid():
+                self._reset()
+            results = self._results
+            stale = time.monotonic() - self._checked > \
+                settings.HEALTH_CHECK_INTERVAL
+            refresh = stale and not self._refreshing
+            if refresh:
+                self._refreshing = True
+        if results is None:
+            return self.refresh() if refresh else self._wait_for_first()
+        if refresh:
+            thread = threading.Thread(target=self.refresh)
+            thread.daemon = True
+            thread.start()
+        return results
+
+    def _wait_for_first(self):
+        deadline = time.monotonic() + settings.HEALTH_CHECK_TIMEOUT
+        while self._results is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self._results or {name: self.TIMED_OUT
+                                 for name in self.probes}
+
+    def refresh(self):
+        timeout = settings.HEALTH_CHECK_TIMEOUT
+        try:
+            futures = {name: self._executor.submit(probe, timeout)
+                       for name, probe in self.probes.items()}
+            wait(futures.values(), timeout=timeout)
+            results = {}
+            for name, future in futures.items():
+                if not future.done():
+                    logger.warning('Health probe %s timed out', name)
+                    results[name] = self.TIMED_OUT
+                elif future.exception():
+                    results[name] = {'status': 'unreachable'}
+                else:
+                    results[name] = future.result()
+            with self._lock:
+                self._results = results
+                self._checked = time.monotonic()
+            return results
+        finally:
+            with self._lock:
+                self._refreshing = False
@@ -2,59 +2,124 @@ import json
 import logging
 import requests
 import sys
+import time
 from functools import wraps
 from urllib.parse import urlparse
 
+from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.utils.decorators import available_attrs
 
 from Crypto.PublicKey import RSA
-from requests.exceptions import ConnectionError, HTTPError, Timeout
+from requests.exceptions import ConnectionError, ConnectTimeout, \
+    HTTPError, Timeout
+from requests.packages.urllib3.exceptions import NewConnectionError
 from rest_framework import HTTP_HEADER_ENCODING, status
 from rest_framework.authentication import BaseAuthentication,\
     get_authorization_header
 from rest_framework.exceptions import AuthenticationFailed
-from social.apps.django_app.default.models import UserSocialAuth
 from social.apps.django_app.views import NAMESPACE
 from social.apps.django_app.utils import load_backend, load_strategy
 
-from .exceptions import BadRequest, ServiceUnavailable
+from .client import client
+from .exceptions import BadRequest, RateLimited, ServiceUnavailable, \
+    ServiceUnreachable
+from .instrumentation import record_upstream
+from .metrics import is_github_url, record_response
+from .models import OAuthToken
 
 logger = logging.getLogger(__name__)
 
+# Answered by a proxy or an overloaded service before the call was handled
+UNREACHED_STATUSES = (status.HTTP_502_BAD_GATEWAY,
+                      status.HTTP_503_SERVICE_UNAVAILABLE,
+                      status.HTTP_504_GATEWAY_TIMEOUT)
 
-def make_rest_call(method, url, headers, data=None):
+
+def make_rest_call(method, url, headers, data=None, timeout=None,
+                   max_retries=None):
     response = None
+    unsent = False
     try:
-        if method == 'GET':
-            response = requests.get(url, headers=headers)
-        elif method == 'DELETE':
-            response = requests.delete(url, headers=headers)
-        elif method == 'POST':
-            response = requests.post(url, data=data, headers=headers)
+        with record_upstream(url):
+            if method == 'GET':
+                response = client.get(url, headers=headers, timeout=timeout,
+                                      max_retries=max_retries)
+            elif method == 'DELETE':
+                response = client.delete(url, headers=headers,
+                                         timeout=timeout)
+            elif method == 'POST':
+                response = client.post(url, data=data, headers=headers,
+                                       timeout=timeout)
     except (ConnectionError, HTTPError, Timeout) as e:
         logger.error('REST %s Connection exception : %s', method, e)
+        unsent = is_connect_error(e)
     except:
         logger.error('Unexpected REST %s error: %s', method, sys.exc_info()[0])
 
+    if response is not None:
+        record_response(url, response)
     if response is None or status.is_server_error(response.status_code):
         msg = '{0} {1}'.format('Service temporarily unavailable:',
                                urlparse(url).netloc)
+        # Any other server error may come from a service that already
+        # started acting on the call
+        if unsent or (response is not None and
+                      response.status_code in UNREACHED_STATUSES):
+            raise ServiceUnreachable(detail=msg)
         raise ServiceUnavailable(detail=msg)
+    elif is_github_url(url) and is_rate_limited(response):
+        raise RateLimited(wait=get_retry_after(response))
     elif status.is_client_error(response.status_code):
         raise BadRequest()
-    elif status.is_redirect(response.status_code):
+    elif (status.is_redirect(response.status_code) and
+            response.status_code != status.HTTP_304_NOT_MODIFIED):
         logger.warn('Redirect %s for %s', response.status_code, url)
 
     return response
 
 
+def is_connect_error(error):
+    """ Whether a request failed before it could reach the server """
+    if isinstance(error, ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def is_rate_limited(response):
+    """ Github answers 403 once a token's quota is used up, or when its
+    abuse limits kick in, and 429 for some secondary limits. Only meaningful
+    for Github responses.
+    """
+    if response.status_code == status.HTTP_429_TOO_MANY_REQUESTS:
+        return True
+    return (response.status_code == status.HTTP_403_FORBIDDEN and
+            (response.headers.get('X-RateLimit-Remaining') == '0' or
+             response.headers.get('Retry-After') is not None))
+
+
+def get_retry_after(response):
+    """ Seconds to wait before retrying a rate limited request """
+    try:
+        return int(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        pass
+    try:
+        reset = int(response.headers['X-RateLimit-Reset'])
+    except (KeyError, ValueError):
+        return None
+    return max(int(reset - time.time()), 1)
+
+
 def make_rest_delete_call(url, headers):
     return make_rest_call('DELETE', url, headers)
 
 
-def make_rest_get_call(url, headers):
-    return make_rest_call('GET', url, headers)
+def make_rest_get_call(url, headers, timeout=None, max_retries=None):
+    return make_rest_call('GET', url, headers, timeout=timeout,
+                          max_retries=max_retries)
 
 
 def make_rest_post_call(url, headers, body):
@@ -82,14 +147,21 @@ class SocialAuthentication(BaseAuthentication):
             raise AuthenticationFailed('Credentials are malformed')
         oauth_token = auth[1]
 
-        social_user = UserSocialAuth.objects\
-                                    .filter(extra_data__contains=oauth_token)\
-                                    .first()
-        if not social_user:
-            # User does not exist in our DB, attempt social auth
-            user = do_auth(oauth_token)
-        else:
-            user = social_user.user
+        digest = OAuthToken.digest_for(oauth_token)
+        # The cached user is dropped when the token is replaced, the user is
+        # saved or deleted, or their social auth record is deleted; see
+        # core.models
+        key = OAuthToken.user_cache_key(digest)
+        user = cache.get(key)
+        if user is None:
+            token = OAuthToken.objects.select_related('social__user')\
+                                      .filter(digest=digest).first()
+            if not token:
+                # User does not exist in our DB, attempt social auth
+                user = do_auth(oauth_token)
+            else:
+                user = token.social.user
+            cache.set(key, user, settings.AUTH_TOKEN_CACHE_TIMEOUT)
         return user, oauth_token
 
 
@@ -107,6 +179,7 @@ def do_auth(oauth_token):
         raise AuthenticationFailed('Bad credentials')
     social = user.social_auth.get(provider='github')
     social.extra_data['access_token'] = oauth_token
+    # Saving also (re)indexes the token, see core.models.index_social_token
     social.save()
     return user
 
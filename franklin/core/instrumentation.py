@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+_local = threading.local()
+
+
+class UpstreamTimings(object):
+    """ Count and total seconds of outbound calls, per upstream host. Calls
+    may be added from several threads, see recording().
+    """
+
+    def __init__(self):
+        self.calls = defaultdict(lambda: [0, 0.0])
+        self._lock = threading.Lock()
+
+    def add(self, host, elapsed):
+        with self._lock:
+            entry = self.calls[host]
+            entry[0] += 1
+            entry[1] += elapsed
+
+
+def start_recording():
+    _local.upstream = UpstreamTimings()
+    return _local.upstream
+
+
+def stop_recording():
+    _local.upstream = None
+
+
+def current_recording():
+    """ The UpstreamTimings of the request served by this thread, if any """
+    return getattr(_local, 'upstream', None)
+
+
+@contextmanager
+def recording(timings):
+    """ Adds the outbound calls made by this thread in the block to
+    `timings`, e.g. to time a request's calls made from a thread pool
+    """
+    previous = current_recording()
+    _local.upstream = timings
+    try:
+        yield
+    finally:
+        _local.upstream = previous
+
+
+@contextmanager
+def record_upstream(url):
+    """ Times an outbound call if the current request is being sampled;
+    otherwise does nothing.
+    """
+    timings = current_recording()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(urlparse(url).netloc, time.perf_counter() - start)
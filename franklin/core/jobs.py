@@ -0,0 +1,133 @@
+import json
+import logging
+import random
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .exceptions import RateLimited
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+
+class RetryLater(Exception):
+    """ Raised by a task that cannot run yet. The job is put back in the
+    queue without counting the attempt against it.
+    """
+    def __init__(self, delay):
+        super(RetryLater, self).__init__(delay)
+        self.delay = delay
+
+
+def enqueue(task, **kwargs):
+    """ Queues `task` (a function or its dotted path) to be called with
+    kwargs by a worker. kwargs must be JSON serializable.
+    """
+    if callable(task):
+        task = '{0}.{1}'.format(task.__module__, task.__name__)
+    return Job.objects.create(task=task, payload=json.dumps(kwargs),
+                              max_attempts=settings.JOB_MAX_ATTEMPTS,
+                              run_at=timezone.now())
+
+
+def claim_job(worker):
+    """ Leases the next runnable job to `worker`. Jobs whose lease expired
+    (e.g. the worker died) are runnable again. The claim is a conditional
+    UPDATE, so two workers can never both take the same job.
+    """
+    now = timezone.now()
+    candidates = Job.objects.filter(
+        Q(status=Job.QUEUED, run_at__lte=now) |
+        Q(status=Job.RUNNING, lease_expires__lt=now)
+    ).order_by('run_at').values_list('id', 'status', 'lease_expires')[:10]
+
+    lease_expires = now + timedelta(seconds=settings.JOB_LEASE_SECONDS)
+    for job_id, status, expires in candidates:
+        claimed = Job.objects.filter(
+            id=job_id, status=status, lease_expires=expires
+        ).update(status=Job.RUNNING, worker=worker, attempts=F('attempts') + 1,
+                 lease_expires=lease_expires, updated=now)
+        if claimed:
+            return Job.objects.get(id=job_id)
+    return None
+
+
+def get_retry_delay(attempts):
+    base = settings.JOB_RETRY_BACKOFF * 2 ** (attempts - 1)
+    return min(base, settings.JOB_MAX_RETRY_DELAY) * random.uniform(0.5, 1.5)
+
+
+def call_task(job):
+    """ Calls the job's task. Hitting Github's rate limit is not the job's
+    fault, so it waits for the limit to reset like RetryLater.
+    """
+    try:
+        import_string(job.task)(**json.loads(job.payload))
+    except RateLimited as e:
+        raise RetryLater(e.wait or settings.JOB_RETRY_BACKOFF)
+
+
+def run_job(job):
+    """ Runs a claimed job and records the outcome. Failed jobs are retried
+    with backoff until max_attempts, after which they are marked DEAD.
+    """
+    # Only touch the job while we still hold its lease
+    owned = Job.objects.filter(id=job.id, status=Job.RUNNING,
+                               worker=job.worker)
+    now = timezone.now()
+    if job.attempts > job.max_attempts:
+        # Lease expired mid-run too many times
+        owned.update(status=Job.DEAD, lease_expires=None, updated=now)
+        logger.error('Job %s %s exceeded its attempts', job.id, job.task)
+        return
+
+    try:
+        call_task(job)
+    except RetryLater as e:
+        owned.update(status=Job.QUEUED, lease_expires=None, worker='',
+                     attempts=F('attempts') - 1, updated=timezone.now(),
+                     run_at=timezone.now() + timedelta(seconds=e.delay))
+    except Exception:
+        error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            logger.error('Job %s %s is dead: %s', job.id, job.task, error)
+            owned.update(status=Job.DEAD, lease_expires=None,
+                         last_error=error, updated=timezone.now())
+        else:
+            logger.warning('Job %s %s failed, will retry: %s', job.id,
+                           job.task, error)
+            delay = get_retry_delay(job.attempts)
+            owned.update(status=Job.QUEUED, lease_expires=None, worker='',
+                         last_error=error, updated=timezone.now(),
+                         run_at=timezone.now() + timedelta(seconds=delay))
+    else:
+        owned.update(status=Job.DONE, lease_expires=None,
+                     updated=timezone.now())
+
+
+def prune_jobs():
+    """ Deletes DONE jobs older than JOB_RETENTION. DEAD jobs are kept for
+    inspection.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.JOB_RETENTION)
+    while True:
+        done = Job.objects.filter(status=Job.DONE, updated__lt=cutoff)\
+                          .values_list('id', flat=True)
+        ids = list(done[:settings.JOB_PRUNE_BATCH_SIZE])
+        if not ids:
+            return
+        Job.objects.filter(id__in=ids).delete()
+
+
+def run_sweeps():
+    """ Calls the housekeeping functions listed in JOB_SWEEPS """
+    for path in settings.JOB_SWEEPS:
+        try:
+            import_string(path)()
+        except Exception:
+            logger.exception('Sweep %s failed', path)
@@ -0,0 +1,71 @@
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from social.apps.django_app.default.models import UserSocialAuth
+
+from core.models import OAuthToken
+
+
+class Command(BaseCommand):
+    help = ('Compares bearer token lookup time of the OAuthToken index with '
+            'the old extra_data scan. Seeded users are rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, nargs='+',
+                            default=[10000, 100000])
+        parser.add_argument('--lookups', type=int, default=100)
+
+    def handle(self, *args, **options):
+        for count in options['users']:
+            with transaction.atomic():
+                tokens = self.seed(count)
+                sample = random.sample(tokens, min(options['lookups'], count))
+                old = self.time_lookups(sample, self.scan_lookup)
+                new = self.time_lookups(sample, self.index_lookup)
+                transaction.set_rollback(True)
+            self.stdout.write(
+                '{0} users: extra_data scan {1:.3f}ms/lookup, '
+                'token index {2:.3f}ms/lookup'.format(count, old, new))
+
+    def seed(self, count):
+        User = get_user_model()
+        prefix = 'bench-{0}-'.format(int(time.time()))
+        User.objects.bulk_create(
+            [User(username=prefix + str(i)) for i in range(count)],
+            batch_size=1000)
+        users = User.objects.filter(username__startswith=prefix)
+        tokens = ['{0:040x}'.format(random.getrandbits(160))
+                  for i in range(count)]
+        UserSocialAuth.objects.bulk_create(
+            [UserSocialAuth(user=user, provider='github', uid=user.username,
+                            extra_data={'access_token': token})
+             for user, token in zip(users, tokens)],
+            batch_size=1000)
+        # bulk_create skips the post_save signal that normally indexes tokens
+        OAuthToken.objects.bulk_create(
+            [OAuthToken(social=social,
+                        digest=OAuthToken.digest_for(
+                            social.extra_data['access_token']))
+             for social in UserSocialAuth.objects.filter(
+                 uid__startswith=prefix)],
+            batch_size=1000)
+        return tokens
+
+    def time_lookups(self, tokens, lookup):
+        start = time.perf_counter()
+        for token in tokens:
+            lookup(token)
+        return (time.perf_counter() - start) * 1000 / len(tokens)
+
+    def scan_lookup(self, token):
+        return UserSocialAuth.objects.filter(extra_data__contains=token)\
+                                     .select_related('user').first()
+
+    def index_lookup(self, token):
+        return OAuthToken.objects.select_related('social__user')\
+                                 .filter(digest=OAuthToken.digest_for(token))\
+                                 .first()
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmark import data
+
+
+class Command(BaseCommand):
+    help = ('Generates a synthetic dataset for run_benchmarks: owners, sites, '
+            'environments, builds and deploys, skewed so a few sites hold '
+            'most builds. Replaces any previously generated data.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--owners', type=int, default=20)
+        parser.add_argument('--sites', type=int, default=500)
+        parser.add_argument('--builds', type=int, default=20000)
+        parser.add_argument('--deploy-ratio', type=float, default=0.3,
+                            help='Fraction of builds that were deployed')
+        parser.add_argument('--token', default='bench-token',
+                            help='Bearer token of the generated user')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--clear', action='store_true',
+                            help='Only remove previously generated data')
+
+    def handle(self, *args, **options):
+        data.clear()
+        if options['clear']:
+            self.stdout.write('Removed generated data')
+            return
+        if options['owners'] < 1 or options['sites'] < 1:
+            raise CommandError('Need at least one owner and one site')
+        owners, sites = data.generate(
+            options['owners'], options['sites'], options['builds'],
+            options['token'], deploy_ratio=options['deploy_ratio'],
+            seed=options['seed'])
+        self.stdout.write('Generated {0} owners, {1} sites, {2} builds'.format(
+            len(owners), len(sites), options['builds']))
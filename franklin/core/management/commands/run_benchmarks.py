@@ -0,0 +1,102 @@
+import json
+import os
+import subprocess
+import time
+from unittest import mock
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from builder.cache import clear_local
+from builder.models import Owner, Site
+from core.benchmark.data import PREFIX
+from core.benchmark.runner import Runner, default_endpoints
+from core.benchmark.stubs import builder_stub, github_stub
+from github.api import response_cache
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the hot API endpoints against the data from '
+            'generate_bench_data, with local stand-ins for Github and '
+            'franklin-builder. Reports latency percentiles, throughput, SQL '
+            'queries and outbound calls per endpoint as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Requests per endpoint and concurrency')
+        parser.add_argument('--concurrency', type=int, nargs='+',
+                            default=[1, 8])
+        parser.add_argument('--endpoints', nargs='+',
+                            help='Only run these endpoints')
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help='Mean seconds the stand-ins take to answer')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Fraction of stand-in responses that 502')
+        parser.add_argument('--token', default='bench-token')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--output', help='Write the results JSON here')
+
+    def handle(self, *args, **options):
+        owners = list(Owner.objects.filter(name__startswith=PREFIX)
+                                   .order_by('github_id'))
+        sites = list(Site.objects.filter(name__startswith=PREFIX)
+                                 .select_related('owner')
+                                 .order_by('github_id'))
+        if not sites:
+            raise CommandError('No benchmark data, run generate_bench_data')
+
+        stub_options = {'latency': options['latency'],
+                        'error_rate': options['error_rate'],
+                        'seed': options['seed']}
+        github = github_stub(owners, sites, **stub_options).start()
+        builder = builder_stub(**stub_options).start()
+        endpoints = default_endpoints(sites)
+        if options['endpoints']:
+            endpoints = [endpoint for endpoint in endpoints
+                         if endpoint.name in options['endpoints']]
+
+        runner = Runner(options['token'], [github, builder],
+                        seed=options['seed'])
+        results = []
+        try:
+            with override_settings(ALLOWED_HOSTS=['*'], DEBUG=False,
+                                   GITHUB_API_URL=github.url), \
+                    mock.patch.dict(os.environ, {'BUILDER_URL': builder.url}):
+                for endpoint in endpoints:
+                    for concurrency in options['concurrency']:
+                        # Every run starts with cold per-worker caches
+                        response_cache.clear()
+                        clear_local()
+                        result = runner.run(endpoint, options['requests'],
+                                            concurrency)
+                        results.append(result)
+                        self.stderr.write(
+                            '{endpoint} x{concurrency}: p50 {p50_ms:.1f}ms '
+                            'p99 {p99_ms:.1f}ms, {throughput_rps:.1f} req/s, '
+                            '{queries_per_request:.1f} queries, '
+                            '{outbound_per_request:.2f} outbound'.format(
+                                **result))
+        finally:
+            github.stop()
+            builder.stop()
+
+        report = json.dumps({
+            'commit': self.get_commit(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'options': {name: options[name] for name in (
+                'requests', 'concurrency', 'latency', 'error_rate', 'seed')},
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report)
+        else:
+            self.stdout.write(report)
+
+    def get_commit(self):
+        try:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'],
+                stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
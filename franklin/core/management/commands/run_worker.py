@@ -0,0 +1,52 @@
+import os
+import signal
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from prometheus_client import start_http_server
+
+from core.jobs import claim_job, run_job, run_sweeps
+
+
+class Command(BaseCommand):
+    help = ('Runs queued background jobs. Start as many worker processes as '
+            'needed; each job is only ever leased to one of them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll', type=float,
+                            default=settings.JOB_POLL_INTERVAL,
+                            help='Seconds to wait when the queue is empty')
+        parser.add_argument('--metrics-port', type=int,
+                            default=settings.WORKER_METRICS_PORT,
+                            help='Port to serve Prometheus metrics on')
+
+    def handle(self, *args, **options):
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        worker = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self.stdout.write('Worker {0} started'.format(worker))
+        if options['metrics_port']:
+            # Metrics recorded by jobs never reach the web workers' /metrics
+            start_http_server(options['metrics_port'])
+
+        next_sweep = 0
+        while self.running:
+            close_old_connections()
+            if time.monotonic() >= next_sweep:
+                run_sweeps()
+                next_sweep = time.monotonic() + settings.JOB_SWEEP_INTERVAL
+            job = claim_job(worker)
+            if job:
+                run_job(job)
+            else:
+                time.sleep(options['poll'])
+        self.stdout.write('Worker {0} stopped'.format(worker))
+
+    def stop(self, signum, frame):
+        # Finish the current job, then exit
+        self.running = False
@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlparse
+
+from django.conf import settings
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, \
+    REGISTRY, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+
+# Metrics are exported from every process. When `prometheus_multiproc_dir`
+# is set (see config/gunicorn.py) prometheus_client keeps each value in a
+# per-process mmapped file, so recording only takes that value's own lock and
+# never coordinates with other workers; /metrics merges the files.
+
+REQUEST_LATENCY = Histogram(
+    'franklin_request_latency_seconds',
+    'Time spent serving API requests, by url name',
+    ['view', 'method', 'status'])
+
+GITHUB_LATENCY = Histogram(
+    'franklin_github_call_latency_seconds',
+    'Time spent in github.api functions that call Github',
+    ['function'])
+
+GITHUB_RESPONSES = Counter(
+    'franklin_github_responses_total',
+    'Responses from the Github API, by github.api function and status',
+    ['function', 'status'])
+
+GITHUB_RATELIMIT_REMAINING = Gauge(
+    'franklin_github_ratelimit_remaining',
+    'Last X-RateLimit-Remaining seen from Github',
+    multiprocess_mode='liveall')
+
+BUILDER_DISPATCH_LATENCY = Histogram(
+    'franklin_builder_dispatch_latency_seconds',
+    'Time spent sending builds to franklin-builder')
+
+BUILDER_DISPATCH_FAILURES = Counter(
+    'franklin_builder_dispatch_failures_total',
+    'Builds franklin-builder could not be reached for')
+
+WEBHOOK_EVENTS = Counter(
+    'franklin_webhook_events_total',
+    'Github webhook events received, and whether they queued any build',
+    ['event', 'outcome'])
+
+BUILD_TRANSITIONS = Counter(
+    'franklin_build_transitions_total',
+    'Build status changes',
+    ['from_status', 'to_status'])
+
+DEPLOY_KEY_POOL_DEPTH = Gauge(
+    'franklin_deploy_key_pool_depth',
+    'Pre-generated deploy keys left in the pool, as last counted',
+    multiprocess_mode='liveall')
+
+DEPLOY_KEY_CLAIM_LATENCY = Histogram(
+    'franklin_deploy_key_claim_latency_seconds',
+    'Time spent taking a deploy key out of the pool, and whether one was '
+    'left',
+    ['outcome'])
+
+_local = threading.local()
+
+
+def status_class(status_code):
+    return '{0}xx'.format(status_code // 100)
+
+
+@contextmanager
+def github_function(name):
+    """ Labels the Github responses received in this block with `name` """
+    previous = current_github_function()
+    _local.github_function = name
+    try:
+        yield
+    finally:
+        _local.github_function = previous
+
+
+def current_github_function():
+    return getattr(_local, 'github_function', None)
+
+
+def timed_github_call(func):
+    """ Records the latency of a github.api function and labels the
+    responses it receives with its name.
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        with github_function(name):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                GITHUB_LATENCY.labels(name).observe(
+                    time.perf_counter() - start)
+    return wrapper
+
+
+def record_response(url, response):
+    """ Counts responses from the Github API, keeping the remaining rate
+    limit. Responses from other hosts are ignored.
+    """
+    if not is_github_url(url):
+        return
+    function = current_github_function() or 'unknown'
+    GITHUB_RESPONSES.labels(function, str(response.status_code)).inc()
+    remaining = response.headers.get('X-RateLimit-Remaining')
+    if remaining is not None:
+        try:
+            GITHUB_RATELIMIT_REMAINING.set(int(remaining))
+        except (TypeError, ValueError):
+            pass
+
+
+def is_github_url(url):
+    return urlparse(url).netloc in (urlparse(settings.GITHUB_API_URL).netloc,
+                                    'github.com')
+
+
+def record_transition(from_status, to_status, count=1):
+    BUILD_TRANSITIONS.labels(from_status or 'unknown', to_status).inc(count)
+
+
+def latest():
+    """ Every metric in the text exposition format, merged across worker
+    processes when running multiprocess.
+    """
+    path = os.environ.get('prometheus_multiproc_dir')
+    if path:
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry, path)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
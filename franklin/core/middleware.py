@@ -0,0 +1,122 @@
+import json
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from .instrumentation import start_recording, stop_recording
+from .metrics import REQUEST_LATENCY, status_class
+
+logger = logging.getLogger(__name__)
+
+
+def last_query():
+    """ The newest entry in the connection's query log, or None """
+    log = connection.queries_log
+    return log[-1] if log else None
+
+
+def queries_since(marker):
+    """ Entries logged after `marker`. The log only keeps its newest
+    entries, so positions shift once it is full; the marker entry is found
+    by identity instead. If it was dropped, the whole log is newer.
+    """
+    queries = list(connection.queries_log)
+    for i in range(len(queries) - 1, -1, -1):
+        if queries[i] is marker:
+            return queries[i + 1:]
+    return queries
+
+
+class InstrumentationMiddleware(object):
+    """ For a sample of requests (INSTRUMENTATION_SAMPLE_RATE), records SQL
+    query count and time, outbound calls per upstream host and view time.
+    They are sent back in a Server-Timing header and logged as one JSON line;
+    queries slower than INSTRUMENTATION_SLOW_QUERY_MS are logged verbatim.
+
+    Requests that are not sampled only pay for one random() call.
+    """
+
+    def process_request(self, request):
+        rate = settings.INSTRUMENTATION_SAMPLE_RATE
+        if rate <= 0 or random.random() >= rate:
+            return None
+        request._instrumentation = {
+            'start': time.perf_counter(),
+            'view_start': None,
+            'debug_cursor': connection.force_debug_cursor,
+            'last_query': last_query(),
+            'upstream': start_recording(),
+        }
+        # Makes the connection log queries with their duration, like DEBUG
+        connection.force_debug_cursor = True
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        sample = getattr(request, '_instrumentation', None)
+        if sample is not None:
+            sample['view_start'] = time.perf_counter()
+        return None
+
+    def process_response(self, request, response):
+        sample = getattr(request, '_instrumentation', None)
+        if sample is None:
+            return response
+        end = time.perf_counter()
+        stop_recording()
+        connection.force_debug_cursor = sample['debug_cursor']
+
+        queries = queries_since(sample['last_query'])
+        db_ms = sum(float(query['time']) for query in queries) * 1000
+        total_ms = (end - sample['start']) * 1000
+        view_ms = (end - sample['view_start']) * 1000 \
+            if sample['view_start'] else None
+        upstream = {host: {'count': count, 'ms': elapsed * 1000}
+                    for host, (count, elapsed)
+                    in sample['upstream'].calls.items()}
+
+        metrics = ['db;desc="{0} queries";dur={1:.1f}'.format(
+            len(queries), db_ms)]
+        for host, calls in sorted(upstream.items()):
+            metrics.append('upstream;desc="{0} ({1})";dur={2:.1f}'.format(
+                host, calls['count'], calls['ms']))
+        if view_ms is not None:
+            metrics.append('view;dur={0:.1f}'.format(view_ms))
+        metrics.append('total;dur={0:.1f}'.format(total_ms))
+        response['Server-Timing'] = ', '.join(metrics)
+
+        slow = [{'ms': float(query['time']) * 1000, 'sql': query['sql']}
+                for query in queries if float(query['time']) * 1000 >=
+                settings.INSTRUMENTATION_SLOW_QUERY_MS]
+        logger.info('request %s', json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(total_ms, 1),
+            'view_ms': round(view_ms, 1) if view_ms is not None else None,
+            'db': {'count': len(queries), 'ms': round(db_ms, 1)},
+            'upstream': upstream,
+            'slow_queries': slow,
+        }, sort_keys=True))
+        return response
+
+
+class MetricsMiddleware(object):
+    """ Records the latency of every request, labelled by url name. """
+
+    def process_request(self, request):
+        request._metrics_start = time.perf_counter()
+        return None
+
+    def process_response(self, request, response):
+        start = getattr(request, '_metrics_start', None)
+        if start is None:
+            return response
+        match = getattr(request, 'resolver_match', None)
+        REQUEST_LATENCY.labels(
+            match.view_name if match else 'unmatched', request.method,
+            status_class(response.status_code)
+        ).observe(time.perf_counter() - start)
+        return response
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('default', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OAuthToken',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, primary_key=True, auto_created=True)),
+                ('digest', models.CharField(unique=True, max_length=64)),
+                ('social', models.OneToOneField(to='default.UserSocialAuth', related_name='token_index')),
+            ],
+            options={
+                'verbose_name': 'OAuth Token',
+                'verbose_name_plural': 'OAuth Tokens',
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations
+
+
+def backfill_tokens(apps, schema_editor):
+    UserSocialAuth = apps.get_model('default', 'UserSocialAuth')
+    OAuthToken = apps.get_model('core', 'OAuthToken')
+    seen = set()
+    tokens = []
+    for social in UserSocialAuth.objects.iterator():
+        token = (social.extra_data or {}).get('access_token')
+        if token:
+            digest = hashlib.sha256(token.encode('utf-8')).hexdigest()
+            if digest not in seen:
+                seen.add(digest)
+                tokens.append(OAuthToken(social=social, digest=digest))
+    OAuthToken.objects.bulk_create(tokens, batch_size=1000)
+
+
+def remove_tokens(apps, schema_editor):
+    apps.get_model('core', 'OAuthToken').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_tokens, remove_tokens),
+    ]
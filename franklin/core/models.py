@@ -0,0 +1,142 @@
+import hashlib
+import logging
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import models
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils.translation import ugettext as _
+
+from social.apps.django_app.default.models import UserSocialAuth
+
+logger = logging.getLogger(__name__)
+
+
+class OAuthToken(models.Model):
+    """ Index of the Github oauth token stored in each social auth record, so
+    bearer tokens can be resolved to a user with a single indexed lookup.
+
+    :param social: The social auth record the token belongs to
+    :param digest: sha256 hex digest of the token. The token itself is only
+                   kept in the social auth record
+    """
+    social = models.OneToOneField(UserSocialAuth, related_name='token_index')
+    digest = models.CharField(max_length=64, unique=True)
+
+    @staticmethod
+    def digest_for(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def user_cache_key(digest):
+        """ Shared cache key of the user a token digest resolves to """
+        return 'token-user:{0}'.format(digest)
+
+    @classmethod
+    def index(cls, social):
+        previous = cls.objects.filter(social=social)\
+                              .values_list('digest', flat=True).first()
+        token = social.extra_data.get('access_token')
+        digest = cls.digest_for(token) if token else None
+        if digest:
+            # A token can only belong to one record; drop any stale claim
+            cls.objects.filter(digest=digest).exclude(social=social).delete()
+            cls.objects.update_or_create(social=social,
+                                         defaults={'digest': digest})
+        else:
+            cls.objects.filter(social=social).delete()
+        # Neither the replaced token nor the new one may resolve to whoever
+        # they were cached for
+        cache.delete_many([cls.user_cache_key(key)
+                           for key in {previous, digest} if key])
+
+    @classmethod
+    def forget_user(cls, user):
+        """ Drops the cached copies of a user, under each of their tokens """
+        digests = cls.objects.filter(social__user=user)\
+                             .values_list('digest', flat=True)
+        cache.delete_many([cls.user_cache_key(digest) for digest in digests])
+
+    @classmethod
+    def forget_social(cls, social):
+        """ Drops the cached user under a social auth record's token """
+        token = social.extra_data.get('access_token')
+        if token:
+            cache.delete(cls.user_cache_key(cls.digest_for(token)))
+
+    def __str__(self):
+        return '%s %s' % (self.social.user, self.digest[:8])
+
+    class Meta(object):
+        verbose_name = _('OAuth Token')
+        verbose_name_plural = _('OAuth Tokens')
+
+
+@receiver(post_save, sender=UserSocialAuth)
+def index_social_token(sender, instance, **kwargs):
+    OAuthToken.index(instance)
+
+
+@receiver(post_delete, sender=UserSocialAuth)
+def forget_social_token(sender, instance, **kwargs):
+    OAuthToken.forget_social(instance)
+
+
+@receiver(post_save, sender=User)
+def forget_cached_user(sender, instance, created, **kwargs):
+    if not created:
+        OAuthToken.forget_user(instance)
+
+
+@receiver(pre_delete, sender=User)
+def forget_deleted_user(sender, instance, **kwargs):
+    # The user's tokens are gone by post_delete
+    OAuthToken.forget_user(instance)
+
+
+class Job(models.Model):
+    """ A unit of background work, run by `manage.py run_worker`.
+
+    :param task: Dotted path of the function to run
+    :param payload: JSON encoded keyword arguments for the task
+    :param status: Where the job is in its lifecycle. DEAD jobs ran out of
+                   attempts and are kept for inspection
+    :param attempts: How many times the job has been claimed
+    :param max_attempts: Attempts allowed before the job is marked DEAD
+    :param run_at: The job will not be claimed before this time
+    :param lease_expires: While running, when another worker may reclaim it
+    :param worker: Identifier of the worker holding the lease
+    :param last_error: The error raised by the most recent failed attempt
+    """
+    QUEUED = 'QUE'
+    RUNNING = 'RUN'
+    DONE = 'DON'
+    DEAD = 'DED'
+    STATUS_CHOICES = (
+        (QUEUED, _('queued')),
+        (RUNNING, _('running')),
+        (DONE, _('done')),
+        (DEAD, _('dead'))
+    )
+
+    task = models.CharField(max_length=200)
+    payload = models.TextField(default='{}')
+    status = models.CharField(max_length=3, choices=STATUS_CHOICES,
+                              default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField()
+    run_at = models.DateTimeField()
+    lease_expires = models.DateTimeField(blank=True, null=True)
+    worker = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '%s %s' % (self.task, self.get_status_display())
+
+    class Meta(object):
+        verbose_name = _('Job')
+        verbose_name_plural = _('Jobs')
+        index_together = ('status', 'run_at')
@@ -0,0 +1,144 @@
+import base64
+import binascii
+import json
+import operator
+from datetime import datetime
+from functools import reduce
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.utils.urls import replace_query_param
+
+from .exceptions import BadRequest
+
+
+class KeysetPagination(object):
+    """ Pagination that resumes from the last row of the previous page
+    (e.g. WHERE (created, id) < cursor) instead of an OFFSET, so pages stay
+    stable while rows are inserted and each page is an index range scan.
+
+    The cursor is opaque to clients; the url of the next page is sent in a
+    `Link: <url>; rel="next"` header so list bodies keep their shape.
+
+    :param fields: Unique combination of fields to order and resume on
+    :param descending: Newest first when ordering by creation
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+
+    def __init__(self, fields=('created', 'id'), descending=True):
+        self.fields = fields
+        self.descending = descending
+        self.next_values = None
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return settings.LIST_PAGE_SIZE
+        return max(1, min(size, settings.LIST_MAX_PAGE_SIZE))
+
+    def decode_cursor(self, request, model=None, positioned=False):
+        """ The values the cursor resumes after, converted to the types of
+        the model's fields when given a model. Positioned cursors (see
+        paginate_list) end with the position of the item they name.
+        """
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            values = json.loads(
+                base64.urlsafe_b64decode(cursor.encode('ascii')).decode())
+        except (ValueError, TypeError, binascii.Error):
+            raise BadRequest(detail='Invalid cursor')
+        length = len(self.fields) + (1 if positioned else 0)
+        if not isinstance(values, list) or len(values) != length:
+            raise BadRequest(detail='Invalid cursor')
+        if model is not None:
+            try:
+                values = [model._meta.get_field(field).to_python(value)
+                          for field, value in zip(self.fields, values)]
+            except (ValidationError, ValueError, TypeError):
+                raise BadRequest(detail='Invalid cursor')
+            if None in values:
+                raise BadRequest(detail='Invalid cursor')
+        return values
+
+    def encode_cursor(self, values):
+        values = [value.isoformat() if isinstance(value, datetime) else value
+                  for value in values]
+        return base64.urlsafe_b64encode(
+            json.dumps(values).encode()).decode('ascii')
+
+    def keyset_filter(self, values):
+        """ Rows strictly after `values` in the pagination order """
+        lookup = '__lt' if self.descending else '__gt'
+        after = []
+        for i, field in enumerate(self.fields):
+            lookups = dict(zip(self.fields[:i], values[:i]))
+            lookups[field + lookup] = values[i]
+            after.append(Q(**lookups))
+        # The redundant bound on the first field keeps it an index range scan
+        return Q(**{self.fields[0] + lookup + 'e': values[0]}) & \
+            reduce(operator.or_, after)
+
+    def paginate_queryset(self, queryset, request):
+        self.request = request
+        size = self.get_page_size(request)
+        prefix = '-' if self.descending else ''
+        queryset = queryset.order_by(*[prefix + field
+                                       for field in self.fields])
+        values = self.decode_cursor(request, queryset.model)
+        if values is not None:
+            queryset = queryset.filter(self.keyset_filter(values))
+        page = list(queryset[:size + 1])
+        return self._finish(page, size,
+                            lambda item: [getattr(item, field)
+                                          for field in self.fields])
+
+    def paginate_list(self, items, request):
+        """ Same as paginate_queryset, for dicts already in memory (e.g. a
+        listing fetched from Github). Items keep their order; the cursor
+        resumes after the item with its values, or at that item's position
+        if it has left the list since.
+        """
+        self.request = request
+        size = self.get_page_size(request)
+
+        def key(item):
+            return [item[field] for field in self.fields]
+
+        start = 0
+        values = self.decode_cursor(request, positioned=True)
+        if values is not None:
+            last, position = values[:-1], values[-1]
+            if not isinstance(position, int) or position < 0:
+                raise BadRequest(detail='Invalid cursor')
+            keys = [key(item) for item in items]
+            start = keys.index(last) + 1 if last in keys else position
+        page = self._finish(items[start:start + size + 1], size, key)
+        if self.next_values is not None:
+            self.next_values.append(start + size - 1)
+        return page
+
+    def _finish(self, page, size, key):
+        if len(page) > size:
+            page = page[:size]
+            self.next_values = key(page[-1])
+        else:
+            self.next_values = None
+        return page
+
+    def get_next_link(self):
+        if self.next_values is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(),
+                                   self.cursor_query_param,
+                                   self.encode_cursor(self.next_values))
+
+    def add_link_header(self, response):
+        link = self.get_next_link()
+        if link:
+            response['Link'] = '<{0}>; rel="next"'.format(link)
+        return response
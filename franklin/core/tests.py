@@ -1,16 +1,42 @@
 import os
+import random
+import requests
+import time
+from collections import deque
+from datetime import timedelta
 from requests.exceptions import ConnectionError, HTTPError, Timeout
 from unittest import mock
 
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
 
-from .exceptions import BadRequest, ServiceUnavailable
-from .helpers import make_rest_get_call, make_rest_post_call
+from rest_framework.exceptions import AuthenticationFailed
+
+from .benchmark.data import skewed_counts
+from .benchmark.runner import percentile
+from .benchmark.stubs import builder_stub
+from .client import RestClient
+from .exceptions import BadRequest, RateLimited, ServiceUnavailable
+from .health import HealthChecker
+from .helpers import SocialAuthentication, make_rest_get_call, \
+    make_rest_post_call
+from .jobs import RetryLater, claim_job, enqueue, prune_jobs, run_job, \
+    run_sweeps
+from .metrics import REGISTRY, github_function, record_response
+from .middleware import last_query, queries_since
+from .models import Job, OAuthToken
+from .views import check_api_health
+from github.api import response_cache
 
 
 class HelpersTestCase(TestCase):
     def setUp(self):
+        cache.clear()
         self.url = os.environ['BUILDER_URL'] + '/build'
         self.headers = {'content-type': 'application/json'}
         self.body = {
@@ -26,28 +52,40 @@ class HelpersTestCase(TestCase):
                         reverse('webhook:builder', args=["uuid1234", ])
         }
 
-    @mock.patch('core.helpers.requests.post', side_effect=ConnectionError)
+    @mock.patch('core.helpers.client.post', side_effect=ConnectionError)
     def test_make_rest_post_call_conn_error(self, mock_post):
         """ Tests make_rest_post_call when the call has an Connection exception.
         """
         with self.assertRaises(ServiceUnavailable):
             make_rest_post_call(self.url, self.headers, self.body)
 
-    @mock.patch('core.helpers.requests.post', side_effect=HTTPError)
+    @mock.patch('core.helpers.client.post', side_effect=HTTPError)
     def test_make_rest_post_call_http_error(self, mock_post):
         """ Tests make_rest_post_call when the call has an HTTP exception.
         """
         with self.assertRaises(ServiceUnavailable):
             make_rest_post_call(self.url, self.headers, self.body)
 
-    @mock.patch('core.helpers.requests.post', side_effect=Timeout)
+    @mock.patch('core.helpers.client.post', side_effect=Timeout)
     def test_make_rest_post_call_timeout_error(self, mock_post):
         """ Tests make_rest_post_call when the call has an Timeout exception.
         """
         with self.assertRaises(ServiceUnavailable):
             make_rest_post_call(self.url, self.headers, self.body)
 
-    @mock.patch('core.helpers.requests.post')
+    @mock.patch('core.helpers.client.post')
+    def test_rate_limit_github_only(self, mock_post):
+        """ Only Github's 403s and 429s are taken as rate limits
+        """
+        mock_post.return_value = mock.Mock(
+            status_code=429, headers={'Retry-After': '30'})
+        with self.assertRaises(BadRequest):
+            make_rest_post_call(self.url, self.headers, self.body)
+        with self.assertRaises(RateLimited):
+            make_rest_post_call(settings.GITHUB_API_URL + '/user/repos',
+                                self.headers, self.body)
+
+    @mock.patch('core.helpers.client.post')
     def test_make_rest_post_call_error(self, mock_post):
         """ Tests make_rest_post_call when the api returns some error
         """
@@ -59,28 +97,28 @@ class HelpersTestCase(TestCase):
         with self.assertRaises(BadRequest):
             make_rest_post_call(self.url, self.headers, self.body)
 
-    @mock.patch('core.helpers.requests.get', side_effect=ConnectionError)
+    @mock.patch('core.helpers.client.get', side_effect=ConnectionError)
     def test_make_rest_get_call_conn_error(self, mock_post):
         """ Tests make_rest_get_call when the call has an Connection exception.
         """
         with self.assertRaises(ServiceUnavailable):
             make_rest_get_call(self.url, self.headers)
 
-    @mock.patch('core.helpers.requests.get', side_effect=HTTPError)
+    @mock.patch('core.helpers.client.get', side_effect=HTTPError)
     def test_make_rest_get_call_http_error(self, mock_post):
         """ Tests make_rest_get_call when the call has an HTTP exception.
         """
         with self.assertRaises(ServiceUnavailable):
             make_rest_get_call(self.url, self.headers)
 
-    @mock.patch('core.helpers.requests.get', side_effect=Timeout)
+    @mock.patch('core.helpers.client.get', side_effect=Timeout)
     def test_make_rest_get_call_timeout_error(self, mock_post):
         """ Tests make_rest_get_call when the call has an Timeout exception.
         """
         with self.assertRaises(ServiceUnavailable):
             make_rest_get_call(self.url, self.headers)
 
-    @mock.patch('core.helpers.requests.get')
+    @mock.patch('core.helpers.client.get')
     def test_make_rest_get_call_error(self, mock_post):
         """ Tests make_rest_get_call when the api returns some error
         """
@@ -91,3 +129,366 @@ class HelpersTestCase(TestCase):
 
         with self.assertRaises(BadRequest):
             make_rest_get_call(self.url, self.headers)
+
+
+class RestClientTestCase(TestCase):
+    def setUp(self):
+        self.rest_client = RestClient(connect_timeout=1, read_timeout=1,
+                                      pool_size=2, max_retries=2, backoff=0)
+        self.url = 'https://api.github.com/user'
+
+    @mock.patch('core.client.requests.Session.request')
+    def test_get_retried(self, mock_request):
+        """ Idempotent calls are retried on connection errors and 503s
+        """
+        mock_request.side_effect = [ConnectionError,
+                                    mock.Mock(status_code=503),
+                                    mock.Mock(status_code=200)]
+        response = self.rest_client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(mock_request.call_args[1]['timeout'], (1, 1))
+
+    @mock.patch('core.client.requests.Session.request')
+    def test_get_retries_bounded(self, mock_request):
+        """ The last response is returned once retries run out
+        """
+        mock_request.return_value = mock.Mock(status_code=503)
+        response = self.rest_client.get(self.url)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(mock_request.call_count, 3)
+
+    @mock.patch('core.client.requests.Session.request',
+                side_effect=ConnectionError)
+    def test_post_not_retried(self, mock_request):
+        """ Non-idempotent calls are attempted once
+        """
+        with self.assertRaises(ConnectionError):
+            self.rest_client.post(self.url, data='{}')
+        self.assertEqual(mock_request.call_count, 1)
+
+    def test_session_per_host(self):
+        """ Sessions are pooled per upstream host
+        """
+        github = 'https://api.github.com'
+        session = self.rest_client._session(github)
+        self.assertIs(session, self.rest_client._session(github))
+        self.assertIsNot(session, self.rest_client._session('http://builder'))
+
+
+class SocialAuthenticationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="a")
+        self.social = self.user.social_auth.create(provider='github', uid=123)
+        self.social.extra_data['access_token'] = 'abc123'
+        self.social.save()
+        self.factory = RequestFactory()
+
+    def authenticate(self, token):
+        request = self.factory.get(
+            '/', HTTP_AUTHORIZATION='Bearer {}'.format(token))
+        return SocialAuthentication().authenticate(request)
+
+    def test_token_indexed(self):
+        """ Saving a social auth record indexes its access token
+        """
+        self.assertTrue(OAuthToken.objects.filter(
+            social=self.social,
+            digest=OAuthToken.digest_for('abc123')).exists())
+
+    def test_authenticate_cached(self):
+        """ The token is resolved by the index once, then from the cache
+        until the user is saved
+        """
+        user, token = self.authenticate('abc123')
+        self.assertEqual(user, self.user)
+        with self.assertNumQueries(0):
+            user, token = self.authenticate('abc123')
+        self.assertEqual(user, self.user)
+        self.user.first_name = 'Changed'
+        self.user.save()
+        user, token = self.authenticate('abc123')
+        self.assertEqual(user.first_name, 'Changed')
+
+    @mock.patch('core.helpers.do_auth')
+    def test_revoked(self, mock_auth):
+        """ Deleting the social auth record or the user stops a cached
+        token from resolving
+        """
+        mock_auth.side_effect = AuthenticationFailed('Bad credentials')
+        self.authenticate('abc123')
+        self.social.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate('abc123')
+
+        self.social = self.user.social_auth.create(provider='github', uid=123)
+        self.social.extra_data['access_token'] = 'abc123'
+        self.social.save()
+        self.authenticate('abc123')
+        self.user.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate('abc123')
+
+    @mock.patch('core.helpers.do_auth')
+    def test_rotated_token(self, mock_auth):
+        """ A replaced token no longer resolves, even once cached
+        """
+        mock_auth.return_value = self.user
+        self.authenticate('abc123')
+        self.social.extra_data['access_token'] = 'def456'
+        self.social.save()
+        self.assertEqual(self.authenticate('def456')[0], self.user)
+        self.authenticate('abc123')
+        mock_auth.assert_called_once_with('abc123')
+
+
+task_calls = []
+
+
+def record_task(**kwargs):
+    task_calls.append(kwargs)
+
+
+def failing_task():
+    raise ValueError('boom')
+
+
+def waiting_task():
+    raise RetryLater(60)
+
+
+def rate_limited_task():
+    raise RateLimited(wait=600)
+
+
+class JobQueueTestCase(TestCase):
+    def setUp(self):
+        del task_calls[:]
+
+    def test_run_job(self):
+        """ A claimed job runs its task with the queued arguments
+        """
+        job = enqueue(record_task, build_id=1)
+        claimed = claim_job('worker-1')
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.status, Job.RUNNING)
+        run_job(claimed)
+        self.assertEqual(task_calls, [{'build_id': 1}])
+        self.assertEqual(Job.objects.get(id=job.id).status, Job.DONE)
+
+    def test_single_claim(self):
+        """ A job leased to one worker can't be claimed by another
+        """
+        enqueue(record_task)
+        self.assertIsNotNone(claim_job('worker-1'))
+        self.assertIsNone(claim_job('worker-2'))
+
+    def test_retry_then_dead(self):
+        """ Failures are retried later, then the job is marked dead
+        """
+        job = enqueue(failing_task)
+        run_job(claim_job('worker-1'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertIn('boom', job.last_error)
+        self.assertIsNone(claim_job('worker-1'))
+
+        Job.objects.filter(id=job.id).update(attempts=job.max_attempts - 1,
+                                             run_at=job.created)
+        run_job(claim_job('worker-1'))
+        self.assertEqual(Job.objects.get(id=job.id).status, Job.DEAD)
+
+    def test_retry_later(self):
+        """ RetryLater requeues a job without using up an attempt
+        """
+        job = enqueue(waiting_task)
+        run_job(claim_job('worker-1'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertEqual(job.attempts, 0)
+
+    def test_rate_limited(self):
+        """ A task hitting Github's rate limit waits for the reset without
+        using up an attempt
+        """
+        job = enqueue(rate_limited_task)
+        run_job(claim_job('worker-1'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertEqual(job.attempts, 0)
+        self.assertGreater(job.run_at, timezone.now() + timedelta(minutes=9))
+
+    @override_settings(JOB_PRUNE_BATCH_SIZE=1)
+    def test_prune(self):
+        """ Old DONE jobs are deleted; recent and DEAD ones are kept
+        """
+        old = timezone.now() - timedelta(days=30)
+        for status in (Job.DONE, Job.DONE, Job.DEAD):
+            job = enqueue(record_task)
+            Job.objects.filter(id=job.id).update(status=status, updated=old)
+        recent = enqueue(record_task)
+        Job.objects.filter(id=recent.id).update(status=Job.DONE)
+        prune_jobs()
+        self.assertEqual(
+            sorted(Job.objects.values_list('status', flat=True)),
+            sorted([Job.DONE, Job.DEAD]))
+        self.assertTrue(Job.objects.filter(id=recent.id).exists())
+
+    @override_settings(JOB_SWEEPS=('core.tests.failing_task',
+                                   'core.tests.record_task'))
+    def test_sweeps(self):
+        """ A failing sweep doesn't stop the others
+        """
+        run_sweeps()
+        self.assertEqual(task_calls, [{}])
+
+
+class BenchmarkTestCase(TestCase):
+    def test_skewed_counts(self):
+        """ Generated items are all assigned, mostly to a few buckets """
+        counts = skewed_counts(1000, 50, random.Random(1))
+        self.assertEqual(sum(counts), 1000)
+        self.assertGreater(sum(sorted(counts)[-5:]), 500)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertIsNone(percentile([], 50))
+
+    def test_stub_server(self):
+        """ Stand-ins answer their routes and count every call """
+        stub = builder_stub(error_rate=0).start()
+        try:
+            response = requests.post(stub.url + '/build', data='{}')
+            self.assertEqual(response.status_code, 200)
+            response = requests.get(stub.url + '/missing')
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(stub.hits, 2)
+        finally:
+            stub.stop()
+
+
+class InstrumentationTestCase(TestCase):
+    @override_settings(INSTRUMENTATION_SAMPLE_RATE=0)
+    def test_not_sampled(self):
+        response = self.client.get('/v1/domains/', {'domain': 'a.com'})
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @override_settings(INSTRUMENTATION_SAMPLE_RATE=1)
+    @mock.patch('core.helpers.client.get')
+    def test_server_timing(self, mock_get):
+        """ Sampled requests report SQL, upstream calls and view time """
+        user = User.objects.create_user(username='testuser', password='a')
+        social = user.social_auth.create(provider='github', uid=123)
+        social.extra_data['access_token'] = 'abc123'
+        social.save()
+        cache.clear()
+        response_cache.clear()
+        mock_get.return_value = mock.Mock(status_code=200, links={})
+        mock_get.return_value.json.return_value = []
+        with mock.patch('core.middleware.logger') as mock_logger:
+            response = self.client.get(
+                '/v1/repos/', HTTP_AUTHORIZATION='Bearer abc123')
+
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;desc="\d+ queries";dur=')
+        self.assertIn('upstream;desc="api.github.com (1)"', timing)
+        self.assertIn('view;dur=', timing)
+        self.assertIn('total;dur=', timing)
+        self.assertTrue(mock_logger.info.called)
+
+    def test_queries_since_full_log(self):
+        """ Queries are picked out after the query log starts dropping its
+        oldest entries
+        """
+        with mock.patch.object(connection, 'queries_log',
+                               deque(maxlen=3)) as log:
+            log.extend([{'sql': 'a'}, {'sql': 'b'}, {'sql': 'c'}])
+            marker = last_query()
+            log.extend([{'sql': 'd'}, {'sql': 'e'}])
+            self.assertEqual([query['sql'] for query in queries_since(marker)],
+                             ['d', 'e'])
+            log.extend([{'sql': 'f'}, {'sql': 'g'}])
+            self.assertEqual([query['sql'] for query in queries_since(marker)],
+                             ['e', 'f', 'g'])
+
+
+class MetricsTestCase(TestCase):
+    def test_request_latency(self):
+        self.client.get('/v1/domains/', {'domain': 'a.com'})
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'franklin_request_latency_seconds_count{',
+                      response.content)
+        self.assertIn(b'view="domain"', response.content)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_restricted(self):
+        """ Only allowed addresses and holders of the token may scrape
+        """
+        response = self.client.get('/metrics', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get('/metrics', REMOTE_ADDR='10.0.0.1',
+                                   HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+    def test_github_responses(self):
+        """ Responses are labelled by github.api function and the rate limit
+        left is kept
+        """
+        labels = {'function': 'get_repo', 'status': '200'}
+        before = REGISTRY.get_sample_value(
+            'franklin_github_responses_total', labels) or 0
+        response = mock.Mock(status_code=200,
+                             headers={'X-RateLimit-Remaining': '42'})
+        with github_function('get_repo'):
+            record_response(settings.GITHUB_API_URL + '/repos/a/b', response)
+            record_response('http://builder/build', response)
+        self.assertEqual(REGISTRY.get_sample_value(
+            'franklin_github_responses_total', labels), before + 1)
+        self.assertEqual(REGISTRY.get_sample_value(
+            'franklin_github_ratelimit_remaining'), 42)
+
+
+class HealthTestCase(TestCase):
+    @override_settings(HEALTH_CHECK_TIMEOUT=0.2, HEALTH_CHECK_INTERVAL=60)
+    def test_probes_concurrent_with_deadline(self):
+        """ Probes run side by side; slow ones are reported as timed out """
+        calls = []
+
+        def probe(delay):
+            def check(timeout):
+                calls.append(timeout)
+                time.sleep(delay)
+                return {'status': 'good'}
+            return check
+
+        checker = HealthChecker({'fast': probe(0), 'fast2': probe(0.1),
+                                 'slow': probe(1)})
+        start = time.monotonic()
+        results = checker.results()
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(results, {'fast': {'status': 'good'},
+                                   'fast2': {'status': 'good'},
+                                   'slow': {'status': 'timeout'}})
+        self.assertEqual(calls, [0.2] * 3)
+
+        # Served from memory until the interval passes
+        self.assertEqual(checker.results(), results)
+        self.assertEqual(len(calls), 3)
+
+    @mock.patch('core.client.requests.Session.request',
+                side_effect=Timeout)
+    def test_api_probe_not_retried(self, mock_request):
+        """ The Github probe is sent once, so it stays within its timeout
+        """
+        self.assertEqual(check_api_health('https://example.com/status', 1),
+                         {'status': 'unreachable'})
+        self.assertEqual(mock_request.call_count, 1)
+
+    def test_live(self):
+        response = self.client.get('/v1/health/live/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'status': 'good'})
@@ -1,14 +1,18 @@
 from django.conf.urls import include, url
 
-from .views import health
-from builder.views import domain, UpdateBuildStatus
-from github.views import builds, deployable_repos, github_webhook, \
-    ProjectDetail, ProjectList, PromoteEnvironment, get_auth_token
+from .views import health, live, metrics
+from builder.views import domain, routes, UpdateBuildStatus, \
+    UpdateBuildStatuses
+from github.views import build_events, builds, deployable_repos, \
+    github_webhook, ProjectDetail, ProjectList, PromoteEnvironment, \
+    get_auth_token
 from users.views import user_details
 
 
 # /webhooks/
 webhook_patterns = [
+    url(r'^builder/builds/$', UpdateBuildStatuses.as_view(),
+        name='builder_batch'),
     url(r'^builder/builds/(?P<uuid>[0-9a-zA-Z\-]+)$',
         UpdateBuildStatus.as_view(), name='builder'),
     url(r'^github/$', github_webhook, name='github'),
@@ -26,6 +30,8 @@ v1_patterns = [
 
     # Managing Builds endpoints
     url(r'^projects/(?P<repo>[0-9]+)/builds$', builds, name='project_builds'),
+    url(r'^projects/(?P<repo>[0-9]+)/events$', build_events,
+        name='project_events'),
 
     # Build promotion
     url(r'^projects/(?P<repo>[0-9]+)/environments/(?P<env>[a-zA-Z]+)$',
@@ -39,14 +45,19 @@ v1_patterns = [
 
     # Domain metadata
     url(r'^domains/$', domain, name='domain'),
+    url(r'^domains/routes/$', routes, name='domain_routes'),
 
     # Utilities
     url(r'^health/$', health, name='health'),
+    url(r'^health/live/$', live, name='health_live'),
 ]
 
 urlpatterns = [
     url(r'^v1/', include(v1_patterns)),
 
+    # Prometheus scrapes
+    url(r'^metrics$', metrics, name='metrics'),
+
     # Webhooks
     url(r'^webhooks/', include(webhook_patterns, namespace='webhook')),
 ]
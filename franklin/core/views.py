@@ -1,19 +1,28 @@
+import hmac
 import logging
-import os
 
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from prometheus_client import CONTENT_TYPE_LATEST
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 
+from builder.pool import get_builder_pool
+from core.health import HealthChecker
 from core.helpers import make_rest_get_call
+from core.metrics import latest
 
 logger = logging.getLogger(__name__)
 
 
-def check_api_health(url):
+def check_api_health(url, timeout=None):
+    # Not retried, so the probe takes no longer than `timeout`
     try:
-        response = make_rest_get_call(url, '')
+        response = make_rest_get_call(url, '', timeout=timeout,
+                                      max_retries=0)
         if status.is_success(response.status_code):
             return response.json()
     except:
@@ -22,16 +31,44 @@ def check_api_health(url):
     return {'status': 'unreachable'}
 
 
+health_checker = HealthChecker({
+    'github': lambda timeout: check_api_health(
+        'https://status.github.com/api/status.json', timeout),
+    'builder': lambda timeout: get_builder_pool().check_health(timeout),
+})
+
+
 @api_view(('GET',))
 @permission_classes((AllowAny, ))
 def health(request):
     """
     For testing if the API is behaving properly
     """
-    github_health_url = 'https://status.github.com/api/status.json'
-    builder_health_url = os.environ['BUILDER_URL'] + '/health/'
-    return Response({
-        'api': {'status': 'good'},
-        'github': check_api_health(github_health_url),
-        'builder': check_api_health(builder_health_url)
-    }, status=status.HTTP_200_OK)
+    result = {'api': {'status': 'good'}}
+    result.update(health_checker.results())
+    return Response(result, status=status.HTTP_200_OK)
+
+
+@api_view(('GET',))
+@permission_classes((AllowAny, ))
+def live(request):
+    """
+    Liveness probe: the process is up and serving, whatever the state of
+    its dependencies
+    """
+    return Response({'status': 'good'}, status=status.HTTP_200_OK)
+
+
+def metrics(request):
+    """
+    Prometheus scrape endpoint, for METRICS_ALLOWED_IPS and holders of
+    METRICS_TOKEN
+    """
+    given = request.META.get('HTTP_AUTHORIZATION', '').encode()
+    expected = 'Bearer {0}'.format(settings.METRICS_TOKEN).encode()
+    allowed = (
+        request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS or
+        (settings.METRICS_TOKEN and hmac.compare_digest(given, expected)))
+    if not allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(latest(), content_type=CONTENT_TYPE_LATEST)
@@ -1,18 +1,27 @@
 import logging
 import os
 import yaml
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
 
+from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 
 from rest_framework import status
 
+from .cache import CachedResponse, ConditionalCache
+from .ratelimit import READ, WRITE, TokenQuota
+from core.exceptions import BadRequest, RateLimited, ServiceUnavailable
 from core.helpers import make_rest_get_call, make_rest_post_call, \
     make_rest_delete_call
+from core.instrumentation import current_recording, recording
+from core.metrics import current_github_function, github_function, \
+    timed_github_call
 
 logger = logging.getLogger(__name__)
 
-repo_base_url = 'https://api.github.com/repo'
-repos_base_url = 'https://api.github.com/repos'
+response_cache = ConditionalCache(max_bytes=settings.GITHUB_CACHE_BYTES)
 
 
 def get_auth_header(user):
@@ -26,27 +35,87 @@ def get_auth_header(user):
     return headers
 
 
+def build_api_url(path):
+    return '{0}/{1}'.format(settings.GITHUB_API_URL, path)
+
+
 def build_repo_url(owner, repo, endpoint=''):
-    return '{0}/{1}/{2}/{3}'.format(repo_base_url, owner, repo, endpoint)
+    return build_api_url('repo/{0}/{1}/{2}'.format(owner, repo, endpoint))
 
 
 def build_repos_url(owner, repo, endpoint=''):
-    return '{0}/{1}/{2}/{3}'.format(repos_base_url, owner, repo, endpoint)
+    return build_api_url('repos/{0}/{1}/{2}'.format(owner, repo, endpoint))
 
 
 def build_repos_root_url(owner, repo):
-    return '{0}/{1}/{2}'.format(repos_base_url, owner, repo)
+    return build_api_url('repos/{0}/{1}'.format(owner, repo))
+
+
+def make_github_call(method, url, headers, body=None, priority=READ,
+                     quota=None):
+    """
+    Calls Github, scheduled against the remaining rate limit of the token in
+    `headers`: calls are refused with RateLimited once the budget is down to
+    the reserve kept for higher priorities (see GITHUB_RATELIMIT_RESERVE).
+    """
+    quota = quota or TokenQuota.for_headers(headers)
+    if quota and not quota.allows(priority):
+        raise RateLimited(wait=quota.wait())
+    try:
+        if method == 'POST':
+            result = make_rest_post_call(url, headers, body)
+        elif method == 'DELETE':
+            result = make_rest_delete_call(url, headers)
+        else:
+            result = make_rest_get_call(url, headers)
+    except RateLimited as e:
+        if quota:
+            quota.exhaust(e.wait)
+        raise
+    if quota:
+        quota.update(result)
+    return result
 
 
+def make_cached_get_call(url, headers, priority=READ):
+    """
+    GET through the response cache. Cached responses are always revalidated
+    with If-None-Match/If-Modified-Since; Github's 304s don't use up rate
+    limit. When the token's budget is too low for `priority`, a stale cached
+    response is served instead of calling Github.
+    """
+    headers = headers or {}
+    token = headers.get('Authorization', '')
+    cached = response_cache.get(token, url)
+    quota = TokenQuota.for_headers(headers)
+    if cached and quota and not quota.allows(priority):
+        response_cache.record('stale')
+        return cached.to_response()
+
+    if cached:
+        headers = dict(headers, **cached.conditional_headers())
+    result = make_github_call('GET', url, headers, priority=priority,
+                              quota=quota)
+    if cached and result.status_code == status.HTTP_304_NOT_MODIFIED:
+        response_cache.record('revalidated')
+        return cached.to_response()
+
+    response_cache.record('miss')
+    if CachedResponse.is_cacheable(result):
+        response_cache.set(token, url, result)
+    return result
+
+
+@timed_github_call
 def get_franklin_config(site, user):
     url = build_repos_url(site.owner.name, site.name, 'contents/.franklin.yml')
     # TODO - This will fetch the file from the default master branch
     headers = get_auth_header(user)
-    config_metadata = make_rest_get_call(url, headers)
+    config_metadata = make_cached_get_call(url, headers)
 
     if status.is_success(config_metadata.status_code):
         download_url = config_metadata.json().get('download_url', None)
-        config_payload = make_rest_get_call(download_url, None)
+        config_payload = make_cached_get_call(download_url, None)
         if status.is_success(config_payload.status_code):
             # TODO - validation and cleanup needed here similar to:
             # http://stackoverflow.com/a/22231372
@@ -57,6 +126,7 @@ def get_franklin_config(site, user):
     return config_metadata
 
 
+@timed_github_call
 def create_repo_deploy_key(site, user):
     # TODO - check for existing and update if needed (or skip)
     url = build_repos_url(site.owner.name, site.name, 'keys')
@@ -66,18 +136,20 @@ def create_repo_deploy_key(site, user):
         'key': site.deploy_key,
         'read_only': True
     }
-    return make_rest_post_call(url, headers, body)
+    return make_github_call('POST', url, headers, body, priority=WRITE)
 
 
+@timed_github_call
 def delete_deploy_key(site, user):
     if site.deploy_key_id:
         endpoint = 'keys/' + site.deploy_key_id
         url = build_repos_url(site.owner.name, site.name, endpoint)
         headers = get_auth_header(user)
-        return make_rest_delete_call(url, headers)
+        return make_github_call('DELETE', url, headers, priority=WRITE)
     return None
 
 
+@timed_github_call
 def create_repo_webhook(site, user):
     # TODO - check for existing webhook and update if needed (or skip)
     url = build_repos_url(site.owner.name, site.name, 'hooks')
@@ -92,18 +164,20 @@ def create_repo_webhook(site, user):
             'secret': os.environ['GITHUB_SECRET']
         }
     }
-    return make_rest_post_call(url, headers, body)
+    return make_github_call('POST', url, headers, body, priority=WRITE)
 
 
+@timed_github_call
 def delete_webhook(site, user):
     if site.webhook_id:
         endpoint = 'hooks/' + site.webhook_id
         url = build_repos_url(site.owner.name, site.name, endpoint)
         headers = get_auth_header(user)
-        return make_rest_delete_call(url, headers)
+        return make_github_call('DELETE', url, headers, priority=WRITE)
     return None
 
 
+@timed_github_call
 def get_access_token(request):
     """
     Converts a temporary auth token for an OAuth access token from Github
@@ -122,67 +196,160 @@ def get_access_token(request):
     return make_rest_post_call(url, headers, params)
 
 
+@timed_github_call
 def get_user_orgs(user):
-    url = 'https://api.github.com/user/orgs'
+    """ The user's orgs, or None unless every page was fetched """
+    url = build_api_url('user/orgs?per_page=100')
     headers = get_auth_header(user)
-    result = make_rest_get_call(url, headers)
-    if status.is_success(result.status_code):
-        return result.json()
-    return None
+    orgs = []
+    try:
+        for result in get_pages(url, headers):
+            orgs.extend(result.json())
+    except (BadRequest, RateLimited, ServiceUnavailable):
+        return None
+    return orgs
 
 
+def get_pages(url, headers):
+    """
+    Yields each page of a paginated Github listing, in order. A page that
+    fails raises like any other Github call, so a listing is never returned
+    with pages missing. When the first page links to the last one, the
+    remaining pages are fetched concurrently; otherwise 'next' links are
+    followed one by one.
+    """
+    result = make_cached_get_call(url, headers)
+    yield result
+
+    last = result.links.get('last')
+    if last:
+        urls = get_page_urls(last['url'])
+        if not urls:
+            return
+        workers = min(settings.GITHUB_PAGE_WORKERS, len(urls))
+        function = current_github_function()
+        timings = current_recording()
+
+        def get_page(page_url):
+            # Pool threads label and time their calls like the caller's
+            with github_function(function), recording(timings):
+                return make_cached_get_call(page_url, headers)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(get_page, page_url)
+                       for page_url in urls]
+            try:
+                # Hands pages back in order; result() raises a page's error
+                for future in futures:
+                    yield future.result()
+            finally:
+                # Pages nobody will read after a failure are not fetched
+                for future in futures:
+                    future.cancel()
+    else:
+        while result.links.get('next'):
+            result = make_cached_get_call(result.links['next']['url'],
+                                          headers)
+            yield result
+
+
+def get_page_urls(last_url):
+    """ Urls for pages 2 through N, given the url of page N """
+    parsed = urlparse(last_url)
+    query = parse_qs(parsed.query)
+    last_page = int(query.get('page', ['1'])[0])
+    urls = []
+    for page in range(2, last_page + 1):
+        query['page'] = [str(page)]
+        urls.append(urlunparse(
+            parsed._replace(query=urlencode(query, doseq=True))))
+    return urls
+
+
+@timed_github_call
 def get_all_repos(user):
-    url = 'https://api.github.com/user/repos?per_page=100'
+    url = build_api_url('user/repos?per_page=100')
     headers = get_auth_header(user)
-    have_next_page = True
     repos = []
     whitelist = os.environ.get('OWNER_WHITELIST', None)
-
-    while have_next_page:
-        result = None
-        have_next_page = False  # when in doubt, leave the loop after 1
-        result = make_rest_get_call(url, headers)
-        if status.is_success(result.status_code):
-            # Add all of the repos to our list
-            for repo in result.json():
-                owner = repo.get('owner', {}).get('login', '')
-                if not whitelist or owner in whitelist.split(','):
-                    repos.append(repo)
-
-            # If the header has a paging link called 'next', update our url
-            # and continue with the while loop
-            if result.links and result.links.get('next', None):
-                url = result.links['next']['url']
-                have_next_page = True
+    owners = whitelist.split(',') if whitelist else None
+
+    for result in get_pages(url, headers):
+        # Add all of the repos on this page to our list
+        for repo in result.json():
+            owner = repo.get('owner', {}).get('login', '')
+            if not owners or owner in owners:
+                repos.append(repo)
     return repos
 
 
-def get_repo(owner, repo, user):
+@timed_github_call
+def get_repo(owner, repo, user, priority=READ):
     url = build_repos_root_url(owner, repo)
     headers = get_auth_header(user)
-    return make_rest_get_call(url, headers)
+    return make_cached_get_call(url, headers, priority)
 
 
-def get_default_branch(site, user):
-    result = get_repo(site.owner.name, site.name, user)
+def get_default_branch(site, user, priority=READ):
+    result = get_repo(site.owner.name, site.name, user, priority)
 
     if status.is_success(result.status_code):
         return result.json().get('default_branch', None)
     return ''
 
 
-def get_repo_permissions(owner, repo, user):
-    result = get_repo(owner, repo, user)
+def get_request_repo(request, owner, repo):
+    """ get_repo for request.user, memoized for the lifetime of the request
+    """
+    repos = getattr(request, '_github_repos', None)
+    if repos is None:
+        repos = request._github_repos = {}
+    key = (owner.lower(), repo.lower())
+    if key not in repos:
+        repos[key] = get_repo(owner, repo, request.user)
+    return repos[key]
 
-    if status.is_success(result.status_code):
-        return result.json().get('permissions', None)
-    return ''
+
+def get_permissions_key(user, owner, repo):
+    generation = cache.get('repo-perms-generation:{0}'.format(user.id), 0)
+    return 'repo-perms:{0}:{1}:{2}/{3}'.format(
+        user.id, generation, owner.lower(), repo.lower())
+
+
+def get_repo_permissions(owner, repo, user, request=None):
+    """ The user's permissions on a repo. Cached, briefly when the user is
+    not an admin so that newly granted access shows up quickly.
+    """
+    key = get_permissions_key(user, owner, repo)
+    permissions = cache.get(key)
+    if permissions is None:
+        if request:
+            result = get_request_repo(request, owner, repo)
+        else:
+            result = get_repo(owner, repo, user)
+        permissions = {}
+        if status.is_success(result.status_code):
+            permissions = result.json().get('permissions', None) or {}
+        if permissions.get('admin', False):
+            timeout = settings.GITHUB_PERMISSIONS_TIMEOUT
+        else:
+            timeout = settings.GITHUB_PERMISSIONS_NEGATIVE_TIMEOUT
+        cache.set(key, permissions, timeout)
+    return permissions
+
+
+def invalidate_repo_permissions(user):
+    """ Forgets every cached repo permission for the user """
+    key = 'repo-perms-generation:{0}'.format(user.id)
+    cache.add(key, 0, None)
+    cache.incr(key)
 
 
-def get_branch_details(site, user, branch):
+@timed_github_call
+def get_branch_details(site, user, branch, priority=READ):
     url = build_repos_url(site.owner.name, site.name, 'branches/' + branch)
     headers = get_auth_header(user)
-    result = make_rest_get_call(url, headers)
+    result = make_cached_get_call(url, headers, priority)
     if (status.is_success(result.status_code) and
             result.json().get('commit', None)):
         return result.json()['commit'].get('sha', None)
@@ -0,0 +1,105 @@
+import logging
+import threading
+from collections import defaultdict
+
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from core.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class CachedResponse(object):
+    """ The parts of a successful Github GET response needed to replay it,
+    plus the validators used to revalidate it with a conditional request.
+    """
+    def __init__(self, response):
+        self.url = response.url
+        self.content = response.content
+        self.headers = dict(response.headers)
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+
+    @classmethod
+    def is_cacheable(cls, response):
+        return (response.status_code == 200 and
+                (isinstance(response.headers.get('ETag'), str) or
+                 isinstance(response.headers.get('Last-Modified'), str)))
+
+    @property
+    def size(self):
+        """ Rough bytes held, see GITHUB_CACHE_BYTES """
+        return len(self.content) + sum(
+            len(name) + len(value) for name, value in self.headers.items())
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def to_response(self):
+        response = Response()
+        response.status_code = 200
+        response.url = self.url
+        response._content = self.content
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        return response
+
+
+class ConditionalCache(object):
+    """ Per-process cache of Github GET responses keyed by (token, url),
+    bounded by the bytes it holds. Responses are always revalidated, since
+    Github's max-age would let changed permissions or branches be served for
+    a minute. Tracks how lookups were served:
+
+    revalidated: Github answered 304 Not Modified (free of rate limit)
+    miss: a full response was fetched
+    stale: served without asking Github because the token's rate limit is
+           running low
+
+    :param max_bytes: Least recently used responses are dropped beyond this
+    """
+    RESULTS = ('revalidated', 'miss', 'stale')
+    LOG_EVERY = 500
+
+    def __init__(self, max_bytes):
+        self._entries = LRUCache(max_size=max_bytes,
+                                 sizeof=lambda cached: cached.size)
+        self._counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def get(self, token, url):
+        return self._entries.get((token, url))
+
+    def set(self, token, url, response):
+        self._entries.set((token, url), CachedResponse(response))
+
+    def clear(self):
+        self._entries.clear()
+        with self._lock:
+            self._counts.clear()
+
+    def record(self, result):
+        with self._lock:
+            self._counts[result] += 1
+            total = sum(self._counts.values())
+        if total % self.LOG_EVERY == 0:
+            logger.info('Github response cache: %s', ', '.join(
+                '{0} {1:.1%}'.format(name, rate)
+                for name, rate in self.stats()['rates'].items()))
+
+    def stats(self):
+        with self._lock:
+            counts = {name: self._counts[name] for name in self.RESULTS}
+        total = sum(counts.values())
+        return {
+            'counts': counts,
+            'rates': {name: count / total if total else 0.0
+                      for name, count in counts.items()},
+        }
@@ -27,10 +27,11 @@ class GithubOnly(permissions.BasePermission):
 class UserHasProjectWritePermission(permissions.BasePermission):
     """ Security Check - User is an admin for the project; can create/delete"""
 
-    def check_perms(self, user, repo, owner):
+    def check_perms(self, user, repo, owner, request=None):
         if user and repo and owner:
-            # Call github and confirm user is an admin for this project
-            perms = get_repo_permissions(owner, repo, user)
+            # Call github (or the cache) and confirm user is an admin for
+            # this project
+            perms = get_repo_permissions(owner, repo, user, request)
             if perms.get('admin', False):
                 return True
         return False
@@ -42,10 +43,12 @@ class UserHasProjectWritePermission(permissions.BasePermission):
         try:
             if request.method == 'POST':
                 obj = request.data['github'].split('/')
-                return self.check_perms(request.user, obj[1], obj[0])
+                return self.check_perms(request.user, obj[1], obj[0],
+                                        request)
             elif request.method == 'DELETE':
                 obj = Site.objects.get(github_id=view.kwargs['repo'])
-                return self.check_perms(request.user, obj.name, obj.owner.name)
+                return self.check_perms(request.user, obj.name,
+                                        obj.owner.name, request)
         except (KeyError, IndexError):
             raise BadRequest()
         except Site.DoesNotExist as e:
@@ -53,7 +56,8 @@ class UserHasProjectWritePermission(permissions.BasePermission):
         return False
 
     def has_object_permission(self, request, view, site):
-        return self.check_perms(request.user, site.name, site.owner.name)
+        return self.check_perms(request.user, site.name, site.owner.name,
+                                request)
 
 
 class IsWhitelistedProject(permissions.BasePermission):
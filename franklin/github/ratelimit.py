@@ -0,0 +1,76 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from core.models import OAuthToken
+
+logger = logging.getLogger(__name__)
+
+# Priorities of Github calls, see GITHUB_RATELIMIT_RESERVE
+WRITE = 'write'
+READ = 'read'
+COSMETIC = 'cosmetic'
+
+
+class TokenQuota(object):
+    """ What is left of an OAuth token's Github rate limit, as last reported
+    by Github. Kept in the shared cache so every worker schedules against
+    the same budget; each response overwrites it with Github's own numbers.
+
+    :param authorization: Authorization header carrying the token
+    """
+    def __init__(self, authorization):
+        self.key = 'github-quota:{0}'.format(
+            OAuthToken.digest_for(authorization))
+
+    @classmethod
+    def for_headers(cls, headers):
+        authorization = (headers or {}).get('Authorization')
+        return cls(authorization) if authorization else None
+
+    def get(self):
+        """ (remaining, reset) or None if unknown or already reset """
+        state = cache.get(self.key)
+        if state is None or state[1] <= time.time():
+            return None
+        return state
+
+    def allows(self, priority):
+        """ Whether a call of `priority` may spend from the budget now """
+        state = self.get()
+        if state is None:
+            return True
+        return state[0] > settings.GITHUB_RATELIMIT_RESERVE[priority]
+
+    def wait(self):
+        """ Seconds until the budget is reset """
+        state = self.get()
+        return max(int(state[1] - time.time()), 1) if state else None
+
+    def update(self, response):
+        try:
+            remaining = int(response.headers['X-RateLimit-Remaining'])
+            reset = int(response.headers['X-RateLimit-Reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+        self._set(remaining, reset)
+
+    def exhaust(self, wait):
+        """ Github refused a call; nothing more can be spent for `wait`
+        seconds
+        """
+        if wait:
+            reset = time.time() + wait
+        else:
+            state = self.get()
+            if state is None:
+                return
+            reset = state[1]
+        logger.warning('Github rate limit exhausted until %d', reset)
+        self._set(0, int(reset))
+
+    def _set(self, remaining, reset):
+        cache.set(self.key, (remaining, reset),
+                  max(int(reset - time.time()), 1))
@@ -1,7 +1,8 @@
 import logging
+
 from rest_framework import serializers
 
-from builder.models import BranchBuild, Owner, Site
+from builder.models import Owner, Site
 
 logger = logging.getLogger(__name__)
 
@@ -82,11 +83,12 @@ class GithubWebhookSerializer(serializers.Serializer):
     def create_build_and_deploy(self):
         site = self.get_existing_site()
         git_hash = self.get_event_hash()
-        branch = self.get_change_location().split('/')[2]
+        location = self.get_change_location()
+        # Branch pushes reference refs/heads/<branch>; tags are bare names
+        branch = location if self.is_tag_event() else location.split('/')[2]
+        builds = []
         if site:
-            environment = site.get_deployable_environment(
-                self.get_change_location(), self.is_tag_event())
-            if environment:
-                build = BranchBuild.objects.create(
-                    git_hash=git_hash, branch=branch, site=site)
-                build.deploy(environment)
+            for environment in site.get_deployable_environments(
+                    location, self.is_tag_event()):
+                builds.append(environment.queue_build(git_hash, branch))
+        return builds
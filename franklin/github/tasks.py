@@ -0,0 +1,41 @@
+import logging
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from .api import delete_deploy_key, delete_webhook
+from builder.models import Site
+from core.exceptions import BadRequest
+
+logger = logging.getLogger(__name__)
+
+
+def teardown_site(site_id, user_id):
+    """ Background job: removes a deactivated site's webhook and deploy key
+    from Github, then its build history and the site itself. Github outages
+    raise ServiceUnavailable, which the job queue retries with backoff.
+    """
+    try:
+        site = Site.objects.select_related('owner').get(id=site_id)
+    except Site.DoesNotExist:
+        return
+    if site.is_active:
+        logger.info('Site %s was reactivated, skipping teardown', site)
+        return
+    user = get_user_model().objects.get(id=user_id)
+
+    # Forget each Github resource once it's gone so a retry skips it
+    for remove, field in ((delete_webhook, 'webhook_id'),
+                          (delete_deploy_key, 'deploy_key_id')):
+        if getattr(site, field):
+            try:
+                remove(site, user)
+            except BadRequest:
+                # Already removed on Github, or the user lost access to it
+                logger.warning('Could not remove %s %s for %s', field,
+                               getattr(site, field), site)
+            setattr(site, field, None)
+            site.save(update_fields=[field])
+
+    site.delete_history(settings.SITE_TEARDOWN_BATCH_SIZE)
+    site.delete()
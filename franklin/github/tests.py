@@ -1,14 +1,30 @@
+import base64
 from datetime import datetime
 import json
+import time
 
 from unittest.mock import Mock, patch
+from uuid import UUID
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
+from requests.models import Response
 from rest_framework.test import APITestCase
 
-from builder.models import BranchBuild, Build, Deploy, Environment, Owner, Site
+from .api import create_repo_deploy_key, get_all_repos, get_repo, \
+    get_repo_permissions, invalidate_repo_permissions, response_cache
+from .cache import ConditionalCache
+from .ratelimit import COSMETIC
+from .tasks import teardown_site
+from builder.models import BranchBuild, Build, Deploy, Environment, Owner, \
+    RouteChange, Site
+from core.exceptions import RateLimited, ServiceUnavailable
+from core.instrumentation import start_recording, stop_recording
+from core.models import Job
 
 
 def ordered(obj):
@@ -35,6 +51,7 @@ class v1ContractTestCase(APITestCase):
     """
 
     def setUp(self):
+        cache.clear()
         self.user = User.objects.create_user(username="testuser", password="a")
 
         token = 'abc123'
@@ -64,7 +81,7 @@ class v1ContractTestCase(APITestCase):
         self.assertEqual(expected, response.data)
 
     @patch('github.views.do_auth')
-    @patch('core.helpers.requests.post')
+    @patch('core.helpers.client.post')
     def test_post_auth_github(self, mock_post, mock_auth):
         """ Complete auth with temp token. Retrieve oAuth token  """
         url = '/v1/auth/github/'
@@ -97,7 +114,7 @@ class v1ContractTestCase(APITestCase):
 
         self.assertEqual(expected, response.data)
 
-    @patch('core.helpers.requests.get')
+    @patch('core.helpers.client.get')
     def test_get_users_repos(self, mock_get):
         """ Get repos from github that the user has access to """
         url = '/v1/repos/'
@@ -106,7 +123,7 @@ class v1ContractTestCase(APITestCase):
         expected = get_mock_data('github', 'get_repos')
 
         # get list of repos from github
-        get_repos = Mock(status_code=200)
+        get_repos = Mock(status_code=200, links={})
         get_repos.json.return_value = expected
         mock_get.return_value = get_repos
 
@@ -114,8 +131,42 @@ class v1ContractTestCase(APITestCase):
 
         self.assertEqual(expected, response.data)
 
-    @patch('core.helpers.requests.post')
-    @patch('core.helpers.requests.get')
+    @patch('core.helpers.client.get')
+    def test_get_users_repos_paged(self, mock_get):
+        """ Repos are paged in the order Github lists them """
+        expected = list(reversed(get_mock_data('github', 'get_repos')))
+        get_repos = Mock(status_code=200, links={})
+        get_repos.json.return_value = expected
+        mock_get.return_value = get_repos
+
+        url = '/v1/repos/?page_size=4'
+        seen = []
+        while url:
+            response = self.client.get(url, **self.header)
+            seen.extend(response.data)
+            url = response.has_header('Link') and \
+                response['Link'].split(';')[0].strip('<>')
+        self.assertEqual(expected, seen)
+
+    @patch('core.helpers.client.get')
+    def test_get_users_repos_cursor_repo_gone(self, mock_get):
+        """ Paging resumes where the cursor's repo was once it is no
+        longer listed
+        """
+        repos = get_mock_data('github', 'get_repos')
+        get_repos = Mock(status_code=200, links={})
+        get_repos.json.return_value = repos
+        mock_get.return_value = get_repos
+
+        response = self.client.get('/v1/repos/?page_size=2', **self.header)
+        self.assertEqual(response.data, repos[:2])
+        get_repos.json.return_value = repos[:1] + repos[2:]
+        response = self.client.get(
+            response['Link'].split(';')[0].strip('<>'), **self.header)
+        self.assertEqual(response.data, repos[2:4])
+
+    @patch('core.helpers.client.post')
+    @patch('core.helpers.client.get')
     def test_post_projects(self, mock_get, mock_post):
         """ Register a project """
         url = '/v1/projects/'
@@ -138,14 +189,14 @@ class v1ContractTestCase(APITestCase):
 
         self.assertEqual(ordered(expected), ordered(response.data))
 
-    @patch('core.helpers.requests.get')
+    @patch('core.helpers.client.get')
     def test_get_projects(self, mock_get):
         """ List of registered projects """
         url = '/v1/projects/'
         self.assertEqual(reverse('project_list'), url)
 
         # users orgs from github
-        get_repo = Mock(status_code=200)
+        get_repo = Mock(status_code=200, links={})
         get_repo.json.return_value = get_mock_data('github', 'get_user_orgs')
         mock_get.return_value = get_repo
 
@@ -154,8 +205,8 @@ class v1ContractTestCase(APITestCase):
 
         self.assertEqual(ordered(expected), ordered(response.data))
 
-    @patch('core.helpers.requests.get')
-    @patch('core.helpers.requests.delete')
+    @patch('core.helpers.client.get')
+    @patch('core.helpers.client.delete')
     def test_delete_project(self, mock_delete, mock_get):
         """ Delete a project that is already registered """
         url = '/v1/projects/45864453'
@@ -172,7 +223,7 @@ class v1ContractTestCase(APITestCase):
         response = self.client.delete(url, **self.header)
         self.assertEqual(204, response.status_code)
 
-    @patch('core.helpers.requests.get')
+    @patch('core.helpers.client.get')
     def test_get_project_details(self, mock_get):
         """ Returns details for a project that is registered """
         url = '/v1/projects/45864453'
@@ -189,8 +240,8 @@ class v1ContractTestCase(APITestCase):
 
         self.assertEqual(ordered(expected), ordered(response.data))
 
-    @patch('core.helpers.requests.post')
-    @patch('core.helpers.requests.get')
+    @patch('core.helpers.client.post')
+    @patch('core.helpers.client.get')
     def test_deploy_project(self, mock_get, mock_post):
         """ Attempts to deploy the latest commit for the project """
         url = '/v1/projects/45864453/builds'
@@ -246,3 +297,386 @@ class v1ContractTestCase(APITestCase):
         response = self.client.post(url, {"uuid": build.uuid}, **self.header)
 
         self.assertEqual(201, response.status_code)
+
+
+def make_response(status_code, body=b'', headers=None):
+    response = Response()
+    response.status_code = status_code
+    response._content = body
+    response.headers.update(headers or {})
+    return response
+
+
+class ResponseCacheTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        response_cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="a")
+        social = self.user.social_auth.create(provider='github', uid=123)
+        social.extra_data['access_token'] = 'abc123'
+        social.save()
+        self.body = json.dumps(get_mock_data('github', 'get_repo')).encode()
+
+    @patch('core.helpers.client.get')
+    def test_revalidated(self, mock_get):
+        """ A 304 from github replays the cached body """
+        mock_get.side_effect = [
+            make_response(200, self.body, {'ETag': '"abc"'}),
+            make_response(304),
+        ]
+        first = get_repo('isl', 'foo', self.user)
+        second = get_repo('isl', 'foo', self.user)
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(
+            mock_get.call_args[1]['headers']['If-None-Match'], '"abc"')
+        self.assertEqual(response_cache.stats()['counts']['revalidated'], 1)
+
+    @patch('core.helpers.client.get')
+    def test_always_revalidated(self, mock_get):
+        """ Responses within their max-age are still revalidated """
+        mock_get.side_effect = [
+            make_response(200, self.body, {
+                'ETag': '"abc"', 'Cache-Control': 'private, max-age=60'}),
+            make_response(304),
+        ]
+        get_repo('isl', 'foo', self.user)
+        result = get_repo('isl', 'foo', self.user)
+        self.assertEqual(result.json()['name'], 'foo')
+        self.assertEqual(mock_get.call_count, 2)
+
+    def test_bounded_by_bytes(self):
+        """ The least recently used responses go once the cache holds more
+        than its size in bytes
+        """
+        responses = ConditionalCache(max_bytes=len(self.body) * 3 // 2)
+        responses.set('token', 'a', make_response(200, self.body,
+                                                  {'ETag': '"a"'}))
+        responses.set('token', 'b', make_response(200, self.body,
+                                                  {'ETag': '"b"'}))
+        self.assertIsNone(responses.get('token', 'a'))
+        self.assertEqual(responses.get('token', 'b').etag, '"b"')
+
+
+class RepoPagingTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="a")
+        social = self.user.social_auth.create(provider='github', uid=123)
+        social.extra_data['access_token'] = 'abc123'
+        social.save()
+        self.url = 'https://api.github.com/user/repos?per_page=100'
+
+    def page(self, number, links=None):
+        result = Mock(status_code=200, links=links or {})
+        result.json.return_value = [
+            {'id': number, 'owner': {'login': 'isl'}},
+            {'id': number * 10, 'owner': {'login': 'other'}},
+        ]
+        return result
+
+    @patch('core.helpers.client.get')
+    def test_pages_in_order(self, mock_get):
+        """ Pages after the first are fetched from the 'last' link and
+        returned in page order, filtered by the whitelist """
+        pages = {
+            self.url: self.page(1, {'last': {'url': self.url + '&page=3'}}),
+            self.url + '&page=2': self.page(2),
+            self.url + '&page=3': self.page(3),
+        }
+        mock_get.side_effect = lambda url, **kwargs: pages[url]
+        with patch.dict('os.environ', {'OWNER_WHITELIST': 'isl'}):
+            repos = get_all_repos(self.user)
+        self.assertEqual([repo['id'] for repo in repos], [1, 2, 3])
+
+    @patch('core.helpers.client.get')
+    def test_pages_timed(self, mock_get):
+        """ Pages fetched by the pool count towards the request's upstream
+        timings """
+        pages = {
+            self.url: self.page(1, {'last': {'url': self.url + '&page=3'}}),
+            self.url + '&page=2': self.page(2),
+            self.url + '&page=3': self.page(3),
+        }
+        mock_get.side_effect = lambda url, **kwargs: pages[url]
+        timings = start_recording()
+        try:
+            with patch.dict('os.environ', {'OWNER_WHITELIST': ''}):
+                get_all_repos(self.user)
+        finally:
+            stop_recording()
+        self.assertEqual(timings.calls['api.github.com'][0], 3)
+
+    @patch('core.helpers.client.get')
+    def test_failed_page_raises(self, mock_get):
+        """ A failed page fails the listing instead of leaving a hole """
+        failed = Mock(status_code=502, links={})
+        pages = {
+            self.url: self.page(1, {'last': {'url': self.url + '&page=3'}}),
+            self.url + '&page=2': failed,
+            self.url + '&page=3': self.page(3),
+        }
+        mock_get.side_effect = lambda url, **kwargs: pages[url]
+        with patch.dict('os.environ', {'OWNER_WHITELIST': 'isl'}):
+            with self.assertRaises(ServiceUnavailable):
+                get_all_repos(self.user)
+
+    @patch('core.helpers.client.get')
+    def test_follows_next(self, mock_get):
+        """ Without a 'last' link, 'next' links are followed """
+        mock_get.side_effect = [
+            self.page(1, {'next': {'url': self.url + '&page=2'}}),
+            self.page(2),
+        ]
+        with patch.dict('os.environ', {'OWNER_WHITELIST': ''}):
+            repos = get_all_repos(self.user)
+        self.assertEqual([repo['id'] for repo in repos], [1, 10, 2, 20])
+
+
+class SiteTeardownTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="a")
+        social = self.user.social_auth.create(provider='github', uid=123)
+        social.extra_data['access_token'] = 'abc123'
+        social.save()
+        self.header = {'HTTP_AUTHORIZATION': 'Bearer abc123'}
+
+        owner = Owner.objects.create(name='isl', github_id=607333)
+        self.site = Site.objects.create(
+            owner=owner, name='foo', github_id=45864453, deploy_key='key',
+            webhook_id='11', deploy_key_id='22')
+        env = Environment.objects.create(site=self.site, name='Staging',
+                                         url='foo-staging.example.com')
+        for i in range(3):
+            build = BranchBuild.objects.create(
+                site=self.site, branch='master', status=Build.SUCCESS,
+                git_hash='abc{}'.format(i))
+            Deploy.objects.create(build=build, environment=env)
+
+    @patch('core.helpers.client.get')
+    def test_delete_deactivates(self, mock_get):
+        """ Deleting a project only deactivates it and queues the teardown """
+        get_repo = Mock(status_code=200)
+        get_repo.json.return_value = get_mock_data('github', 'get_repo')
+        mock_get.return_value = get_repo
+
+        response = self.client.delete('/v1/projects/45864453', **self.header)
+        self.assertEqual(204, response.status_code)
+        self.site.refresh_from_db()
+        self.assertFalse(self.site.is_active)
+        self.assertTrue(Job.objects.filter(
+            task='github.tasks.teardown_site').exists())
+
+    @patch('core.helpers.client.delete')
+    def test_teardown(self, mock_delete):
+        """ The teardown job removes github resources, then the site """
+        mock_delete.return_value = Mock(status_code=204)
+        Site.objects.filter(id=self.site.id).update(is_active=False)
+        with self.settings(SITE_TEARDOWN_BATCH_SIZE=2):
+            teardown_site(self.site.id, self.user.id)
+        self.assertEqual(mock_delete.call_count, 2)
+        self.assertFalse(Site.objects.filter(id=self.site.id).exists())
+        self.assertFalse(Build.objects.exists())
+        self.assertFalse(Deploy.objects.exists())
+
+    def test_delete_history_routes(self):
+        """ Each batch records one route change per environment it touched,
+        not one per deploy
+        """
+        env = Environment.objects.get(site=self.site)
+        current = env.current_build
+        version = RouteChange.latest_version()
+        self.site.delete_history(2)
+        changes = RouteChange.objects.filter(id__gt=version).order_by('id')
+        # The first batch leaves the current build in place
+        self.assertEqual([(change.url, change.path) for change in changes],
+                         [(env.url, current.path), (env.url, None)])
+
+
+class ProjectListQueriesTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="a")
+        social = self.user.social_auth.create(provider='github', uid=123)
+        social.extra_data['access_token'] = 'abc123'
+        social.save()
+        self.header = {'HTTP_AUTHORIZATION': 'Bearer abc123'}
+        self.owner = Owner.objects.create(name='isl', github_id=607333)
+
+    def add_site(self, github_id):
+        site = Site.objects.create(owner=self.owner, name=str(github_id),
+                                   github_id=github_id, deploy_key='key')
+        for i in range(2):
+            BranchBuild.objects.create(site=site, branch='master',
+                                       git_hash='abc{}'.format(i))
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/v1/projects/', **self.header)
+        self.assertEqual(200, response.status_code)
+        return len(queries), response
+
+    @patch('core.helpers.client.get')
+    def test_constant_queries(self, mock_get):
+        """ Listing projects costs the same number of queries for any number
+        of sites """
+        get_orgs = Mock(status_code=200, links={})
+        get_orgs.json.return_value = get_mock_data('github', 'get_user_orgs')
+        mock_get.return_value = get_orgs
+
+        self.add_site(1)
+        self.count_queries()  # warm up per-worker caches
+        one_site, response = self.count_queries()
+        for github_id in range(2, 7):
+            self.add_site(github_id)
+        many_sites, response = self.count_queries()
+
+        self.assertEqual(len(response.data), 6)
+        self.assertEqual(one_site, many_sites)
+        self.assertTrue(all(site['build'] for site in response.data))
+
+
+class RepoPermissionsCacheTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="a")
+        social = self.user.social_auth.create(provider='github', uid=123)
+        social.extra_data['access_token'] = 'abc123'
+        social.save()
+
+    @patch('core.helpers.client.get')
+    def test_cached_until_invalidated(self, mock_get):
+        """ Permission checks are cached per user and repo until the user's
+        repos are refreshed """
+        get_repo = Mock(status_code=200)
+        get_repo.json.return_value = get_mock_data('github', 'get_repo')
+        mock_get.return_value = get_repo
+
+        self.assertTrue(get_repo_permissions('isl', 'foo', self.user)['admin'])
+        self.assertTrue(get_repo_permissions('isl', 'foo', self.user)['admin'])
+        self.assertEqual(mock_get.call_count, 1)
+
+        invalidate_repo_permissions(self.user)
+        get_repo_permissions('isl', 'foo', self.user)
+        self.assertEqual(mock_get.call_count, 2)
+
+
+class BuildPaginationTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="a")
+        social = self.user.social_auth.create(provider='github', uid=123)
+        social.extra_data['access_token'] = 'abc123'
+        social.save()
+        self.header = {'HTTP_AUTHORIZATION': 'Bearer abc123'}
+
+        owner = Owner.objects.create(name='isl', github_id=607333)
+        self.site = Site.objects.create(
+            owner=owner, name='foo', github_id=45864453, deploy_key='key')
+        self.add_builds(5)
+
+    def add_builds(self, count):
+        for i in range(count):
+            BranchBuild.objects.create(site=self.site, branch='master',
+                                       git_hash='abc{}'.format(i))
+
+    def test_follow_cursor(self):
+        """ Pages are linked by cursor, newest first, and rows inserted
+        while paging neither repeat nor shift later pages """
+        url = '/v1/projects/45864453/builds?page_size=2'
+        seen = []
+        while url:
+            response = self.client.get(url, **self.header)
+            self.assertEqual(200, response.status_code)
+            self.assertLessEqual(len(response.data), 2)
+            seen.extend(UUID(build['uuid']) for build in response.data)
+            if not response.has_header('Link'):
+                break
+            url = response['Link'].split(';')[0].strip('<>')
+            self.add_builds(1)
+
+        expected = BranchBuild.objects.order_by('created', 'id')[:5]
+        self.assertEqual(seen, [build.uuid for build in reversed(expected)])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/v1/projects/45864453/builds?cursor=xx',
+                                   **self.header)
+        self.assertEqual(400, response.status_code)
+
+    def test_tampered_cursor(self):
+        """ Cursor values of the wrong type are refused, not a 500 """
+        for values in (['garbage', 1], [datetime.now().isoformat(), 'abc'],
+                       [{}, 1]):
+            cursor = base64.urlsafe_b64encode(
+                json.dumps(values).encode()).decode('ascii')
+            response = self.client.get(
+                '/v1/projects/45864453/builds?cursor=' + cursor,
+                **self.header)
+            self.assertEqual(400, response.status_code)
+
+
+class RateLimitTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        response_cache.clear()
+        # The exhausted quotas must not leak into other tests
+        self.addCleanup(cache.clear)
+        self.addCleanup(response_cache.clear)
+        self.user = User.objects.create_user(username="testuser", password="a")
+        social = self.user.social_auth.create(provider='github', uid=123)
+        social.extra_data['access_token'] = 'abc123'
+        social.save()
+        self.owner = Owner.objects.create(name='isl', github_id=607333)
+        self.site = Site.objects.create(owner=self.owner, name='foo',
+                                        github_id=45864453, deploy_key='key')
+        self.body = json.dumps(get_mock_data('github', 'get_repo')).encode()
+        self.reset = str(int(time.time()) + 600)
+
+    @patch('core.helpers.client.get')
+    def test_stale_when_low(self, mock_get):
+        """ Cosmetic reads make do with the cache once the budget is low """
+        mock_get.return_value = make_response(200, self.body, {
+            'ETag': '"abc"', 'X-RateLimit-Remaining': '500',
+            'X-RateLimit-Reset': self.reset})
+        get_repo('isl', 'foo', self.user)
+        result = get_repo('isl', 'foo', self.user, COSMETIC)
+        self.assertEqual(result.json()['name'], 'foo')
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(response_cache.stats()['counts']['stale'], 1)
+
+        # Reads still go to Github
+        get_repo('isl', 'foo', self.user)
+        self.assertEqual(mock_get.call_count, 2)
+
+    @patch('core.helpers.client.post')
+    @patch('core.helpers.client.get')
+    def test_exhausted(self, mock_get, mock_post):
+        """ Once Github refuses a token, calls fail with a 429 until the
+        reset, without calling Github
+        """
+        mock_get.return_value = make_response(403, b'{}', {
+            'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': self.reset})
+        with self.assertRaises(RateLimited) as raised:
+            get_repo('isl', 'foo', self.user)
+        self.assertEqual(raised.exception.status_code, 429)
+        self.assertGreater(raised.exception.wait, 500)
+
+        with self.assertRaises(RateLimited):
+            get_repo('isl', 'foo', self.user)
+        with self.assertRaises(RateLimited):
+            create_repo_deploy_key(self.site, self.user)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertFalse(mock_post.called)
+
+    @patch('core.helpers.client.post')
+    @patch('core.helpers.client.get')
+    def test_writes_first(self, mock_get, mock_post):
+        """ The last requests of the budget are kept for writes """
+        mock_get.return_value = make_response(200, self.body, {
+            'X-RateLimit-Remaining': '5', 'X-RateLimit-Reset': self.reset})
+        mock_post.return_value = make_response(201, b'{"id": 1}')
+        get_repo('isl', 'foo', self.user)
+        with self.assertRaises(RateLimited):
+            get_repo('isl', 'foo', self.user)
+        create_repo_deploy_key(self.site, self.user)
+        self.assertTrue(mock_post.called)
@@ -1,28 +1,38 @@
 import logging
 import os
 
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, \
+    renderer_classes
 from rest_framework.exceptions import NotFound
 from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.status import HTTP_200_OK, HTTP_201_CREATED, \
-    HTTP_204_NO_CONTENT, HTTP_503_SERVICE_UNAVAILABLE
+    HTTP_202_ACCEPTED, HTTP_204_NO_CONTENT
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
 from .api import create_repo_deploy_key, create_repo_webhook, \
-    delete_deploy_key, delete_webhook, get_access_token, get_all_repos, \
-    get_repo
+    get_access_token, get_all_repos, get_request_repo
 from .permissions import GithubOnly, IsWhitelistedProject, \
     UserHasProjectWritePermission
 from .serializers import GithubWebhookSerializer, RepositorySerializer
-from builder.models import Build, BranchBuild, Deploy, Environment, Site
+from .tasks import teardown_site
+from builder.models import Build, BranchBuild, BuildEvent, Deploy, \
+    Environment, Site
 from builder.serializers import BranchBuildSerializer, FlatSiteSerializer, \
     SiteSerializer
+from builder.streams import EventStream, EventStreamRenderer, acquire_slot
+from builder.tasks import deploy_build
 from core.exceptions import BadRequest, BadResource, ResourceExists, \
     ServiceUnavailable
 from core.helpers import do_auth, validate_request_payload
+from core.jobs import enqueue
+from core.metrics import WEBHOOK_EVENTS
+from core.pagination import KeysetPagination
 from users.serializers import UserSerializer
 
 
@@ -39,9 +49,12 @@ class ProjectList(APIView):
                           IsWhitelistedProject)
 
     def get(self, request, format=None):
-        sites = request.user.details.get_user_repos()
+        paginator = KeysetPagination(fields=('id', ), descending=False)
+        sites = Site.prefetch_most_recent_builds(paginator.paginate_queryset(
+            request.user.details.get_user_repos(), request))
         site_serializer = FlatSiteSerializer(sites, many=True)
-        return Response(site_serializer.data, status=HTTP_200_OK)
+        return paginator.add_link_header(
+            Response(site_serializer.data, status=HTTP_200_OK))
 
     @validate_request_payload(['github', ])
     def post(self, request, format=None):
@@ -50,8 +63,9 @@ class ProjectList(APIView):
         if Site.objects.filter(name=repo, owner__name=owner).count() > 0:
             raise ResourceExists()
 
-        # New project, call github for the details
-        result = get_repo(owner, repo, request.user)
+        # New project, call github for the details (usually already fetched
+        # by the permission check)
+        result = get_request_repo(request, owner, repo)
         serializer = RepositorySerializer(data=result.json())
 
         if serializer and serializer.is_valid():
@@ -81,28 +95,27 @@ class ProjectDetail(APIView):
                           UserHasProjectWritePermission)
 
     def get(self, request, repo, format=None):
-        site = get_object_or_404(Site, github_id=repo)
+        environments = Environment.objects\
+                                  .select_related('current_build__branchbuild')
+        sites = Site.objects.select_related('owner').prefetch_related(
+            Prefetch('environments', queryset=environments))
+        site = get_object_or_404(sites, github_id=repo)
         serializer = SiteSerializer(site, context={'user': request.user})
         return Response(serializer.data, status=HTTP_200_OK)
 
     def delete(self, request, repo, format=None):
         site = get_object_or_404(Site, github_id=repo)
-        site.is_active = False
-        site.save()
         return delete_site(site, request.user)
 
 
 def delete_site(site, user):
-    # TODO - This should be an async process that is thrown into a queue. The
-    # site is no longer active, so the actual delete can occur lazily.
-    try:
-        delete_webhook(site, user)
-        delete_deploy_key(site, user)
-        site.delete()
-        return Response(status=HTTP_204_NO_CONTENT)
-    except:
-        logger.warn('webhook/deploy_key delete failed | %s | %s', user, site)
-        raise
+    """ Deactivates the site right away. Removing it from Github and deleting
+    its history happens later in a background job.
+    """
+    site.is_active = False
+    site.save()
+    enqueue(teardown_site, site_id=site.id, user_id=user.id)
+    return Response(status=HTTP_204_NO_CONTENT)
 
 
 @api_view(['GET'])
@@ -111,9 +124,13 @@ def deployable_repos(request):
     All repos from Github that the user has the permission level to deploy
     """
     if request.method == 'GET':
-        github_repos = get_all_repos(request.user)
+        # Every Github page is still fetched; only the response is paged
+        paginator = KeysetPagination(fields=('id', ), descending=False)
+        github_repos = paginator.paginate_list(
+            get_all_repos(request.user), request)
         serializer = RepositorySerializer(github_repos, many=True)
-        return Response(serializer.data, status=HTTP_200_OK)
+        return paginator.add_link_header(
+            Response(serializer.data, status=HTTP_200_OK))
 
 
 @api_view(['GET', 'POST'])
@@ -125,25 +142,50 @@ def builds(request, repo):
     site = get_object_or_404(Site, github_id=repo)
 
     if request.method == 'GET':
-        builds = BranchBuild.objects.filter(site=site).all()
+        paginator = KeysetPagination()
+        builds = paginator.paginate_queryset(
+            BranchBuild.objects.filter(site=site), request)
         serializer = BranchBuildSerializer(builds, many=True)
-        return Response(serializer.data, status=HTTP_200_OK)
+        return paginator.add_link_header(
+            Response(serializer.data, status=HTTP_200_OK))
     elif request.method == 'POST':
         branch, git_hash = site.get_newest_commit(request.user)
         env = site.environments.filter(name='Staging').first()
-        build = BranchBuild.objects.create(
-            git_hash=git_hash, branch=branch, site=site)
-        try:
-            build.deploy(env)
-        except ServiceUnavailable as e:
-            serializer = BranchBuildSerializer(build)
-            return Response({
-                'detail': e.detail,
-                'build': serializer.data
-            }, status=HTTP_503_SERVICE_UNAVAILABLE)
+        build = env.queue_build(git_hash, branch)
 
         serializer = BranchBuildSerializer(build)
-        return Response(serializer.data, status=HTTP_201_CREATED)
+        return Response(serializer.data, status=HTTP_202_ACCEPTED)
+
+
+@api_view(['GET'])
+@renderer_classes((JSONRenderer, EventStreamRenderer))
+def build_events(request, repo):
+    """
+    Server-sent events for the project's builds: `status` when a build
+    changes status and `deploy` when one is deployed to an environment.
+    Resumes after the Last-Event-ID header (or ?last_event_id=), resending
+    the events recorded just before it; otherwise starts with the next event.
+    """
+    site = get_object_or_404(Site, github_id=repo)
+    last_id = request.META.get('HTTP_LAST_EVENT_ID') or \
+        request.GET.get('last_event_id')
+    resumed = last_id is not None
+    if not resumed:
+        last_id = BuildEvent.objects.filter(site=site).order_by('-id')\
+                                    .values_list('id', flat=True).first()
+    try:
+        last_id = int(last_id or 0)
+    except ValueError:
+        raise BadRequest(detail='Last-Event-ID must be an event id')
+
+    if not acquire_slot():
+        raise ServiceUnavailable(detail='Too many open event streams')
+    response = StreamingHttpResponse(EventStream(site.id, last_id, resumed),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stops nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 
 class PromoteEnvironment(APIView):
@@ -153,7 +195,8 @@ class PromoteEnvironment(APIView):
     def get_object(self, request, repo, env):
         try:
             site = Site.objects.get(github_id=repo)
-            environment = Environment.objects.get(name__iexact=env, site=site)
+            environment = Environment.objects.get(lookup_name=env.lower(),
+                                                  site=site)
             uuid = request.data['uuid']
             build = BranchBuild.objects.get(uuid=uuid)
             return (environment, build)
@@ -178,8 +221,9 @@ class PromoteEnvironment(APIView):
                 Deploy.objects.create(build=build, environment=environment)
                 return Response(status=HTTP_201_CREATED)
             elif build.status == Build.FAILED or build.status == Build.NEW:
-                build.deploy(environment)
-                return Response(status=HTTP_201_CREATED)
+                enqueue(deploy_build, build_id=build.id,
+                        environment_id=environment.id)
+                return Response(status=HTTP_202_ACCEPTED)
         raise BadRequest()
 
 
@@ -195,13 +239,18 @@ def github_webhook(request):
             if event_type in ['push', 'create']:
                 github_event = GithubWebhookSerializer(data=request.data)
                 if github_event and github_event.is_valid():
-                    github_event.create_build_and_deploy()
-                    return Response(status=HTTP_201_CREATED)
+                    # The build is dispatched by a worker; see builder.tasks
+                    builds = github_event.create_build_and_deploy()
+                    WEBHOOK_EVENTS.labels(
+                        event_type, 'built' if builds else 'ignored').inc()
+                    return Response(status=HTTP_202_ACCEPTED)
                 else:
                     logger.warning("Received invalid Github Webhook message")
+                    WEBHOOK_EVENTS.labels(event_type, 'invalid').inc()
                 # Likely a webhook we don't build for.
                 return Response(status=HTTP_200_OK)
             elif event_type == 'ping':
+                WEBHOOK_EVENTS.labels(event_type, 'ignored').inc()
                 # We COULD update the DB with some important info here
                 # repository{ id, name, owner{ id, login },
                 #             sender{ id, login, site_admin }}
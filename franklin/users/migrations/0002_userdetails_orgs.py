@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userdetails',
+            name='org_ids',
+            field=models.TextField(default='', blank=True),
+        ),
+        migrations.AddField(
+            model_name='userdetails',
+            name='orgs_refreshed',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+    ]
@@ -1,12 +1,17 @@
 import logging
+from datetime import timedelta
+
 from django.conf import settings
+from django.core.cache import cache
 from django.dispatch import receiver
 from django.db import models
 from django.db.models.signals import post_save
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 
 from builder.models import Site
-from github.api import get_user_orgs
+from core.jobs import enqueue
+from github.api import get_user_orgs, invalidate_repo_permissions
 
 logger = logging.getLogger(__name__)
 
@@ -17,24 +22,55 @@ class UserDetails(models.Model):
 
     :param user: FK to a unique user
     :param sites: List of sites the user has permission to deploy
+    :param org_ids: Comma separated github ids of the user's organizations
+    :param orgs_refreshed: When org_ids was last fetched from github
     """
     user = models.OneToOneField(
         settings.AUTH_USER_MODEL, related_name='details')
     sites = models.ManyToManyField(Site, related_name='admins')
+    org_ids = models.TextField(blank=True, default='')
+    orgs_refreshed = models.DateTimeField(blank=True, null=True)
+
+    def get_org_ids(self):
+        """ Github ids of the user's organizations. They are only fetched
+        inline the first time; after that stale ids are returned while a
+        background job refreshes them.
+        """
+        if self.orgs_refreshed is None:
+            self.refresh_orgs()
+        elif self.orgs_refreshed < timezone.now() - timedelta(
+                seconds=settings.USER_ORGS_TIMEOUT):
+            # Only one refresh per user is queued at a time
+            if cache.add(self.refresh_key, True, settings.USER_ORGS_TIMEOUT):
+                enqueue('users.tasks.refresh_user_orgs', user_id=self.user_id)
+        return [int(org_id) for org_id in self.org_ids.split(',') if org_id]
+
+    def refresh_orgs(self):
+        orgs = get_user_orgs(self.user)
+        cache.delete(self.refresh_key)
+        if orgs is None:
+            logger.warning('Could not fetch orgs for %s', self.user)
+            return
+        self.org_ids = ','.join(str(org['id']) for org in orgs)
+        self.orgs_refreshed = timezone.now()
+        self.save(update_fields=['org_ids', 'orgs_refreshed'])
+
+    @property
+    def refresh_key(self):
+        return 'refresh-orgs:{0}'.format(self.user_id)
 
     def get_user_repos(self):
         # Return all sites owned by the user or one of their org memberships.
 
         # Init the owners list with the current user as they are an owner
         owners = [int(self.user.social_auth.get(provider='github').uid)]
-        orgs = get_user_orgs(self.user)
-        for org in orgs:
-            owners.append(org.get('id', ''))
+        owners.extend(self.get_org_ids())
         return Site.objects.filter(owner__github_id__in=owners)\
-                           .filter(is_active=True).all()
+                           .filter(is_active=True).select_related('owner')
 
     def update_repos_for_user(self, repos):
         # Clear out the users sites in case permissions have changed
+        invalidate_repo_permissions(self.user)
         self.sites.clear()
         all_sites = Site.objects.all()
         for repo in repos:
@@ -0,0 +1,9 @@
+from .models import UserDetails
+
+
+def refresh_user_orgs(user_id):
+    """ Refetches a user's org memberships from github """
+    details = UserDetails.objects.select_related('user').filter(
+        user_id=user_id).first()
+    if details:
+        details.refresh_orgs()
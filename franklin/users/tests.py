@@ -1,9 +1,13 @@
+from datetime import timedelta
 from unittest import mock
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase
+from django.utils import timezone
 
 from .models import UserDetails
 from builder.models import Owner, Site
+from core.models import Job
 
 
 class UserTestCase(TestCase):
@@ -30,3 +34,62 @@ class UserTestCase(TestCase):
         """ Every user that is created should have details
         """
         self.assertIsInstance(self.user.details, UserDetails)
+
+
+class OrgMembershipTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username="orgs", password="asdf")
+
+    @mock.patch('users.models.get_user_orgs')
+    def test_fetched_once(self, mock_orgs):
+        """ Orgs are fetched inline only the first time """
+        mock_orgs.return_value = [{'id': 5}, {'id': 6}]
+        details = self.user.details
+        self.assertEqual(details.get_org_ids(), [5, 6])
+        self.assertEqual(details.get_org_ids(), [5, 6])
+        self.assertEqual(mock_orgs.call_count, 1)
+        self.assertFalse(Job.objects.exists())
+
+    @mock.patch('users.models.get_user_orgs')
+    def test_stale_refreshed_in_background(self, mock_orgs):
+        """ Stale orgs are served while a single refresh job is queued """
+        details = self.user.details
+        details.org_ids = '5'
+        details.orgs_refreshed = timezone.now() - timedelta(days=1)
+        details.save()
+
+        self.assertEqual(details.get_org_ids(), [5])
+        self.assertEqual(details.get_org_ids(), [5])
+        self.assertFalse(mock_orgs.called)
+        self.assertEqual(Job.objects.filter(
+            task='users.tasks.refresh_user_orgs').count(), 1)
+
+    @mock.patch('users.models.get_user_orgs')
+    def test_failed_fetch_keeps_orgs(self, mock_orgs):
+        """ A failed fetch leaves the known orgs in place """
+        mock_orgs.return_value = None
+        details = self.user.details
+        details.org_ids = '5'
+        details.save()
+        details.refresh_orgs()
+        self.assertEqual(details.org_ids, '5')
+        self.assertIsNone(details.orgs_refreshed)
+
+    @mock.patch('core.helpers.client.get')
+    def test_partial_fetch_keeps_orgs(self, mock_get):
+        """ Orgs are only replaced when every page was fetched """
+        social = self.user.social_auth.create(provider='github', uid=123)
+        social.extra_data['access_token'] = 'abc123'
+        social.save()
+        url = 'https://api.github.com/user/orgs?per_page=100'
+        first = mock.Mock(status_code=200,
+                          links={'last': {'url': url + '&page=2'}})
+        first.json.return_value = [{'id': 6}]
+        mock_get.side_effect = [first, mock.Mock(status_code=502, links={})]
+        details = self.user.details
+        details.org_ids = '5'
+        details.save()
+        details.refresh_orgs()
+        self.assertEqual(details.org_ids, '5')
+        self.assertIsNone(details.orgs_refreshed)